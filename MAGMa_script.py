@@ -83,7 +83,21 @@ class MagmaCommand(object):
         sc.add_argument('-w', '--max_water_losses', help='Maximum number of additional water (OH) and/or ammonia (NH2) losses (default: %(default)s)', default=1, type=int)
         sc.add_argument('-u', '--use_all_peaks', help='Annotate all level 1 peaks, including those not fragmented (default: %(default)s)', action='store_true')
         sc.add_argument('--skip_fragmentation', help='Skip substructure annotation of fragment peaks (default: %(default)s)', action='store_true')
-        sc.add_argument('-f', '--fast', help='Quick calculations for molecules up to 64 atoms (default: %(default)s)', action='store_true')
+        sc.add_argument('-f', '--fast', help='Quick calculations with the compiled fragmentation engine (default: %(default)s)', action='store_true')
+        sc.add_argument('--prune_fragments', help='Do not generate fragments lighter than the lightest fragment peak (default: %(default)s)', action='store_true')
+        sc.add_argument('-n', '--ncpus', help='Number of parallel processes to match candidate molecules with (default: %(default)s)', default=1, type=int)
+        sc.add_argument('--shard', help='Only annotate shard i of N of the candidate molecules, given as i/N, to be combined with merge_results, --annotate_top and --prefilter_top then select the best candidates of each shard (default: %(default)s)', default=None, type=str)
+        sc.add_argument('--fragment_ncpus', help='Number of processes to expand the fragments of a large candidate molecule with (default: %(default)s)', default=1, type=int)
+        sc.add_argument('--symmetry', help='Generate and match symmetric fragments only once (default: %(default)s)', action='store_true')
+        sc.add_argument('--candidate_time_limit', help='Maximum time in seconds to match a candidate molecule, candidates exceeding it are skipped (default: %(default)s)', default=None, type=float)
+        sc.add_argument('--candidate_memory_limit', help='Maximum memory in MB to match a candidate molecule, candidates exceeding it are skipped (default: %(default)s)', default=None, type=float)
+        sc.add_argument('--reuse_parent_fragments', help='Generate the fragments of metabolites from those of their reactant (default: %(default)s)', action='store_true')
+        sc.add_argument('--prefilter_top', help='Rank the candidates first with a shallow search, and only annotate the best ones of each precursor ion with -b broken bonds (default: %(default)s)', default=None, type=int)
+        sc.add_argument('--prefilter_broken_bonds', help='Maximum number of bond breaks in the shallow search of --prefilter_top (default: %(default)s)', default=1, type=int)
+        sc.add_argument('--depth_budget', help='Time in seconds to fragment all candidates in, the number of bond breaks (-b) is reduced per candidate to fit it (default: %(default)s)', default=None, type=float)
+        sc.add_argument('--fragment_cache', help='Sqlite file with fragment tables cached between jobs (default: fragment_cache in magma_job.ini, if set)', default=None, type=str)
+        sc.add_argument('--annotate_top', help='Only add formula and SMILES to the fragments of the given number of best candidates per scan (default: all candidates)', default=None, type=int)
+        sc.add_argument('--fragment_library', help='Fragment library of the structure database, made with build_fragment_library (default: %(default)s)', default=None, type=str)
         sc.add_argument('-s', '--structure_database', help='Retrieve molecules from structure database  (default: %(default)s)', default='', choices=['pubchem',
          'kegg',
          'hmdb',
@@ -102,6 +116,27 @@ class MagmaCommand(object):
         sc.add_argument('--call_back_url', help='Call back url (default: %(default)s)', default=None, type=str)
         sc.add_argument('db', type=str, help='Sqlite database file with results')
         sc.set_defaults(func=self.annotate)
+        sc = subparsers.add_parser('build_fragment_library', help=self.build_fragment_library.__doc__, description=self.build_fragment_library.__doc__)
+        sc.add_argument('-b', '--max_broken_bonds', help='Maximum number of bond breaks to generate substructures (default: %(default)s)', default=3, type=int)
+        sc.add_argument('-w', '--max_water_losses', help='Maximum number of additional water (OH) and/or ammonia (NH2) losses (default: %(default)s)', default=1, type=int)
+        sc.add_argument('-i', '--ionisation_mode', help='Ionisation mode (default: %(default)s)', default='1', choices=['-1', '1'])
+        sc.add_argument('-n', '--ncpus', help='Number of parallel processes (default: %(default)s)', default=1, type=int)
+        sc.add_argument('-f', '--fast', help='Quick calculations with the compiled fragmentation engine (default: %(default)s)', action='store_true')
+        sc.add_argument('--log', help='Set logging level (default: %(default)s)', default='warn', choices=['debug',
+         'info',
+         'warn',
+         'error'])
+        sc.add_argument('structure_db', type=str, help='Sqlite structure database file (molecules table, as used by the annotate -s option)')
+        sc.add_argument('library', type=str, help='Fragment library file to write')
+        sc.set_defaults(func=self.build_fragment_library)
+        sc = subparsers.add_parser('merge_results', help=self.merge_results.__doc__, description=self.merge_results.__doc__)
+        sc.add_argument('--log', help='Set logging level (default: %(default)s)', default='warn', choices=['debug',
+         'info',
+         'warn',
+         'error'])
+        sc.add_argument('db', type=str, help='Sqlite database file with results, to add the results of the shards to')
+        sc.add_argument('shard_dbs', type=str, nargs='+', help='Sqlite database files with results of annotate --shard')
+        sc.set_defaults(func=self.merge_results)
         sc = subparsers.add_parser('select', help=self.select.__doc__, description=self.select.__doc__)
         sc.add_argument('-f', '--frag_id', help='Fragment_identifier as selection query (default: %(default)s)', default=None, type=int)
         sc.add_argument('db_in', type=str, help='Input sqlite database file with annotation results')
@@ -186,7 +221,7 @@ class MagmaCommand(object):
     def annotate(self, args, magma_session = None):
         if magma_session == None:
             magma_session = self.get_magma_session(args.db, args.description, args.log)
-        annotate_engine = magma_session.get_annotate_engine(skip_fragmentation=args.skip_fragmentation, max_broken_bonds=args.max_broken_bonds, max_water_losses=args.max_water_losses, ms_intensity_cutoff=args.ms_intensity_cutoff, msms_intensity_cutoff=args.msms_intensity_cutoff, use_all_peaks=args.use_all_peaks, adducts=args.adducts, force_adduct=args.force_adduct, max_charge=args.max_charge, call_back_url=args.call_back_url)
+        annotate_engine = magma_session.get_annotate_engine(skip_fragmentation=args.skip_fragmentation, max_broken_bonds=args.max_broken_bonds, max_water_losses=args.max_water_losses, ms_intensity_cutoff=args.ms_intensity_cutoff, msms_intensity_cutoff=args.msms_intensity_cutoff, use_all_peaks=args.use_all_peaks, adducts=args.adducts, force_adduct=args.force_adduct, max_charge=args.max_charge, call_back_url=args.call_back_url, fragment_cache=args.fragment_cache, fragment_library=args.fragment_library)
         if args.scans == 'all':
             scans = 'all'
         else:
@@ -217,14 +252,31 @@ class MagmaCommand(object):
             elif args.structure_database == 'metlin':
                 query_engine = magma.MetlinEngine(db_opts[0], db_opts[2] == 'True')
             pubchem_metids = annotate_engine.get_db_candidates(query_engine, db_opts[1])
+        shard = None
+        if args.shard != None:
+            shard = tuple([ int(x) for x in args.shard.split('/') ])
+            if len(shard) != 2 or not 1 <= shard[0] <= shard[1]:
+                exit('Shard should be given as i/N, with i from 1 to N')
         if args.metids == None:
-            annotate_engine.search_structures(fast=args.fast, time_limit=args.time_limit)
+            annotate_engine.search_structures(ncpus=args.ncpus, fast=args.fast, time_limit=args.time_limit, annotate_top=args.annotate_top, prune_fragments=args.prune_fragments, fragment_ncpus=args.fragment_ncpus, symmetry=args.symmetry, depth_budget=args.depth_budget, candidate_time_limit=args.candidate_time_limit, candidate_memory_limit=args.candidate_memory_limit, reuse_parent_fragments=args.reuse_parent_fragments, prefilter_top=args.prefilter_top, prefilter_broken_bonds=args.prefilter_broken_bonds, shard=shard)
         else:
             metids = args.metids.split(',') + pubchem_metids
-            annotate_engine.search_structures(metids=metids, ncpus=args.ncpus, fast=args.fast, time_limit=args.time_limit)
+            annotate_engine.search_structures(metids=metids, ncpus=args.ncpus, fast=args.fast, time_limit=args.time_limit, annotate_top=args.annotate_top, prune_fragments=args.prune_fragments, fragment_ncpus=args.fragment_ncpus, symmetry=args.symmetry, depth_budget=args.depth_budget, candidate_time_limit=args.candidate_time_limit, candidate_memory_limit=args.candidate_memory_limit, reuse_parent_fragments=args.reuse_parent_fragments, prefilter_top=args.prefilter_top, prefilter_broken_bonds=args.prefilter_broken_bonds, shard=shard)
         magma_session.commit()
         magma_session.fill_molecules_reactions()
 
+    def build_fragment_library(self, args):
+        """Fragments all molecules of a structure database into a fragment library for annotate"""
+        logging.basicConfig(format='%(levelname)s: %(message)s', level=getattr(logging, args.log.upper()))
+        magma.build_fragment_library(args.structure_db, args.library, args.max_broken_bonds, args.max_water_losses, int(args.ionisation_mode), args.ncpus, args.fast)
+
+    def merge_results(self, args):
+        """Merges the results of annotate --shard jobs on copies of a database into one of them"""
+        magma_session = self.get_magma_session(args.db, '', args.log)
+        magma.merge_results(args.db, args.shard_dbs)
+        magma_session.fill_molecules_reactions()
+        magma_session.commit()
+
     def select(self, args):
         shutil.copy(args.db_in, args.db_out)
         magma_session = self.get_magma_session(args.db_out)
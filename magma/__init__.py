@@ -12,6 +12,14 @@ import sqlite3
 import struct
 import zlib
 import gzip
+import hashlib
+import json
+import tempfile
+import shutil
+import multiprocessing
+import multiprocessing.pool
+import signal
+import resource
 import copy
 import pkg_resources
 import numpy
@@ -21,9 +29,10 @@ from sqlalchemy import create_engine, and_, desc, distinct
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql import func
-from models import Base, Metabolite, Reaction, fill_molecules_reactions, Scan, Peak, Fragment, Run
+from models import Base, Metabolite, Reaction, fill_molecules_reactions, add_missing_columns, Scan, Peak, Fragment, Run
 import requests
 import functools
+import collections
 #import macauthlib
 from requests.auth import AuthBase
 import cPickle as pickle
@@ -41,6 +50,9 @@ elif config.get('magma job', 'chemical_engine') == 'cdk':
     import cdk_engine
     Chem = cdk_engine.engine()
 
+# number of fragmented reactants kept in memory to generate the fragments of their products from
+max_parent_engines = 16
+
 class MagmaSession(object):
 
     def __init__(self, db_name, description = '', loglevel = 'warning'):
@@ -49,6 +61,7 @@ class MagmaSession(object):
         session.configure(bind=engine)
         self.db_session = session()
         Base.metadata.create_all(engine)
+        add_missing_columns(engine)
         try:
             rundata = self.db_session.query(Run).one()
         except:
@@ -71,8 +84,8 @@ class MagmaSession(object):
 
 
 
-    def get_annotate_engine(self, skip_fragmentation = False, max_broken_bonds = 3, max_water_losses = 1, ms_intensity_cutoff = 1000000.0, msms_intensity_cutoff = 5, use_all_peaks = False, adducts = None, force_adduct = False, max_charge = 1, call_back_url = None):
-        return AnnotateEngine(self.db_session, skip_fragmentation, max_broken_bonds, max_water_losses, ms_intensity_cutoff, msms_intensity_cutoff, use_all_peaks, adducts, force_adduct, max_charge, call_back_url)
+    def get_annotate_engine(self, skip_fragmentation = False, max_broken_bonds = 3, max_water_losses = 1, ms_intensity_cutoff = 1000000.0, msms_intensity_cutoff = 5, use_all_peaks = False, adducts = None, force_adduct = False, max_charge = 1, call_back_url = None, fragment_cache = None, fragment_library = None):
+        return AnnotateEngine(self.db_session, skip_fragmentation, max_broken_bonds, max_water_losses, ms_intensity_cutoff, msms_intensity_cutoff, use_all_peaks, adducts, force_adduct, max_charge, call_back_url, fragment_cache, fragment_library)
 
 
 
@@ -719,7 +732,7 @@ class MsDataEngine(object):
 
 class AnnotateEngine(object):
 
-    def __init__(self, db_session, skip_fragmentation, max_broken_bonds, max_water_losses, ms_intensity_cutoff, msms_intensity_cutoff, use_all_peaks, adducts = None, force_adduct = False, max_charge = 1, call_back_url = None):
+    def __init__(self, db_session, skip_fragmentation, max_broken_bonds, max_water_losses, ms_intensity_cutoff, msms_intensity_cutoff, use_all_peaks, adducts = None, force_adduct = False, max_charge = 1, call_back_url = None, fragment_cache = None, fragment_library = None):
         self.db_session = db_session
         try:
             rundata = self.db_session.query(Run).one()
@@ -758,6 +771,18 @@ class AnnotateEngine(object):
             self.call_back_engine = CallBackEngine(call_back_url)
         else:
             self.call_back_engine = None
+        if fragment_cache == None and config.has_option('magma job', 'fragment_cache'):
+            fragment_cache = config.get('magma job', 'fragment_cache')
+        if fragment_cache != None:
+            self.fragment_cache = FragmentCache(fragment_cache)
+        else:
+            self.fragment_cache = None
+        self.fragment_library = None
+        if fragment_library != None:
+            self.fragment_library = FragmentLibrary(fragment_library)
+            if not self.fragment_library.compatible(self.max_broken_bonds, self.max_water_losses, self.ionisation_mode):
+                print 'WARNING: Fragment library ' + fragment_library + ' was built with other parameters, not used'
+                self.fragment_library = None
         print 'SETTINGS FOR MATCHING PRECURSOR IONS AND CANDIDATES:'
         print 'Ionisation mode:',
         print self.ionisation_mode
@@ -981,7 +1006,38 @@ class AnnotateEngine(object):
 
 
 
-    def search_structures(self, metids = None, fast = False, time_limit = None):
+    def search_structures(self, metids = None, fast = False, time_limit = None, annotate_top = None, prune_fragments = False, fragment_ncpus = 1, symmetry = False, depth_budget = None, candidate_time_limit = None, candidate_memory_limit = None, reuse_parent_fragments = False, prefilter_top = None, prefilter_broken_bonds = 1, ncpus = 1, shard = None):
+        """Matches the candidate molecules with the spectra and stores their hits.
+
+        With a depth_budget (in seconds) the number of broken bonds is chosen per candidate,
+        at most max_broken_bonds, so that fragmenting all candidates fits the budget (see DepthPolicy).
+        The number of broken bonds used is stored with the fragments of each candidate.
+
+        With a candidate_time_limit (in seconds) or candidate_memory_limit (in MB) each candidate
+        is matched in a worker process, which is killed when it exceeds the limit. The candidate
+        is then skipped, with the reason stored in its skip_reason, and the search continues.
+
+        With reuse_parent_fragments, the fragments of metabolites which are the product of a reaction are
+        generated from those of the reactant, when it has more than one product (see get_parent_engine).
+        The reactant is fragmented as part of the job of its first product. This is not done with candidate
+        limits, as a supervised worker can not keep the reactant fragments for the next product.
+
+        With prefilter_top, the candidates are first ranked with a shallow search (see prefilter_structures),
+        and only the prefilter_top best candidates of each precursor ion are matched at full depth. The
+        shallow search uses the same workers, fragment cache and library, and candidate limits.
+
+        When the fragmentation is skipped, the candidates are matched by their mass only (see match_precursors).
+
+        With ncpus > 1 the candidates are matched by a pool of ncpus worker processes, while this process
+        reads the candidates and stores all results, in the same order as with a single process. The
+        depth_budget is then shared by the workers.
+
+        With shard (index, nshards), only the candidates with metid % nshards == index - 1 are matched, to
+        split a job over several copies of its database, which are combined afterwards with merge_results.
+        A prefilter or annotate_top then selects the best candidates of each shard, so the merged results
+        have up to nshards times as many candidates per precursor ion matched at full depth or annotated,
+        which include those a single job would select.
+        """
         global fragid
         print 'MATCHING CANDIDATE MOLECULES'
         fragid = self.db_session.query(func.max(Fragment.fragid)).scalar()
@@ -993,45 +1049,91 @@ class AnnotateEngine(object):
             else:
                 metabdata = self.db_session.query(Metabolite.metid).order_by(Metabolite.probability).all()
             metids = [ x[0] for x in metabdata ]
+        if shard != None:
+            (index, nshards,) = shard
+            metids = [ metid for metid in metids if int(metid) % nshards == index - 1 ]
+        pool = None
+        process_pool = False
+        # number of candidates submitted to the pool ahead of the one being stored
+        window = 0
+        if ncpus > 1 and len(metids) > 0 and not self.skip_fragmentation:
+            window = 2 * ncpus
+            (pool, process_pool,) = self.get_search_pool(ncpus, candidate_time_limit, candidate_memory_limit)
+            if process_pool:
+                # pool processes can not start a pool to expand the fragments with
+                fragment_ncpus = 1
+        search_kwargs = {'prune_fragments': prune_fragments,
+         'fragment_ncpus': fragment_ncpus,
+         'symmetry': symmetry}
+        if not process_pool:
+            # the workers of a process pool use their own connections, see init_search_worker
+            search_kwargs['fragment_cache'] = self.fragment_cache
+            search_kwargs['fragment_library'] = self.fragment_library
+        if prefilter_top != None and not self.skip_fragmentation:
+            metids = self.prefilter_structures(metids, prefilter_top, prefilter_broken_bonds, fast, search_kwargs, pool, window, candidate_time_limit, candidate_memory_limit)
         total_frags = 0
         total_metids = len(metids)
+        if self.skip_fragmentation:
+            total_frags = self.match_precursors(metids, time_limit)
+            metids = []
+        depth_policy = None
+        if depth_budget != None and not self.skip_fragmentation:
+            depth_policy = DepthPolicy(self.max_broken_bonds, self.max_water_losses, depth_budget * max(1, ncpus), total_metids)
+        reactants = {}
+        parent_engines = collections.OrderedDict()
+        if reuse_parent_fragments and not self.skip_fragmentation and not symmetry and candidate_time_limit == None and candidate_memory_limit == None:
+            nproducts = {}
+            for (reactant, product,) in self.db_session.query(Reaction.reactant, Reaction.product).all():
+                nproducts[reactant] = nproducts.get(reactant, 0) + 1
+                reactants.setdefault(product, reactant)
+
+            reactants = dict([ (product, reactant) for (product, reactant,) in reactants.iteritems() if nproducts[reactant] > 1 ])
         start_time = time.time()
         count = 0
-        while len(metids) > 0:
-            ids = set([])
-            while len(ids) < 500 and len(metids) > 0:
-                ids.add(metids.pop())
 
-            structures = self.db_session.query(Metabolite).filter(Metabolite.metid.in_(ids)).all()
-            jobs = []
+        def get_jobs(structures):
+            # the depth of a candidate is chosen when it is submitted, after the results of the candidates before the window
             for structure in structures:
                 if self.db_session.query(Fragment.fragid).filter(Fragment.metid == structure.metid).count() > 0:
                     logging.warn('Metabolite ' + str(structure.metid) + ': Already annotated, skipped')
+                    if depth_policy != None:
+                        depth_policy.skip_candidate()
                     continue
-                molcharge = 0
-                molcharge += 1 * (structure.molformula[-1] == '-' and self.ionisation_mode == -1 or structure.molformula[-1] == '+' and self.ionisation_mode == 1)
-                peaks = set([])
-                for charge in range(1, len(self.ions)):
-                    for ionmass in self.ions[(charge - molcharge)]:
-                        int_mass = int(round((structure.mim + ionmass) / charge))
-                        try:
-                            peaks = peaks.union(self.indexed_peaks[int_mass])
-                        except:
-                            pass
-                        try:
-                            peaks = peaks.union(self.indexed_peaks[(int_mass - 1)])
-                        except:
-                            pass
-                        try:
-                            peaks = peaks.union(self.indexed_peaks[(int_mass + 1)])
-                        except:
-                            pass
-
-
+                molcharge = self.get_molcharge(structure.molformula)
+                peaks = self.get_candidate_peaks(structure.mim, molcharge)
                 if len(peaks) == 0:
                     logging.info('Metabolite ' + str(structure.metid) + ': No match')
+                    if depth_policy != None:
+                        depth_policy.skip_candidate()
                     continue
-                (hits, frags,) = search_structure(structure.mol, structure.mim, molcharge, peaks, self.max_broken_bonds, self.max_water_losses, self.precision, self.mz_precision_abs, self.use_all_peaks, self.ionisation_mode, self.skip_fragmentation, fast and structure.natoms <= 64, config.get('magma job', 'chemical_engine'), self.ions)
+                max_broken_bonds = self.max_broken_bonds
+                if depth_policy != None:
+                    max_broken_bonds = depth_policy.choose_depth(structure.mol)
+                    logging.debug('Metabolite ' + str(structure.metid) + ': ' + str(max_broken_bonds) + ' broken bonds')
+                search_args = (structure.mol, structure.mim, molcharge, peaks, max_broken_bonds, self.max_water_losses, self.precision, self.mz_precision_abs, self.use_all_peaks, self.ionisation_mode, self.skip_fragmentation, fast, config.get('magma job', 'chemical_engine'), self.ions)
+                kwargs = dict(search_kwargs, inchikey=structure.smiles, annotate_fragments=annotate_top == None)
+                parent = None
+                if structure.metid in reactants:
+                    parent = self.get_parent(reactants[structure.metid], max_broken_bonds, fast)
+                # parent engines are not passed to worker processes, which keep their own
+                yield ((structure, max_broken_bonds), (search_args, kwargs, candidate_time_limit, candidate_memory_limit, parent, None if process_pool else parent_engines))
+
+
+
+        while len(metids) > 0:
+            ids = set([])
+            while len(ids) < 500 and len(metids) > 0:
+                ids.add(metids.pop())
+
+            structures = self.db_session.query(Metabolite).filter(Metabolite.metid.in_(ids)).all()
+            for ((structure, max_broken_bonds,), result, seconds,) in run_search_jobs(get_jobs(structures), pool, window):
+                if depth_policy != None:
+                    depth_policy.add_candidate(structure.mol, max_broken_bonds, seconds)
+                if isinstance(result, str):
+                    logging.warn('Metabolite ' + str(structure.metid) + ': Skipped, ' + result)
+                    structure.skip_reason = unicode(result)
+                    result = ([], 0)
+                (hits, frags,) = result
                 total_frags += frags
                 logging.debug(' -> ' + str(frags) + ' fragments')
                 structure.nhits = len(hits)
@@ -1044,7 +1146,7 @@ class AnnotateEngine(object):
                     print structure.origin.encode('utf-8')
                     for hit in hits:
                         print 'Scan: ' + str(hit.scan) + ' - Mz: ' + str(hit.mz) + ' - ' + 'Score:',
-                        print self.store_hit(hit, structure.metid, 0)
+                        print self.store_hit(hit, structure.metid, 0, max_broken_bonds)
 
                 self.db_session.flush()
                 count += 1
@@ -1061,6 +1163,14 @@ class AnnotateEngine(object):
 
             self.db_session.commit()
 
+        if pool != None:
+            # after a time limit, candidates still being matched are dropped
+            pool.terminate()
+            pool.join()
+        if annotate_top != None:
+            self.annotate_fragments(annotate_top)
+        elif prefilter_top != None:
+            self.annotate_fragments()
         if self.call_back_engine != None:
             self.call_back_engine.update_callback_url('Annotation completed', force=True)
         logging.info(str(total_frags) + ' fragments generated in total.')
@@ -1071,8 +1181,276 @@ class AnnotateEngine(object):
 
 
 
-    def store_hit(self, hit, metid, parentfragid):
+    def match_precursors(self, metids, time_limit = None):
+        """Matches the candidate molecules with the precursor peaks when the fragmentation is skipped.
+
+        The hits are those of search_structure (see get_hit and MoleculeFragmentEngine), but the matching only
+        uses the mim and molformula of the candidates, for all candidates at once, without parsing their molecules.
+        The number of atoms of a candidate that matched is read from the counts line of its molblock, which is
+        only parsed if it has hydrogen atoms, as these may be removed, and the natoms column counts the heavy
+        atoms only. Candidates without a counts line are not matched. The formula and InChIKey of the hits are
+        the molformula and smiles (InChIKey) of the candidate. Progress is reported and time_limit (in minutes)
+        applied as in search_structures. Returns the number of candidates matched, as each has one fragment.
+        """
+        annotated = set([ x[0] for x in self.db_session.query(distinct(Fragment.metid)).all() ])
+        candidates = []
+        for i in range(0, len(metids), 500):
+            candidates.extend(self.db_session.query(Metabolite.metid, Metabolite.mim, Metabolite.molformula, Metabolite.origin, Metabolite.natoms, Metabolite.smiles).filter(Metabolite.metid.in_(metids[i:i + 500])).all())
+
+        for metid in annotated.intersection([ int(metid) for metid in metids ]):
+            logging.warn('Metabolite ' + str(metid) + ': Already annotated, skipped')
+
+        candidates = [ candidate for candidate in candidates if candidate[0] not in annotated ]
+        peaks = []
+        for scan in self.scans:
+            for peak in scan.peaks:
+                if not (not self.use_all_peaks and peak.childscan == None):
+                    peaks.append(peak)
+
+
+
+        if len(candidates) == 0 or len(peaks) == 0:
+            return 0
+        mims = numpy.array([ candidate[1] for candidate in candidates ])
+        molcharges = numpy.array([ self.get_molcharge(candidate[2]) for candidate in candidates ])
+        peak_mzs = numpy.array([ peak.mz for peak in peaks ])
+        lowmzs = numpy.minimum(peak_mzs / self.precision, peak_mzs - self.mz_precision_abs)
+        highmzs = numpy.maximum(peak_mzs * self.precision, peak_mzs + self.mz_precision_abs)
+        # the first ion matching a candidate with a peak is used, in the order of search_structure
+        matches = {}
+        for charge in range(1, len(self.ions)):
+            for molcharge in (0, 1):
+                selected = numpy.flatnonzero(molcharges == molcharge)
+                for (ionmass, ion,) in self.ions[(charge - molcharge)].iteritems():
+                    mzs = (mims[selected] + ionmass) / charge - self.ionisation_mode * pars.elmass
+                    order = numpy.argsort(mzs, kind='mergesort')
+                    sorted_mzs = mzs[order]
+                    start = numpy.searchsorted(sorted_mzs, lowmzs, 'left')
+                    end = numpy.searchsorted(sorted_mzs, highmzs, 'right')
+                    for p in numpy.flatnonzero(end > start):
+                        for c in selected[order[start[p]:end[p]]]:
+                            matches.setdefault(c, {}).setdefault(p, (ionmass, ion))
+
+
+
+        start_time = time.time()
+        total_metids = len(metids)
+        nmatched = 0
+        for (c, candidate_matches,) in sorted(matches.iteritems()):
+            (metid, mim, molformula, origin, heavy_atoms, inchikey,) = candidates[c]
+            mol = self.db_session.query(Metabolite.mol).filter(Metabolite.metid == metid).scalar()
+            counts = get_molblock_counts(mol)
+            if counts != None:
+                natoms = counts[0]
+                if natoms != heavy_atoms:
+                    # hydrogen atoms are removed when the molecule is parsed, unless they are isotopes
+                    natoms = Chem.natoms(Chem.MolFromMolBlock(str(mol)))
+                fragment_engine = MoleculeFragmentEngine(natoms, mim, molcharges[c], self.ionisation_mode, molformula, inchikey)
+                hits = []
+                for (p, (ionmass, ion,),) in sorted(candidate_matches.iteritems()):
+                    hit = get_hit(fragment_engine, peaks[p], fragment_engine.molecule, 0, 0, mim, ionmass, ion, self.precision, self.mz_precision_abs, self.ionisation_mode)
+                    add_fragment_data_to_hit(fragment_engine, hit)
+                    hits.append(hit)
+
+                self.db_session.query(Metabolite).filter(Metabolite.metid == metid).update({'nhits': len(hits)}, synchronize_session=False)
+                print 'Metabolite',
+                print str(metid) + ':',
+                print origin.encode('utf-8')
+                for hit in hits:
+                    print 'Scan: ' + str(hit.scan) + ' - Mz: ' + str(hit.mz) + ' - ' + 'Score:',
+                    print self.store_hit(hit, metid, 0, self.max_broken_bonds)
+
+                nmatched += 1
+            else:
+                logging.info('Metabolite ' + str(metid) + ': No match')
+            elapsed_time = time.time() - start_time
+            if self.call_back_engine != None:
+                # the candidates before it, which did not match, are processed as well
+                processed = total_metids - len(candidates) + c + 1
+                status = 'Annotation: %d / %d candidate molecules processed  (%d%%)' % (processed, total_metids, 100.0 * processed / total_metids)
+                self.call_back_engine.update_callback_url(status, elapsed_time, time_limit)
+            if time_limit and elapsed_time > time_limit * 60:
+                if self.call_back_engine != None:
+                    self.call_back_engine.update_callback_url('Annotation stopped: time limit exceeded', force=True)
+                print 'WARNING: Annotation stopped: time limit exceeded'
+                break
+
+        self.db_session.commit()
+        return nmatched
+
+
+
+    def get_candidate_peaks(self, mim, molcharge):
+        """Returns the set of precursor peaks within one Dalton of the ions of a candidate molecule"""
+        peaks = set([])
+        for charge in range(1, len(self.ions)):
+            for ionmass in self.ions[(charge - molcharge)]:
+                int_mass = int(round((mim + ionmass) / charge))
+                try:
+                    peaks = peaks.union(self.indexed_peaks[int_mass])
+                except:
+                    pass
+                try:
+                    peaks = peaks.union(self.indexed_peaks[(int_mass - 1)])
+                except:
+                    pass
+                try:
+                    peaks = peaks.union(self.indexed_peaks[(int_mass + 1)])
+                except:
+                    pass
+
+
+        return peaks
+
+
+
+    def prefilter_structures(self, metids, top, max_broken_bonds, fast, search_kwargs = {}, pool = None, window = 0, candidate_time_limit = None, candidate_memory_limit = None):
+        """First stage of a two-stage search: matches the candidate molecules with fragments of at most
+        max_broken_bonds broken bonds and no water losses, and ranks them per precursor ion by this score.
+        The candidates are matched as in search_structures, with search_kwargs and the pool and limits
+        it uses, but without the formula and SMILES of the hits.
+
+        Returns the metids of the candidates among the top best of at least one precursor ion (including
+        candidates tied with the last of them), in the order of metids, to be matched at full depth. The
+        other candidates are stored with their hits of the shallow search, which is marked by max_broken_bonds
+        of their fragments, and are annotated by search_structures afterwards. Candidates exceeding a limit
+        are stored as skipped. Candidates which are already annotated or match no precursor are passed on,
+        the full search skips them as before.
+        """
+        print 'RANKING CANDIDATE MOLECULES'
+        selected = set([])
+        ranking = {}
+        shallow_hits = {}
+
+        def get_jobs(structures):
+            for structure in structures:
+                if self.db_session.query(Fragment.fragid).filter(Fragment.metid == structure.metid).count() > 0:
+                    selected.add(structure.metid)
+                    continue
+                molcharge = self.get_molcharge(structure.molformula)
+                peaks = self.get_candidate_peaks(structure.mim, molcharge)
+                if len(peaks) == 0:
+                    selected.add(structure.metid)
+                    continue
+                search_args = (structure.mol, structure.mim, molcharge, peaks, max_broken_bonds, 0, self.precision, self.mz_precision_abs, self.use_all_peaks, self.ionisation_mode, False, fast, config.get('magma job', 'chemical_engine'), self.ions)
+                kwargs = dict(search_kwargs, inchikey=structure.smiles, annotate_fragments=False)
+                yield (structure.metid, (search_args, kwargs, candidate_time_limit, candidate_memory_limit))
+
+
+
+        skipped = {}
+        for i in range(0, len(metids), 500):
+            structures = self.db_session.query(Metabolite).filter(Metabolite.metid.in_(metids[i:i + 500])).all()
+            for (metid, result, seconds,) in run_search_jobs(get_jobs(structures), pool, window):
+                if isinstance(result, str):
+                    logging.warn('Metabolite ' + str(metid) + ': Skipped, ' + result)
+                    skipped[metid] = unicode(result)
+                    continue
+                (hits, frags,) = result
+                shallow_hits[metid] = hits
+                for hit in hits:
+                    ranking.setdefault((hit.scan, hit.mz), []).append((hit.score, metid))
+
+
+
+        for candidates in ranking.itervalues():
+            candidates.sort()
+            # candidates tied with the last one selected are selected as well
+            cutoff = candidates[min(top, len(candidates)) - 1][0]
+            selected.update([ metid for (score, metid,) in candidates if score <= cutoff ])
+
+        for i in range(0, len(metids), 500):
+            structures = self.db_session.query(Metabolite).filter(Metabolite.metid.in_(metids[i:i + 500])).all()
+            for structure in structures:
+                if structure.metid in selected:
+                    continue
+                hits = shallow_hits.get(structure.metid, [])
+                structure.nhits = len(hits)
+                structure.skip_reason = skipped.get(structure.metid)
+                self.db_session.add(structure)
+                for hit in hits:
+                    self.store_hit(hit, structure.metid, 0, max_broken_bonds, 0)
+
+
+            self.db_session.flush()
+
+        self.db_session.commit()
+        logging.info(str(len(selected)) + ' of ' + str(len(metids)) + ' candidate molecules selected for full annotation')
+        return [ metid for metid in metids if int(metid) in selected ]
+
+
+
+    def get_search_pool(self, ncpus, candidate_time_limit = None, candidate_memory_limit = None):
+        """Returns a pool of ncpus workers to run search_structure_job in, and whether it is a pool of
+        processes, which use their own fragment cache and library (see init_search_worker)"""
+        if candidate_time_limit != None or candidate_memory_limit != None:
+            # pool processes can not start processes, so the supervised workers are started from threads
+            return (multiprocessing.pool.ThreadPool(ncpus), False)
+        fragment_cache = None
+        if self.fragment_cache != None:
+            fragment_cache = (self.fragment_cache.dbfilename, self.fragment_cache.max_size / 1000000.0)
+        fragment_library = None
+        if self.fragment_library != None:
+            fragment_library = self.fragment_library.libfilename
+        return (multiprocessing.Pool(ncpus, init_search_worker, (fragment_cache, fragment_library)), True)
+
+
+
+    def get_molcharge(self, molformula):
+        """Returns 1 for a molecule charged in the ionisation mode, according to its formula, otherwise 0"""
+        return 1 * (molformula[-1] == '-' and self.ionisation_mode == -1 or molformula[-1] == '+' and self.ionisation_mode == 1)
+
+
+
+    def get_parent(self, metid, max_broken_bonds, fast):
+        """Returns the arguments of get_parent_engine for the reactant metid of a candidate molecule"""
+        (mol, molformula,) = self.db_session.query(Metabolite.mol, Metabolite.molformula).filter(Metabolite.metid == metid).one()
+        return (metid, mol, self.get_molcharge(molformula), max_broken_bonds, self.max_water_losses, self.ionisation_mode, fast)
+
+
+
+    def annotate_fragments(self, top_candidates = None):
+        """Adds formula and SMILES to fragments stored without them, for the top_candidates best candidates of each precursor ion"""
+        import fragmentation_py
+        candidates = {}
+        for (scanid, mz, metid, score,) in self.db_session.query(Fragment.scanid, Fragment.mz, Fragment.metid, Fragment.score).filter(Fragment.parentfragid == 0).all():
+            candidates.setdefault((scanid, mz), []).append((score, metid))
+
+        metids = set([])
+        for scan_candidates in candidates.itervalues():
+            scan_candidates.sort()
+            metids.update([ metid for (score, metid,) in scan_candidates[:top_candidates] ])
+
+        for metid in metids:
+            fragments = self.db_session.query(Fragment).filter(Fragment.metid == metid).filter(Fragment.inchikey == u'').all()
+            if len(fragments) == 0:
+                continue
+            mol = self.db_session.query(Metabolite.mol).filter(Metabolite.metid == metid).scalar()
+            fragment_engine = fragmentation_py.FragmentEngine(mol, self.max_broken_bonds, self.max_water_losses, self.ionisation_mode, self.skip_fragmentation, 0)
+            fragment_atoms = []
+            for fragment in fragments:
+                atoms = 0
+                for atom in fragment.atoms.split(',')[1:]:
+                    atoms |= 1 << int(atom)
+
+                fragment_atoms.append(atoms)
+
+            fragment_engine.get_fragments_info(fragment_atoms)
+            for (fragment, atoms,) in zip(fragments, fragment_atoms):
+                (atomstring, atomlist, formula, smiles,) = fragment_engine.get_fragment_info(atoms, fragment.deltah)
+                fragment.formula = unicode(formula) + fragment.formula
+                fragment.inchikey = unicode(smiles)
+
+
+        self.db_session.commit()
+        logging.info('Fragments of ' + str(len(metids)) + ' candidates annotated')
+
+
+
+    def store_hit(self, hit, metid, parentfragid, max_broken_bonds = None, max_water_losses = None):
         global fragid
+        if max_water_losses == None:
+            max_water_losses = self.max_water_losses
         fragid += 1
         currentFragid = fragid
         score = hit.score
@@ -1083,11 +1461,11 @@ class AnnotateEngine(object):
             if hit.ion[-2] in '123456789':
                 charge = int(hit.ion[-2])
             deltappm = (hit.mz - (hit.mass + hit.deltaH) / charge + self.ionisation_mode * pars.elmass) / hit.mz * 1000000.0
-        self.db_session.add(Fragment(metid=metid, scanid=hit.scan, mz=hit.mz, mass=hit.mass, score=score, parentfragid=parentfragid, atoms=unicode(hit.atomstring), inchikey=unicode(hit.inchikey), deltah=hit.deltaH, deltappm=deltappm, formula=unicode(hit.formula + '<br>' + hit.ion)))
+        self.db_session.add(Fragment(metid=metid, scanid=hit.scan, mz=hit.mz, mass=hit.mass, score=score, parentfragid=parentfragid, atoms=unicode(hit.atomstring), inchikey=unicode(hit.inchikey), deltah=hit.deltaH, deltappm=deltappm, formula=unicode(hit.formula + '<br>' + hit.ion), max_broken_bonds=max_broken_bonds, max_water_losses=max_water_losses))
         if len(hit.besthits) > 0:
             for childhit in hit.besthits:
                 if childhit != None:
-                    self.store_hit(childhit, metid, currentFragid)
+                    self.store_hit(childhit, metid, currentFragid, max_broken_bonds, max_water_losses)
 
         return score
 
@@ -1289,6 +1667,498 @@ class MetaCycEngine(object):
 
 
 
+class FragmentLibrary(object):
+    """Precomputed fragment tables of all molecules in a structure database.
+
+    The library is a single sidecar file, written by build_fragment_library, with
+    flat arrays for all molecules followed by a JSON header and a trailer. The
+    arrays are memory-mapped, so opening a library is cheap and only the pages of
+    the candidates that are looked up are read from disk. Molecules are found by
+    InChIKey; a digest of the atom block guards against different atom numbering.
+    """
+
+    magic = 'MAGMAFL1'
+
+    def __init__(self, libfilename):
+        self.libfilename = libfilename
+        libfile = open(libfilename, 'rb')
+        libfile.seek(-16, 2)
+        end = libfile.tell()
+        (header_offset, magic,) = struct.unpack('<Q8s', libfile.read(16))
+        if magic != self.magic:
+            raise IOError('Not a fragment library: ' + libfilename)
+        libfile.seek(header_offset)
+        header = json.loads(libfile.read(end - header_offset))
+        libfile.close()
+        self.parameters = header['parameters']
+        self.arrays = {}
+        for (name, (dtype, shape, offset,),) in header['arrays'].items():
+            if numpy.prod(shape) == 0:
+                self.arrays[name] = numpy.zeros(shape, dtype=dtype)
+            else:
+                self.arrays[name] = numpy.memmap(libfilename, dtype=dtype, mode='r', offset=offset, shape=tuple(shape))
+
+
+
+    def compatible(self, max_broken_bonds, max_water_losses, ionisation_mode):
+        # compare in the JSON form in which the parameters are stored
+        return self.parameters == json.loads(json.dumps(get_fragment_library_parameters(max_broken_bonds, max_water_losses, ionisation_mode)))
+
+
+
+    def get_fragments(self, inchikey, molblock, molcharge):
+        """Returns fragments, masses, scores and bondbreaks of a molecule, or None if it is not in the library"""
+        inchikeys = self.arrays['inchikeys']
+        key = str(inchikey)
+        digest = get_atom_block_digest(molblock)
+        i = numpy.searchsorted(inchikeys, key)
+        while i < len(inchikeys) and inchikeys[i] == key:
+            if self.arrays['digests'][i] == digest and self.arrays['molcharges'][i] == molcharge:
+                start = int(self.arrays['fragment_offsets'][i])
+                end = start + int(self.arrays['fragment_counts'][i])
+                nwords = int(self.arrays['nwords'][i])
+                word_start = int(self.arrays['word_offsets'][i])
+                words = self.arrays['words'][word_start:word_start + (end - start) * nwords].reshape((end - start, nwords))
+                fragments = [0] * (end - start)
+                for w in range(nwords - 1, -1, -1):
+                    fragments = [ fragment << 64 | word for (fragment, word,) in zip(fragments, words[:, w].tolist()) ]
+
+                return (fragments,
+                 numpy.array(self.arrays['masses'][start:end]),
+                 numpy.array(self.arrays['scores'][start:end]),
+                 numpy.array(self.arrays['bondbreaks'][start:end]))
+            i += 1
+
+        return None
+
+
+
+
+def get_atom_block_digest(molblock):
+    """64 bit digest of the atom and bond block of a molblock, fragments depend on its atom numbering"""
+    atom_block = str(molblock).split('\n', 3)[-1]
+    return int(hashlib.sha1(atom_block).hexdigest()[:16], 16)
+
+
+
+def get_fragment_library_parameters(max_broken_bonds, max_water_losses, ionisation_mode):
+    import fragmentation_py
+    parameters = {'max_broken_bonds': max_broken_bonds,
+     'max_water_losses': max_water_losses,
+     'ionisation_mode': ionisation_mode,
+     'typew': sorted(pars.typew.items()),
+     'heterow': sorted(pars.heterow.items())}
+    # large molecules are stored as found with the beam search, if it is enabled in magma_job.ini
+    if fragmentation_py.beam_max_atoms != None or fragmentation_py.beam_max_bonds != None:
+        parameters['beam'] = [fragmentation_py.beam_max_atoms, fragmentation_py.beam_max_bonds, fragmentation_py.beam_width]
+    return parameters
+
+
+
+def fragment_library_molecule(job):
+    """Generates the fragments of one molecule of a structure database, for build_fragment_library"""
+    (inchikey, molblock, molcharge, max_broken_bonds, max_water_losses, ionisation_mode, fast,) = job
+    if fast:
+        import fragmentation_cy as Fragmentation
+    else:
+        import fragmentation_py as Fragmentation
+    fragment_engine = Fragmentation.FragmentEngine(molblock, max_broken_bonds, max_water_losses, ionisation_mode, False, molcharge)
+    if not fragment_engine.accepted():
+        return None
+    fragment_engine.generate_fragments()
+    if not fragment_engine.cacheable():
+        return None
+    (fragments, masses, scores, bondbreaks,) = fragment_engine.get_fragment_arrays()
+    return (inchikey,
+     get_atom_block_digest(molblock),
+     molcharge,
+     fragment_engine.nwords,
+     fragment_engine.fragments_to_words(fragments),
+     masses,
+     scores,
+     bondbreaks)
+
+
+
+def build_fragment_library(dbfilename, libfilename, max_broken_bonds, max_water_losses, ionisation_mode, ncpus = 1, fast = False):
+    """Fragments all molecules of a structure database and writes them to a fragment library file"""
+    # with a process pool, jobs are read by the thread that feeds the pool
+    conn = sqlite3.connect(dbfilename, check_same_thread=False)
+    conn.text_factory = str
+
+    def jobs():
+        # columns as in the query engines: id, mim, charge, natoms, molblock, inchikey, molform, ...
+        for row in conn.execute('SELECT * FROM molecules'):
+            (molblock, inchikey, molform,) = (zlib.decompress(row[4]), row[5], row[6])
+            molcharge = 1 * (molform[-1] == '-' and ionisation_mode == -1 or molform[-1] == '+' and ionisation_mode == 1)
+            yield (inchikey, molblock, molcharge, max_broken_bonds, max_water_losses, ionisation_mode, fast)
+
+    if ncpus > 1:
+        pool = multiprocessing.Pool(ncpus)
+        results = pool.imap(fragment_library_molecule, jobs(), 16)
+    else:
+        pool = None
+        results = (fragment_library_molecule(job) for job in jobs())
+    # the per fragment arrays are streamed to temporary files, the index is kept in memory
+    data_names = ['words', 'masses', 'scores', 'bondbreaks']
+    data_dtypes = {'words': '<u8', 'masses': '<f8', 'scores': '<f8', 'bondbreaks': '|i1'}
+    data_files = dict([ (name, tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(libfilename)))) for name in data_names ])
+    data_sizes = dict([ (name, 0) for name in data_names ])
+    index = []
+    count = 0
+    for result in results:
+        count += 1
+        if count % 1000 == 0:
+            logging.info(str(count) + ' molecules fragmented')
+        if result == None:
+            continue
+        (inchikey, digest, molcharge, nwords, words, masses, scores, bondbreaks,) = result
+        index.append((inchikey, digest, molcharge, nwords, data_sizes['masses'], len(masses), data_sizes['words']))
+        for (name, data,) in zip(data_names, (words, masses, scores, bondbreaks)):
+            data = numpy.ascontiguousarray(data, dtype=data_dtypes[name]).ravel()
+            data_files[name].write(data.tostring())
+            data_sizes[name] += len(data)
+
+    if pool != None:
+        pool.close()
+        pool.join()
+    conn.close()
+    index.sort(key=itemgetter(0))
+    columns = zip(*index) or [[]] * 7
+    arrays = [('inchikeys', numpy.array(columns[0], dtype='S' + str(max([1] + map(len, columns[0]))))),
+     ('digests', numpy.array(columns[1], dtype='<u8')),
+     ('molcharges', numpy.array(columns[2], dtype='|i1')),
+     ('nwords', numpy.array(columns[3], dtype='<i4')),
+     ('fragment_offsets', numpy.array(columns[4], dtype='<i8')),
+     ('fragment_counts', numpy.array(columns[5], dtype='<i8')),
+     ('word_offsets', numpy.array(columns[6], dtype='<i8'))]
+    header = {'parameters': get_fragment_library_parameters(max_broken_bonds, max_water_losses, ionisation_mode),
+     'arrays': {}}
+    libfile = open(libfilename, 'wb')
+    for (name, array,) in arrays:
+        header['arrays'][name] = [array.dtype.str, list(array.shape), libfile.tell()]
+        libfile.write(array.tostring())
+        libfile.write('\0' * (-libfile.tell() % 8))
+
+    for name in data_names:
+        header['arrays'][name] = [data_dtypes[name], [data_sizes[name]], libfile.tell()]
+        data_files[name].seek(0)
+        shutil.copyfileobj(data_files[name], libfile)
+        data_files[name].close()
+        libfile.write('\0' * (-libfile.tell() % 8))
+
+    header_offset = libfile.tell()
+    libfile.write(json.dumps(header))
+    libfile.write(struct.pack('<Q8s', header_offset, FragmentLibrary.magic))
+    libfile.close()
+    print str(len(index)) + ' of ' + str(count) + ' molecules stored in fragment library ' + libfilename
+    return len(index)
+
+
+
+
+def merge_results(dbfilename, shard_dbfilenames):
+    """Merges the results of annotate jobs on shards of the candidate molecules into results database dbfilename.
+
+    The shards are copies of the same job database, each annotated with another annotate --shard. Per shard,
+    the fragments of candidates without fragments in dbfilename are copied in one statement, with fragid and
+    parentfragid shifted past the fragments already there, together with the nhits and skip_reason of these
+    candidates. The candidates of a shard are identified with those of dbfilename by their InChIKey (the
+    smiles column), as a candidate only found in a shard, e.g. from a structure database, can have the metid
+    of another candidate in dbfilename. These candidates are copied with a metid which is free in dbfilename.
+    Run parameters missing in dbfilename are taken from the shard. Returns the number of fragments added.
+    """
+    conn = sqlite3.connect(dbfilename)
+    c = conn.cursor()
+    nfragments = 0
+    for shard_dbfilename in shard_dbfilenames:
+        c.execute('ATTACH DATABASE ? AS shard', (shard_dbfilename,))
+        columns = {}
+        for table in ('metabolites', 'fragments', 'run'):
+            # only the columns in both databases, in case one of them was made by an older version
+            main_columns = [ row[1] for row in c.execute('PRAGMA main.table_info(' + table + ')') ]
+            shard_columns = set([ row[1] for row in c.execute('PRAGMA shard.table_info(' + table + ')') ])
+            columns[table] = [ column for column in main_columns if column in shard_columns ]
+
+        run_columns = [ column for column in columns['run'] if column != 'runid' and column != 'description' ]
+        main_run = c.execute('SELECT ' + ', '.join(run_columns) + ' FROM main.run').fetchone()
+        shard_run = c.execute('SELECT ' + ', '.join(run_columns) + ' FROM shard.run').fetchone()
+        if shard_run != None:
+            for (column, main_value, shard_value,) in zip(run_columns, main_run or [None] * len(run_columns), shard_run):
+                if main_value != None and shard_value != None and main_value != shard_value:
+                    logging.warn('Shard ' + shard_dbfilename + ' has another ' + column + ': ' + str(shard_value) + ' instead of ' + str(main_value))
+
+            if main_run == None:
+                c.execute('INSERT INTO main.run (' + ', '.join(run_columns) + ') SELECT ' + ', '.join(run_columns) + ' FROM shard.run LIMIT 1')
+            else:
+                c.execute('UPDATE main.run SET ' + ', '.join([ column + ' = COALESCE(' + column + ', (SELECT ' + column + ' FROM shard.run LIMIT 1))' for column in run_columns ]))
+        # the metid in dbfilename of each candidate of the shard, with the same metid if possible
+        main_metids = {}
+        for (metid, smiles,) in c.execute('SELECT metid, smiles FROM main.metabolites ORDER BY metid').fetchall():
+            main_metids.setdefault(smiles, []).append(metid)
+
+        used_metids = set([ metid for metids in main_metids.itervalues() for metid in metids ])
+        next_metid = max(used_metids or [0]) + 1
+        metid_map = []
+        for (metid, smiles,) in c.execute('SELECT metid, smiles FROM shard.metabolites ORDER BY metid').fetchall():
+            if smiles in main_metids:
+                if metid in main_metids[smiles]:
+                    metid_map.append((metid, metid, 0))
+                else:
+                    metid_map.append((metid, main_metids[smiles][0], 0))
+                continue
+            new_metid = metid
+            if metid in used_metids:
+                new_metid = next_metid
+                next_metid += 1
+                logging.warn('Metabolite ' + str(metid) + ' of shard ' + shard_dbfilename + ' added as ' + str(new_metid) + ', as its metid is used by another metabolite')
+            used_metids.add(new_metid)
+            main_metids[smiles] = [new_metid]
+            metid_map.append((metid, new_metid, 1))
+
+        c.execute('CREATE TEMP TABLE metid_map (shard_metid INTEGER PRIMARY KEY, metid INTEGER, new INTEGER)')
+        c.executemany('INSERT INTO temp.metid_map (shard_metid, metid, new) VALUES (?, ?, ?)', metid_map)
+        values = [ 'm.metid' if column == 'metid' else 's.' + column for column in columns['metabolites'] ]
+        c.execute('INSERT INTO main.metabolites (' + ', '.join(columns['metabolites']) + ') SELECT ' + ', '.join(values) + ' FROM shard.metabolites AS s JOIN temp.metid_map AS m ON m.shard_metid = s.metid WHERE m.new = 1')
+        annotated = 'SELECT DISTINCT metid FROM main.fragments'
+        # the candidates matched in the shard, or skipped there as they exceeded a limit
+        matched = 'SELECT m.metid FROM shard.fragments AS f JOIN temp.metid_map AS m ON m.shard_metid = f.metid'
+        results = ['nhits']
+        if 'skip_reason' in columns['metabolites']:
+            matched += ' UNION SELECT m.metid FROM shard.metabolites AS s JOIN temp.metid_map AS m ON m.shard_metid = s.metid WHERE s.skip_reason IS NOT NULL'
+            results.append('skip_reason')
+        c.execute('UPDATE main.metabolites SET ' + ', '.join([ column + ' = (SELECT s.' + column + ' FROM shard.metabolites AS s JOIN temp.metid_map AS m ON m.shard_metid = s.metid WHERE m.metid = metabolites.metid)' for column in results ]) + ' WHERE metid IN (' + matched + ') AND metid NOT IN (' + annotated + ')')
+        offset = c.execute('SELECT COALESCE(MAX(fragid), 0) FROM main.fragments').fetchone()[0]
+        values = []
+        for column in columns['fragments']:
+            if column == 'fragid':
+                values.append('f.fragid + ' + str(offset))
+            elif column == 'parentfragid':
+                values.append('CASE WHEN f.parentfragid = 0 THEN 0 ELSE f.parentfragid + ' + str(offset) + ' END')
+            elif column == 'metid':
+                values.append('m.metid')
+            else:
+                values.append('f.' + column)
+
+        c.execute('INSERT INTO main.fragments (' + ', '.join(columns['fragments']) + ') SELECT ' + ', '.join(values) + ' FROM shard.fragments AS f JOIN temp.metid_map AS m ON m.shard_metid = f.metid WHERE m.metid NOT IN (' + annotated + ') ORDER BY f.fragid')
+        logging.info(str(c.rowcount) + ' fragments added from ' + shard_dbfilename)
+        nfragments += c.rowcount
+        c.execute('DROP TABLE temp.metid_map')
+        conn.commit()
+        c.execute('DETACH DATABASE shard')
+
+    conn.close()
+    return nfragments
+
+
+
+def get_molblock_counts(molblock):
+    """Returns the numbers of atoms and bonds of a V2000 or V3000 molblock, from its counts line, or None if it has none"""
+    lines = str(molblock).splitlines()
+    try:
+        if len(lines) > 3 and lines[3].rstrip().endswith('V3000'):
+            for line in lines[4:]:
+                if line.startswith('M  V30 COUNTS'):
+                    counts = line.split()
+                    return (int(counts[3]), int(counts[4]))
+
+            return None
+        return (int(lines[3][0:3]), int(lines[3][3:6]))
+    except (IndexError, ValueError):
+        return None
+
+
+
+
+class DepthPolicy(object):
+    """Chooses the number of broken bonds for each candidate molecule, within a time budget for the whole run.
+
+    The fragmentation cost of a candidate is estimated from its numbers of bonds and rings, and
+    converted to seconds with the time per unit of cost measured on the candidates so far. Each
+    remaining candidate gets an equal share of the remaining budget, time left over by cheap
+    candidates goes to later ones, and a candidate gets the greatest depth that fits its share.
+    Candidates of which the cost can not be estimated get max_broken_bonds.
+    """
+
+    def __init__(self, max_broken_bonds, max_water_losses, time_budget, ncandidates, min_broken_bonds = 1):
+        self.max_broken_bonds = max_broken_bonds
+        self.max_water_losses = max_water_losses
+        self.min_broken_bonds = min(min_broken_bonds, max_broken_bonds)
+        self.time_budget = time_budget
+        self.ncandidates = ncandidates
+        # initial guess of the time per unit of cost, replaced by the measured time once available
+        self.seconds_per_cost = 5e-05
+        self.spent_time = 0.0
+        # the time and cost of the candidates with an estimated cost
+        self.measured_time = 0.0
+        self.spent_cost = 0
+
+
+
+    def estimate_cost(self, molblock, max_broken_bonds):
+        """Estimates the number of fragments of a molecule (given as molblock) for max_broken_bonds.
+
+        Breaking a ring bond only splits the molecule with a second break in the same ring, so
+        the estimate counts the combinations of at most max_broken_bonds bonds that are not
+        closing a ring, for each allowed water loss. Returns None if the molblock has no counts line.
+        """
+        counts = get_molblock_counts(molblock)
+        if counts == None:
+            return None
+        (natoms, nbonds,) = counts
+        nrings = max(0, nbonds - natoms + 1)
+        chain_bonds = nbonds - nrings
+        cost = 0
+        combinations = 1
+        for k in range(max_broken_bonds + 1):
+            cost += combinations
+            combinations = combinations * (chain_bonds - k) / (k + 1)
+
+        return cost * (1 + self.max_water_losses)
+
+
+
+    def choose_depth(self, molblock):
+        """Returns the number of broken bonds for the next candidate molecule"""
+        share = (self.time_budget - self.spent_time) / max(1, self.ncandidates)
+        if self.estimate_cost(molblock, self.max_broken_bonds) == None:
+            return self.max_broken_bonds
+        for max_broken_bonds in range(self.max_broken_bonds, self.min_broken_bonds, -1):
+            if self.estimate_cost(molblock, max_broken_bonds) * self.seconds_per_cost <= share:
+                return max_broken_bonds
+
+        return self.min_broken_bonds
+
+
+
+    def add_candidate(self, molblock, max_broken_bonds, seconds):
+        """Records the time it took to process a candidate molecule with max_broken_bonds"""
+        self.ncandidates -= 1
+        self.spent_time += seconds
+        cost = self.estimate_cost(molblock, max_broken_bonds)
+        if cost == None:
+            return 
+        self.measured_time += seconds
+        self.spent_cost += cost
+        if self.spent_cost > 0 and self.measured_time > 0:
+            self.seconds_per_cost = self.measured_time / self.spent_cost
+
+
+
+    def skip_candidate(self):
+        """Records a candidate molecule that was not fragmented"""
+        self.ncandidates -= 1
+
+
+
+
+class FragmentCache(object):
+    """Persistent cache of fragment tables, shared between jobs.
+
+    Fragment tables are stored in a sqlite database, keyed by InChIKey, atom numbering,
+    fragmentation parameters and scoring parameters. When the cache grows beyond
+    max_size (in MB) the least recently used tables are evicted. The database is
+    opened in WAL mode so several jobs can read from it while one of them writes.
+    The last use of a table is only updated when it is older than touch_interval
+    (in seconds), and skipped if the database stays locked for touch_timeout.
+    """
+    touch_interval = 3600
+    touch_timeout = 0.1
+
+    def __init__(self, dbfilename = '', max_size = None):
+        if dbfilename == '':
+            dbfilename = config.get('magma job', 'fragment_cache')
+        if max_size == None:
+            if config.has_option('magma job', 'fragment_cache.max_size'):
+                max_size = config.getfloat('magma job', 'fragment_cache.max_size')
+            else:
+                max_size = 1024
+        self.max_size = int(max_size * 1000000.0)
+        self.dbfilename = dbfilename
+        self.conn = sqlite3.connect(dbfilename, timeout=60)
+        self.conn.text_factory = str
+        self.c = self.conn.cursor()
+        self.c.execute('PRAGMA journal_mode=WAL')
+        self.c.execute('CREATE TABLE IF NOT EXISTS fragment_tables (key TEXT PRIMARY KEY, size INTEGER, last_used REAL, data BLOB)')
+        self.c.execute('CREATE INDEX IF NOT EXISTS fragment_tables_last_used ON fragment_tables (last_used)')
+        self.conn.commit()
+
+
+
+    def get_key(self, inchikey, molblock, max_broken_bonds, max_water_losses, ionisation_mode, skip_fragmentation, molcharge, symmetry = False, beam = 0):
+        # fragments are bitsets of atom indices, so the atom block is part of the key as well
+        atom_block = str(molblock).split('\n', 3)[-1]
+        parameters = repr((max_broken_bonds,
+         max_water_losses,
+         ionisation_mode,
+         bool(skip_fragmentation),
+         molcharge,
+         sorted(pars.typew.items()),
+         sorted(pars.heterow.items()),
+         pars.missingfragmentpenalty))
+        if symmetry:
+            parameters += ' symmetry'
+        if beam > 0:
+            parameters += ' beam ' + str(beam)
+        return str(inchikey) + ':' + hashlib.sha1(parameters + atom_block).hexdigest()
+
+
+
+    def get(self, key):
+        self.c.execute('SELECT last_used, data FROM fragment_tables WHERE key = ?', (key,))
+        result = self.c.fetchone()
+        if result == None:
+            return None
+        (last_used, data,) = result
+        if time.time() - last_used >= self.touch_interval:
+            self.touch(key)
+        return pickle.loads(zlib.decompress(data))
+
+
+
+    def touch(self, key):
+        # the last use is only needed for eviction, so readers don't wait for a job which is writing
+        self.c.execute('PRAGMA busy_timeout = ' + str(int(self.touch_timeout * 1000)))
+        try:
+            self.c.execute('UPDATE fragment_tables SET last_used = ? WHERE key = ?', (time.time(), key))
+            self.conn.commit()
+        except sqlite3.OperationalError:
+            self.conn.rollback()
+            logging.debug('Fragment cache busy, last use of ' + key + ' not updated')
+        finally:
+            self.c.execute('PRAGMA busy_timeout = 60000')
+
+
+
+    def put(self, key, fragment_table):
+        data = zlib.compress(pickle.dumps(fragment_table, 2))
+        try:
+            self.c.execute('INSERT OR REPLACE INTO fragment_tables (key, size, last_used, data) VALUES (?, ?, ?, ?)', (key, len(data), time.time(), sqlite3.Binary(data)))
+            self.evict()
+            self.conn.commit()
+        except sqlite3.OperationalError:
+            self.conn.rollback()
+            logging.warn('Fragment cache busy, fragments of ' + key + ' not stored')
+
+
+
+    def evict(self):
+        total_size = self.c.execute('SELECT SUM(size) FROM fragment_tables').fetchone()[0]
+        if total_size <= self.max_size:
+            return 
+        keys = []
+        for (key, size,) in self.c.execute('SELECT key, size FROM fragment_tables ORDER BY last_used').fetchall():
+            if total_size <= self.max_size:
+                break
+            keys.append((key,))
+            total_size -= size
+
+        self.c.executemany('DELETE FROM fragment_tables WHERE key = ?', keys)
+        logging.info(str(len(keys)) + ' fragment tables evicted from cache')
+
+
+
+
 class SelectEngine(object):
 
     def __init__(self, db_session):
@@ -1523,7 +2393,99 @@ class DataAnalysisEngine(object):
 
 
 
-def search_structure(mol, mim, molcharge, peaks, max_broken_bonds, max_water_losses, precision, mz_precision_abs, use_all_peaks, ionisation_mode, skip_fragmentation, fast, chem_engine, ions):
+def get_hit(fragment_engine, peak, fragment, score, bondbreaks, mass, ionmass, ion, precision, mz_precision_abs, ionisation_mode):
+    """Returns the hit of a fragment of fragment_engine with peak. The best matching child fragments of the
+    peaks in its child scan are added as its besthits, recursively, and their scores to its score."""
+    hit = types.HitType(peak, fragment, score, bondbreaks, mass, ionmass, ion)
+    if fragment > 0 and peak.childscan != None and len(peak.childscan.peaks) > 0:
+        total_score = 0.0
+        mzs_neutral = [childpeak.mz + ionisation_mode * pars.elmass for childpeak in peak.childscan.peaks]
+        child_fragment_sets = fragment_engine.find_fragments_batch(mzs_neutral, fragment, precision, mz_precision_abs)
+        for (childpeak, child_fragments,) in zip(peak.childscan.peaks, child_fragment_sets):
+            besthit = get_hit(fragment_engine, childpeak, 0, None, 0, 0, 0, '', precision, mz_precision_abs, ionisation_mode)
+            besthit_rel2parent = 0
+            child_rel2parent = fragment_engine.score_fragments_rel2parent([ child[0] for child in child_fragments ], fragment)
+            for ((childfrag, childscore, childbbreaks, childmass, childH,), childhit_rel2parent,) in zip(child_fragments, child_rel2parent):
+                childhit = get_hit(fragment_engine, childpeak, childfrag, childscore * childpeak.intensity ** 0.5, childbbreaks, childmass, childH * pars.Hmass, '[X' + '+' * (childH > 0) + '-' * (childH < 0) + str(abs(childH)) * (not -2 < childH < 2) + 'H' * (childH != 0) + ']' + '+' * (ionisation_mode > 0) + '-' * (ionisation_mode < 0), precision, mz_precision_abs, ionisation_mode)
+                if besthit.score == None or besthit.score > childhit.score or besthit.score == childhit.score and abs(besthit.deltaH) > abs(childhit.deltaH) or besthit_rel2parent > childhit_rel2parent:
+                    besthit = childhit
+                    besthit_rel2parent = childhit_rel2parent
+
+            if besthit.score == None:
+                total_score += childpeak.missing_fragment_score
+            else:
+                hit.besthits.append(besthit)
+                total_score += min(besthit.score, childpeak.missing_fragment_score)
+
+        hit.score = hit.score + total_score
+    return hit
+
+
+
+def add_fragment_data_to_hit(fragment_engine, hit, annotate_fragments = True):
+    """Adds the atoms of the fragments of hit and its child hits, and with annotate_fragments their formula and SMILES"""
+    if hit.fragment != 0:
+        if annotate_fragments:
+            (hit.atomstring, hit.atomlist, hit.formula, hit.inchikey,) = fragment_engine.get_fragment_info(hit.fragment, hit.deltaH)
+        else:
+            # formula and SMILES are added later by AnnotateEngine.annotate_fragments
+            (hit.atomstring, hit.atomlist,) = fragment_engine.get_fragment_atoms(hit.fragment)
+        if len(hit.besthits) > 0:
+            for childhit in hit.besthits:
+                if childhit != None:
+                    add_fragment_data_to_hit(fragment_engine, childhit, annotate_fragments)
+
+
+
+class MoleculeFragmentEngine(object):
+    """Stands in for the FragmentEngine of a molecule which is not fragmented, for get_hit, without parsing the molecule.
+
+    The only fragment is the molecule itself, of natoms atoms with mass mim, and with the ion masses of a fragment
+    without broken bonds (see FragmentEngine.get_ion_mass_offsets). Its formula and InChIKey are given.
+    """
+
+    def __init__(self, natoms, mim, molcharge, ionisation_mode, formula, inchikey):
+        self.molecule = (1 << natoms) - 1
+        self.mim = mim
+        self.formula = formula
+        self.inchikey = inchikey
+        self.ions = []
+        for deltaH in sorted([0, -ionisation_mode]):
+            ion_deltaH = deltaH + ionisation_mode * (1 - molcharge)
+            offset = 0.0 if deltaH == -ionisation_mode else ion_deltaH * pars.Hmass
+            self.ions.append((mim + offset, ion_deltaH))
+
+
+
+    def find_fragments_batch(self, masses, parent, precision, mz_precision_abs):
+        fragment_sets = []
+        for mass in masses:
+            low = min(mass / precision, mass - mz_precision_abs)
+            high = max(mass * precision, mass + mz_precision_abs)
+            fragment_sets.append([ [self.molecule, 0, 0, self.mim, deltaH] for (ion_mass, deltaH,) in self.ions if low < ion_mass < high ])
+
+        return fragment_sets
+
+
+
+    def score_fragments_rel2parent(self, fragments, parent):
+        return [0] * len(fragments)
+
+
+
+    def get_fragment_atoms(self, fragment):
+        atomlist = list(range(fragment.bit_length()))
+        return (''.join([ ',' + str(atom) for atom in atomlist ]), atomlist)
+
+
+
+    def get_fragment_info(self, fragment, deltaH):
+        return self.get_fragment_atoms(fragment) + (self.formula, self.inchikey)
+
+
+
+
+def search_structure(mol, mim, molcharge, peaks, max_broken_bonds, max_water_losses, precision, mz_precision_abs, use_all_peaks, ionisation_mode, skip_fragmentation, fast, chem_engine, ions, fragment_cache = None, inchikey = None, fragment_library = None, annotate_fragments = True, prune_fragments = False, fragment_ncpus = 1, symmetry = False, parent_engine = None):
     if fast:
         import fragmentation_cy as Fragmentation
     else:
@@ -1542,42 +2504,24 @@ def search_structure(mol, mim, molcharge, peaks, max_broken_bonds, max_water_los
 
 
 
-    def gethit(peak, fragment, score, bondbreaks, mass, ionmass, ion):
-        try:
-            hit = types.HitType(peak, fragment, score, bondbreaks, mass, ionmass, ion)
-        except:
-            hit = magma.types.HitType(peak, fragment, score, bondbreaks, mass, ionmass, ion)
-        if fragment > 0 and peak.childscan != None and len(peak.childscan.peaks) > 0:
-            n_child_peaks = len(peak.childscan.peaks)
-            total_score = 0.0
-            total_count = 0.0
-            for childpeak in peak.childscan.peaks:
-                besthit = gethit(childpeak, 0, None, 0, 0, 0, '')
-                mz_neutral = childpeak.mz + ionisation_mode * pars.elmass
-                for (childfrag, childscore, childbbreaks, childmass, childH,) in fragment_engine.find_fragments(mz_neutral, fragment, precision, mz_precision_abs):
-                    if childfrag & fragment == childfrag:
-                        childhit = gethit(childpeak, childfrag, childscore * childpeak.intensity ** 0.5, childbbreaks, childmass, childH * pars.Hmass, '[X' + '+' * (childH > 0) + '-' * (childH < 0) + str(abs(childH)) * (not -2 < childH < 2) + 'H' * (childH != 0) + ']' + '+' * (ionisation_mode > 0) + '-' * (ionisation_mode < 0))
-                        if besthit.score == None or besthit.score > childhit.score or besthit.score == childhit.score and abs(besthit.deltaH) > abs(childhit.deltaH) or fragment_engine.score_fragment_rel2parent(besthit.fragment, fragment) > fragment_engine.score_fragment_rel2parent(childhit.fragment, fragment):
-                            besthit = childhit
-
-                if besthit.score == None:
-                    total_score += childpeak.missing_fragment_score
-                else:
-                    hit.besthits.append(besthit)
-                    total_score += min(besthit.score, childpeak.missing_fragment_score)
+    def get_peak_masses(peaks):
+        masses = []
+        for peak in peaks:
+            if peak.childscan != None:
+                masses.extend([ childpeak.mz + ionisation_mode * pars.elmass for childpeak in peak.childscan.peaks ])
+                masses.extend(get_peak_masses(peak.childscan.peaks))
 
-            hit.score = hit.score + total_score
-        return hit
+        return masses
 
 
 
-    def add_fragment_data_to_hit(hit):
-        if hit.fragment != 0:
-            (hit.atomstring, hit.atomlist, hit.formula, hit.inchikey,) = fragment_engine.get_fragment_info(hit.fragment, hit.deltaH)
-            if len(hit.besthits) > 0:
-                for childhit in hit.besthits:
-                    if childhit != None:
-                        add_fragment_data_to_hit(childhit)
+    def get_hit_fragments(hit):
+        fragments = [hit.fragment]
+        for childhit in hit.besthits:
+            if childhit != None:
+                fragments.extend(get_hit_fragments(childhit))
+
+        return fragments
 
 
 
@@ -1589,13 +2533,187 @@ def search_structure(mol, mim, molcharge, peaks, max_broken_bonds, max_water_los
             i = massmatch(peak, mim, molcharge)
             if i != False:
                 if not Fragmented:
-                    fragment_engine = Fragmentation.FragmentEngine(mol, max_broken_bonds, max_water_losses, ionisation_mode, skip_fragmentation, molcharge)
+                    fragment_engine = Fragmentation.FragmentEngine(mol, max_broken_bonds, max_water_losses, ionisation_mode, skip_fragmentation, molcharge, symmetry)
                     if fragment_engine.accepted():
-                        frags = fragment_engine.generate_fragments()
+                        fragment_table = None
+                        fragment_arrays = None
+                        # library tables contain all symmetric fragments, so they are not used when these are merged,
+                        # nor at another depth than they were built with, as chosen with a depth_budget
+                        if fragment_library != None and not skip_fragmentation and not symmetry and fragment_library.compatible(max_broken_bonds, max_water_losses, ionisation_mode):
+                            fragment_arrays = fragment_library.get_fragments(inchikey, mol, molcharge)
+                        if fragment_cache != None and fragment_arrays == None:
+                            cache_key = fragment_cache.get_key(inchikey, mol, max_broken_bonds, max_water_losses, ionisation_mode, skip_fragmentation, molcharge, symmetry, fragment_engine.get_beam_width())
+                            fragment_table = fragment_cache.get(cache_key)
+                        if fragment_arrays != None:
+                            frags = fragment_engine.set_fragment_arrays(*fragment_arrays)
+                        elif fragment_table != None:
+                            frags = fragment_engine.set_fragment_table(fragment_table)
+                        elif prune_fragments:
+                            # pruned tables are incomplete, so they are not cached
+                            frags = fragment_engine.generate_fragments(get_peak_masses(peaks), precision, mz_precision_abs, ncpus=fragment_ncpus)
+                        else:
+                            frags = None
+                            if parent_engine != None:
+                                frags = fragment_engine.generate_fragments_from_parent(parent_engine, ncpus=fragment_ncpus)
+                            if frags == None:
+                                frags = fragment_engine.generate_fragments(ncpus=fragment_ncpus)
+                            # as are tables truncated at the memory limit or from a parent, beam search tables are keyed by their width
+                            if fragment_cache != None and fragment_engine.cacheable():
+                                fragment_cache.put(cache_key, fragment_engine.get_fragment_table())
                     Fragmented = True
                 if fragment_engine.accepted():
-                    hit = gethit(peak, (1 << fragment_engine.get_natoms()) - 1, 0, 0, mim, i[0], i[1])
-                    add_fragment_data_to_hit(hit)
+                    hit = get_hit(fragment_engine, peak, (1 << fragment_engine.get_natoms()) - 1, 0, 0, mim, i[0], i[1], precision, mz_precision_abs, ionisation_mode)
+                    if annotate_fragments:
+                        fragment_engine.get_fragments_info(get_hit_fragments(hit))
+                    add_fragment_data_to_hit(fragment_engine, hit, annotate_fragments)
                     hits.append(hit)
 
     return (hits, frags)
+
+
+
+def supervised_search_structure(conn, memory_limit, args, kwargs):
+    """Runs search_structure in a worker process started by search_structure_supervised.
+
+    Sends the result over conn, or the reason the search failed. The worker starts a process
+    group of its own, so any fragmentation pool it starts is killed along with it.
+    """
+    os.setpgrp()
+    if memory_limit != None:
+        # the limit applies to the memory allocated on top of what the worker inherited
+        try:
+            inherited = int(open('/proc/self/statm').read().split()[0]) * resource.getpagesize()
+        except IOError:
+            inherited = 0
+        limit = inherited + int(memory_limit * 1048576)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    if kwargs.get('fragment_cache') != None:
+        # sqlite connections can not be used across a fork
+        fragment_cache = kwargs['fragment_cache']
+        kwargs['fragment_cache'] = FragmentCache(fragment_cache.dbfilename, fragment_cache.max_size / 1000000.0)
+    try:
+        result = search_structure(*args, **kwargs)
+    except MemoryError:
+        result = 'memory limit of ' + str(memory_limit) + ' MB exceeded'
+    conn.send(result)
+    conn.close()
+
+
+
+def search_structure_supervised(args, kwargs, time_limit = None, memory_limit = None):
+    """Runs search_structure(*args, **kwargs) in a worker process with a wall clock time limit (s) and a memory limit (MB).
+
+    Returns the result of search_structure, or a string with the reason the worker was stopped.
+    """
+    (receiver, sender,) = multiprocessing.Pipe(False)
+    worker = multiprocessing.Process(target=supervised_search_structure, args=(sender,
+     memory_limit,
+     args,
+     kwargs))
+    worker.start()
+    sender.close()
+    result = None
+    try:
+        if receiver.poll(time_limit):
+            result = receiver.recv()
+        else:
+            result = 'time limit of ' + str(time_limit) + ' s exceeded'
+    except EOFError:
+        result = None
+    finally:
+        receiver.close()
+        if result == None or isinstance(result, str):
+            try:
+                os.killpg(worker.pid, signal.SIGKILL)
+            except OSError:
+                # the worker has not started its process group yet, or has stopped already
+                worker.terminate()
+        worker.join()
+
+    if result == None:
+        result = 'worker process stopped with exit code ' + str(worker.exitcode)
+    return result
+
+
+
+def get_parent_engine(parent_engines, metid, mol, molcharge, max_broken_bonds, max_water_losses, ionisation_mode, fast):
+    """Returns a FragmentEngine with the generated fragments of metabolite metid, to generate the fragments
+    of its reaction products from, see FragmentEngine.generate_fragments_from_parent.
+
+    The engines are kept in the ordered dict parent_engines, dropping the oldest beyond max_parent_engines,
+    so each parent is only fragmented once as long as its products are close together in the search.
+    """
+    key = (metid, max_broken_bonds, fast)
+    if key not in parent_engines:
+        if fast:
+            import fragmentation_cy as Fragmentation
+        else:
+            import fragmentation_py as Fragmentation
+        if len(parent_engines) >= max_parent_engines:
+            parent_engines.popitem(last=False)
+        parent_engine = Fragmentation.FragmentEngine(mol, max_broken_bonds, max_water_losses, ionisation_mode, False, molcharge)
+        if parent_engine.accepted():
+            parent_engine.generate_fragments()
+        parent_engines[key] = parent_engine
+    return parent_engines[key]
+
+
+
+# fragment cache, fragment library and parent engines of a worker process of search_structures
+search_worker = {}
+
+def init_search_worker(fragment_cache, fragment_library):
+    """Opens the fragment cache and library in a worker process of search_structures, as sqlite
+    connections can not be used across a fork. fragment_cache is (dbfilename, max_size) or None."""
+    search_worker['fragment_cache'] = None
+    if fragment_cache != None:
+        search_worker['fragment_cache'] = FragmentCache(*fragment_cache)
+    search_worker['fragment_library'] = None
+    if fragment_library != None:
+        search_worker['fragment_library'] = FragmentLibrary(fragment_library)
+    search_worker['parent_engines'] = collections.OrderedDict()
+
+
+
+def run_search_jobs(jobs, pool = None, window = 0):
+    """Runs search_structure_job for the (key, job_args) pairs of the iterable jobs, in pool if given, with
+    at most window jobs submitted ahead of the one whose result is returned. Yields (key, result, seconds)
+    in the order of jobs. A job is taken from jobs when it is submitted, so it can depend on the results
+    yielded before.
+    """
+    submitted = collections.deque()
+    for (key, job_args,) in jobs:
+        if pool == None:
+            yield (key,) + search_structure_job(*job_args)
+            continue
+        submitted.append((key, pool.apply_async(search_structure_job, job_args)))
+        if len(submitted) > window:
+            (key, job,) = submitted.popleft()
+            yield (key,) + job.get()
+
+    while len(submitted) > 0:
+        (key, job,) = submitted.popleft()
+        yield (key,) + job.get()
+
+
+
+def search_structure_job(args, kwargs, time_limit = None, memory_limit = None, parent = None, parent_engines = None):
+    """Matches a candidate molecule for search_structures, in its own process or in a worker.
+
+    Runs search_structure(*args, **kwargs), supervised when a limit is given (see search_structure_supervised),
+    and returns its result with the time it took. In a worker process (see init_search_worker) the fragment
+    cache and library of the worker are used. The parent engine is made from parent, the arguments of
+    get_parent_engine, and kept in parent_engines, or in those of the worker process. The time it takes
+    counts for the job.
+    """
+    start_time = time.time()
+    if len(search_worker) > 0:
+        kwargs = dict(kwargs, fragment_cache=search_worker['fragment_cache'], fragment_library=search_worker['fragment_library'])
+        parent_engines = search_worker['parent_engines']
+    if parent != None:
+        kwargs = dict(kwargs, parent_engine=get_parent_engine(parent_engines, *parent))
+    if time_limit != None or memory_limit != None:
+        result = search_structure_supervised(args, kwargs, time_limit, memory_limit)
+    else:
+        result = search_structure(*args, **kwargs)
+    return (result, time.time() - start_time)
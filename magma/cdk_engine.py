@@ -1,5 +1,6 @@
 # 2014.10.20 12:27:28 CEST
 import jpype
+import numpy
 import glob
 import os
 jars = ('/home/ridderl/cdk/cdk-1.4.13.jar',)
@@ -96,12 +97,66 @@ class engine(object):
 
 
 
+    def FragmentsToSmiles(self, mol, atomlists):
+        return [ self.FragmentToSmiles(mol, atomlist) for atomlist in atomlists ]
+
+
+
     def FragmentToInchiKey(self, mol, atomlist):
         ac = self.acm.extractSubstructure(mol, atomlist)
         return self.MolToInchiKey(ac)
 
 
 
+    def FragmentsToInchiKey(self, mol, atomlists):
+        return [ self.FragmentToInchiKey(mol, atomlist) for atomlist in atomlists ]
+
+
+
+    def GetMolArrays(self, mol):
+        """Returns the atoms and bonds of mol at once, as numpy arrays (see rdkit_engine.GetMolArrays)"""
+        masses = []
+        symbols = []
+        hs = []
+        degrees = []
+        for atom in mol.atoms().iterator():
+            symbol = atom.getSymbol()
+            hc = atom.getImplicitHydrogenCount().intValue()
+            masses.append(self.isof.getMajorIsotope(symbol).getExactMass().floatValue() + self.Hmass * hc)
+            symbols.append(symbol)
+            hs.append(hc)
+            degrees.append(atom.getFormalNeighbourCount().intValue() - hc)
+
+        bond_atoms = []
+        bond_types = []
+        for bond in mol.bonds().iterator():
+            bond_atoms.append([ mol.getAtomNumber(a) for a in bond.atoms().iterator() ])
+            if bond.getFlag(4) == 1:
+                bond_types.append('AROMATIC')
+            else:
+                bond_types.append(bond.getOrder().toString())
+
+        return (numpy.array(masses, dtype=numpy.float64),
+         numpy.array(symbols, dtype=str),
+         numpy.array(hs, dtype=numpy.int64),
+         numpy.array(degrees, dtype=numpy.int64),
+         numpy.array(bond_atoms, dtype=numpy.int64).reshape(-1, 2),
+         numpy.array(bond_types, dtype=str))
+
+
+
+    def GetAutomorphisms(self, mol, max_automorphisms = 1000):
+        # no automorphism search with CDK, so no symmetric fragments are merged
+        return [tuple(range(mol.getAtomCount()))]
+
+
+
+    def GetSubstructMatch(self, mol, query):
+        # no substructure matching with CDK, so fragment tables of metabolic parents are not reused
+        return ()
+
+
+
     def LogP(self, mol):
         ha = self.cdk.tools.CDKHydrogenAdder.getInstance(self.builder)
         newmol = mol.clone()
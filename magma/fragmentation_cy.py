@@ -1,17 +1,49 @@
 # 2014.10.20 12:27:50 CEST
+"""
+FragmentEngine with compiled kernels for fragment enumeration, scoring and masses.
 
-def __bootstrap__():
-    global __file__
-    global __bootstrap__
-    global __loader__
-    import sys
-    import pkg_resources
-    import imp
-    __file__ = pkg_resources.resource_filename(__name__, 'fragmentation_cy.so')
-    __loader__ = None
-    del __bootstrap__
-    del __loader__
-    imp.load_dynamic(__name__, __file__)
-
-
-__bootstrap__()
+The kernels are implemented in fragmentation_kernels.pyx on multi-word bitsets,
+so molecules of any size are supported. When no prebuilt extension is available,
+the kernels are compiled from source with pyximport on first import.
+"""
+try:
+    import fragmentation_kernels
+except ImportError:
+    import pyximport
+    pyximport.install()
+    import fragmentation_kernels
+import fragmentation_py
+from fragmentation_py import Chem
+
+class FragmentEngine(fragmentation_py.FragmentEngine):
+
+    def __init__(self, mol, max_broken_bonds, max_water_losses, ionisation_mode, skip_fragmentation, molcharge, symmetry = False):
+        fragmentation_py.FragmentEngine.__init__(self, mol, max_broken_bonds, max_water_losses, ionisation_mode, skip_fragmentation, molcharge, symmetry)
+        if self.accept:
+            self.graph = fragmentation_kernels.FragmentGraph(self.natoms, self.neighbour_masks, self.bond_atoms.tolist(), self.bond_weights.tolist(), self.atom_masses)
+
+
+
+    def get_child_fragments(self, fragment):
+        return self.graph.expand(fragment)
+
+
+
+    def score_fragments(self, fragments):
+        return self.graph.score(fragments)
+
+
+
+    def get_batch_bytes(self):
+        # the compiled kernels score without temporary arrays
+        return 3 * fragmentation_py.visited_batch_size * 8 * self.nwords
+
+
+
+    def score_fragment_rel2parent(self, fragment, parent):
+        return self.graph.score_rel2parent(fragment, parent)
+
+
+
+    def calc_fragment_mass(self, fragment):
+        return self.graph.mass(fragment)
@@ -0,0 +1,209 @@
+# cython: language_level=2, boundscheck=False, wraparound=False
+"""
+Compiled kernels for fragment enumeration and scoring.
+
+Fragments are bitsets of atoms. At the Python level they are (long) integers,
+as in fragmentation_py; inside the kernels they are stored as arrays of 64-bit
+words, so there is no limit on the number of atoms.
+"""
+from libc.stdlib cimport malloc, free
+from libc.string cimport memset, memcpy
+from libc.stdint cimport uint64_t
+
+cdef extern from *:
+    int __builtin_ctzll(unsigned long long x)
+
+WORDMASK = (1 << 64) - 1
+
+
+cdef class FragmentGraph:
+    """Immutable atom/bond graph of a molecule, with the kernels operating on it"""
+
+    cdef int natoms
+    cdef int nwords
+    cdef int nbonds
+    cdef uint64_t *neighbours
+    cdef int *bond_atoms
+    cdef double *bond_weights
+    cdef double *atom_masses
+    cdef object args
+
+    def __cinit__(self, int natoms, neighbour_masks, bond_atoms, bond_weights, atom_masses):
+        cdef int a, b
+        self.args = (natoms, list(neighbour_masks), [tuple(bond) for bond in bond_atoms], list(bond_weights), list(atom_masses))
+        self.natoms = natoms
+        self.nwords = (natoms + 63) // 64
+        self.nbonds = len(bond_atoms)
+        self.neighbours = <uint64_t *> malloc(max(natoms * self.nwords, 1) * sizeof(uint64_t))
+        self.bond_atoms = <int *> malloc(max(2 * self.nbonds, 1) * sizeof(int))
+        self.bond_weights = <double *> malloc(max(self.nbonds, 1) * sizeof(double))
+        self.atom_masses = <double *> malloc(max(natoms, 1) * sizeof(double))
+        if not (self.neighbours and self.bond_atoms and self.bond_weights and self.atom_masses):
+            raise MemoryError()
+        for a in range(natoms):
+            self.to_words(neighbour_masks[a], self.neighbours + a * self.nwords)
+            self.atom_masses[a] = atom_masses[a]
+        for b in range(self.nbonds):
+            self.bond_atoms[2 * b] = bond_atoms[b][0]
+            self.bond_atoms[2 * b + 1] = bond_atoms[b][1]
+            self.bond_weights[b] = bond_weights[b]
+
+    def __dealloc__(self):
+        free(self.neighbours)
+        free(self.bond_atoms)
+        free(self.bond_weights)
+        free(self.atom_masses)
+
+    def __reduce__(self):
+        return (FragmentGraph, self.args)
+
+    cdef void to_words(self, fragment, uint64_t *words):
+        cdef int w
+        for w in range(self.nwords):
+            words[w] = fragment >> 64 * w & WORDMASK
+
+    cdef object from_words(self, uint64_t *words):
+        cdef int w
+        fragment = 0
+        for w in range(self.nwords - 1, -1, -1):
+            fragment = fragment << 64 | words[w]
+        return fragment
+
+    cdef inline int has_atom(self, uint64_t *words, int atom):
+        return words[atom >> 6] >> (atom & 63) & 1
+
+    cdef void component(self, int atom, uint64_t *template, uint64_t *component, uint64_t *frontier):
+        """Fills component with the atoms in template connected to atom"""
+        cdef int w, nw = self.nwords, a
+        cdef uint64_t lowbit, new_atoms
+        cdef uint64_t *neighbours
+        memset(component, 0, nw * sizeof(uint64_t))
+        memset(frontier, 0, nw * sizeof(uint64_t))
+        component[atom >> 6] = <uint64_t> 1 << (atom & 63)
+        frontier[atom >> 6] = component[atom >> 6]
+        w = 0
+        while w < nw:
+            if frontier[w] == 0:
+                w += 1
+                continue
+            lowbit = frontier[w] & (~frontier[w] + 1)
+            frontier[w] ^= lowbit
+            a = 64 * w + __builtin_ctzll(lowbit)
+            neighbours = self.neighbours + a * nw
+            for a in range(nw):
+                new_atoms = neighbours[a] & template[a] & ~component[a]
+                component[a] |= new_atoms
+                frontier[a] |= new_atoms
+                if new_atoms and a < w:
+                    w = a
+
+    def expand(self, fragment):
+        """Returns the fragments which remain after removing each of the atoms of fragment"""
+        cdef int nw = self.nwords, w, v, u, atom, nbits
+        cdef uint64_t bits, lowbit
+        cdef uint64_t *buf = <uint64_t *> malloc(6 * nw * sizeof(uint64_t))
+        cdef uint64_t *words = buf
+        cdef uint64_t *template = buf + nw
+        cdef uint64_t *ext = buf + 2 * nw
+        cdef uint64_t *comp = buf + 3 * nw
+        cdef uint64_t *frontier = buf + 4 * nw
+        cdef uint64_t *neighbours
+        if not buf:
+            raise MemoryError()
+        child_fragments = []
+        try:
+            self.to_words(fragment, words)
+            for w in range(nw):
+                bits = words[w]
+                while bits:
+                    lowbit = bits & (~bits + 1)
+                    bits ^= lowbit
+                    atom = 64 * w + __builtin_ctzll(lowbit)
+                    memcpy(template, words, nw * sizeof(uint64_t))
+                    template[w] ^= lowbit
+                    neighbours = self.neighbours + atom * nw
+                    nbits = 0
+                    for v in range(nw):
+                        ext[v] = neighbours[v] & template[v]
+                        if ext[v]:
+                            nbits += 1 if ext[v] & (ext[v] - 1) == 0 else 2
+                    if nbits == 1:
+                        child_fragments.append(self.from_words(template))
+                    elif nbits > 1:
+                        for v in range(nw):
+                            while ext[v]:
+                                self.component(64 * v + __builtin_ctzll(ext[v]), template, comp, frontier)
+                                child_fragments.append(self.from_words(comp))
+                                for u in range(nw):
+                                    ext[u] &= ~comp[u]
+        finally:
+            free(buf)
+        return child_fragments
+
+    def score(self, fragments):
+        """Counts and scores the broken bonds of a batch of fragments"""
+        cdef int nw = self.nwords, b, a1, a2, bondbreaks
+        cdef double score
+        cdef uint64_t *words = <uint64_t *> malloc(nw * sizeof(uint64_t))
+        if not words:
+            raise MemoryError()
+        all_bondbreaks = []
+        all_scores = []
+        try:
+            for fragment in fragments:
+                self.to_words(fragment, words)
+                bondbreaks = 0
+                score = 0.0
+                for b in range(self.nbonds):
+                    a1 = self.bond_atoms[2 * b]
+                    a2 = self.bond_atoms[2 * b + 1]
+                    if self.has_atom(words, a1) != self.has_atom(words, a2):
+                        bondbreaks += 1
+                        score += self.bond_weights[b]
+                all_bondbreaks.append(bondbreaks)
+                all_scores.append(score)
+        finally:
+            free(words)
+        return (all_bondbreaks, all_scores)
+
+    def score_rel2parent(self, fragment, parent):
+        """Sums the weights of the bonds of parent which are broken in fragment"""
+        cdef int nw = self.nwords, b, lo, hi, in_fragment, in_parent
+        cdef double score = 0.0
+        cdef uint64_t *words = <uint64_t *> malloc(2 * nw * sizeof(uint64_t))
+        if not words:
+            raise MemoryError()
+        try:
+            self.to_words(fragment, words)
+            self.to_words(parent, words + nw)
+            for b in range(self.nbonds):
+                lo = min(self.bond_atoms[2 * b], self.bond_atoms[2 * b + 1])
+                hi = max(self.bond_atoms[2 * b], self.bond_atoms[2 * b + 1])
+                # integer comparison 0 < fragment & bond < bond & parent, on the two bond bits
+                in_fragment = 2 * self.has_atom(words, hi) + self.has_atom(words, lo)
+                in_parent = 2 * self.has_atom(words + nw, hi) + self.has_atom(words + nw, lo)
+                if 0 < in_fragment < in_parent:
+                    score += self.bond_weights[b]
+        finally:
+            free(words)
+        return score
+
+    def mass(self, fragment):
+        """Sums the masses of the atoms in fragment, in order of atom index"""
+        cdef int nw = self.nwords, w
+        cdef uint64_t bits, lowbit
+        cdef double fragment_mass = 0.0
+        cdef uint64_t *words = <uint64_t *> malloc(nw * sizeof(uint64_t))
+        if not words:
+            raise MemoryError()
+        try:
+            self.to_words(fragment, words)
+            for w in range(nw):
+                bits = words[w]
+                while bits:
+                    lowbit = bits & (~bits + 1)
+                    bits ^= lowbit
+                    fragment_mass += self.atom_masses[64 * w + __builtin_ctzll(lowbit)]
+        finally:
+            free(words)
+        return fragment_mass
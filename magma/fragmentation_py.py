@@ -3,6 +3,8 @@ import numpy
 import pars
 import ConfigParser
 import os
+import logging
+import multiprocessing
 config = ConfigParser.ConfigParser()
 config.read(['magma_job.ini', os.path.expanduser('~/magma_job.ini')])
 if config.get('magma job', 'chemical_engine') == 'rdkit':
@@ -11,9 +13,235 @@ elif config.get('magma job', 'chemical_engine') == 'cdk':
     import cdk_engine
     Chem = cdk_engine.engine()
 
+WORDMASK = (1 << 64) - 1
+# breadth steps with fewer fragments than this are not split over worker processes
+min_parallel_fragments = 1000
+# symmetric fragments are merged using at most this number of automorphisms of a molecule
+max_automorphisms = 64
+# children are checked against the visited fragments in batches of about this size
+visited_batch_size = 65536
+# fragments are scored in batches with temporary arrays of at most this number of MB
+score_batch_memory = 16
+# rough number of bytes used per fragment in the fragment table
+fragment_entry_bytes = 200
+# enumeration stops at the current breadth step when the estimated memory use exceeds this number of MB
+max_memory = None
+if config.has_option('magma job', 'fragmentation.max_memory'):
+    max_memory = config.getfloat('magma job', 'fragmentation.max_memory')
+# if set, molecules with more atoms or bonds than this are fragmented with a beam search,
+# which expands only the beam_width best scoring fragments per number of broken bonds
+beam_max_atoms = None
+beam_max_bonds = None
+beam_width = 1000
+if config.has_option('magma job', 'fragmentation.beam_max_atoms'):
+    beam_max_atoms = config.getint('magma job', 'fragmentation.beam_max_atoms')
+if config.has_option('magma job', 'fragmentation.beam_max_bonds'):
+    beam_max_bonds = config.getint('magma job', 'fragmentation.beam_max_bonds')
+if config.has_option('magma job', 'fragmentation.beam_width'):
+    beam_width = config.getint('magma job', 'fragmentation.beam_width')
+
+def iter_bits(bits):
+    """Yields the indices of the set bits of a bitset, lowest first"""
+    while bits:
+        lowbit = bits & -bits
+        yield lowbit.bit_length() - 1
+        bits ^= lowbit
+
+
+
+def connected_component(atom, template, neighbour_masks):
+    """Returns the bitset of the atoms in template that are connected to atom"""
+    component = 1 << atom
+    frontier = component
+    while frontier:
+        lowbit = frontier & -frontier
+        frontier ^= lowbit
+        new_atoms = neighbour_masks[lowbit.bit_length() - 1] & template & ~component
+        component |= new_atoms
+        frontier |= new_atoms
+
+    return component
+
+
+
+def expand_fragment(fragment, neighbour_masks):
+    """Returns the fragments which remain after removing each of the atoms of fragment.
+
+    Only reads its arguments, so it is safe to call from worker threads or processes.
+    """
+    child_fragments = []
+    for atom in iter_bits(fragment):
+        template = fragment ^ 1 << atom
+        ext_atoms = neighbour_masks[atom] & template
+        if ext_atoms & ext_atoms - 1 == 0:
+            if ext_atoms:
+                child_fragments.append(template)
+        else:
+            while ext_atoms:
+                lowbit = ext_atoms & -ext_atoms
+                component = connected_component(lowbit.bit_length() - 1, template, neighbour_masks)
+                child_fragments.append(component)
+                ext_atoms &= ~component
+
+
+    return child_fragments
+
+
+
+expansion_engine = None
+
+def init_expansion_worker(engine):
+    """Pool initializer, keeps the engine of which the fragments are expanded in the worker process"""
+    global expansion_engine
+    expansion_engine = engine
+
+
+
+def expand_fragments_job(fragments):
+    """Expands a chunk of (fragment, mass) pairs in a worker process.
+
+    Returns the child fragments that pass the bond break and score limits, as
+    (fragment, mass, score, bondbreaks), in the order in which the serial
+    breadth step would encounter them.
+    """
+    engine = expansion_engine
+    children = []
+    for (fragment, fragmass,) in fragments:
+        child_fragments = engine.get_child_fragments(fragment)
+        (bondbreaks, scores,) = engine.score_fragments(child_fragments)
+        for i in range(len(child_fragments)):
+            if bondbreaks[i] <= engine.max_broken_bonds and scores[i] < pars.missingfragmentpenalty + 5:
+                children.append((child_fragments[i], fragmass - engine.calc_fragment_mass(fragment ^ child_fragments[i]), scores[i], bondbreaks[i]))
+
+
+    return children
+
+
+
+def map_fragment(fragment, byte_tables):
+    """Maps the atoms of fragment with an atom permutation given as lookup tables per byte of the bitset"""
+    image = 0
+    for table in byte_tables:
+        if not fragment:
+            break
+        image |= table[fragment & 255]
+        fragment >>= 8
+
+    return image
+
+
+
+class GrowableArray(object):
+    """One-dimensional numpy array which can be appended to, doubling its capacity when full"""
+
+    def __init__(self, dtype, capacity = 1024):
+        self.data = numpy.empty(capacity, dtype=dtype)
+        self.size = 0
+
+
+
+    def reserve(self, size):
+        if size > len(self.data):
+            data = numpy.empty(max(size, 2 * len(self.data)), dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+
+
+
+    def append(self, value):
+        self.reserve(self.size + 1)
+        self.data[self.size] = value
+        self.size += 1
+
+
+
+    def extend(self, values):
+        self.reserve(self.size + len(values))
+        self.data[self.size:self.size + len(values)] = values
+        self.size += len(values)
+
+
+
+    def array(self):
+        return self.data[:self.size]
+
+
+
+    def __len__(self):
+        return self.size
+
+
+
+class FragmentSet(object):
+    """Set of fragments, stored as sorted arrays of rows of 64 bit words.
+
+    Takes 8 bytes per word per fragment, a fraction of a Python set of long integers.
+    Fragments are added in batches, see add_new. The new fragments of each batch are
+    appended as a sorted run, a run is merged with the one before it until that one is more
+    than twice as large, so each fragment is copied a logarithmic number of times. See merge.
+    """
+
+    def __init__(self, nwords):
+        self.dtype = numpy.dtype((numpy.void, 8 * nwords))
+        self.runs = []
+
+
+
+    def add_new(self, words):
+        """Adds a batch of fragments, given as rows of words.
+
+        Returns a boolean array which is True for the first occurrence in the batch
+        of each fragment that was not in the set before.
+        """
+        keys = numpy.ascontiguousarray(words, dtype=numpy.uint64).view(self.dtype).ravel()
+        new = numpy.zeros(len(keys), dtype=bool)
+        if len(keys) == 0:
+            return new
+        (unique_keys, first,) = numpy.unique(keys, return_index=True)
+        unseen = numpy.ones(len(unique_keys), dtype=bool)
+        for run in self.runs:
+            positions = numpy.searchsorted(run, unique_keys)
+            unseen &= run[numpy.minimum(positions, len(run) - 1)] != unique_keys
+
+        new[first[unseen]] = True
+        if unseen.any():
+            self.runs.append(unique_keys[unseen])
+            while len(self.runs) > 1 and len(self.runs[-2]) <= 2 * len(self.runs[-1]):
+                self.merge_runs(2)
+
+        return new
+
+
+
+    def merge(self):
+        """Merges all runs into one, as done after each breadth step"""
+        if len(self.runs) > 1:
+            self.merge_runs(len(self.runs))
+
+
+
+    def merge_runs(self, nruns):
+        keys = numpy.concatenate(self.runs[-nruns:])
+        keys.sort()
+        self.runs[-nruns:] = [keys]
+
+
+
+    def nbytes(self):
+        """Returns the size of the runs, doubled for the copy made when merging them"""
+        return 2 * sum([ run.nbytes for run in self.runs ])
+
+
+
+    def __len__(self):
+        return sum([ len(run) for run in self.runs ])
+
+
+
+
 class FragmentEngine(object):
 
-    def __init__(self, mol, max_broken_bonds, max_water_losses, ionisation_mode, skip_fragmentation, molcharge):
+    def __init__(self, mol, max_broken_bonds, max_water_losses, ionisation_mode, skip_fragmentation, molcharge, symmetry = False):
         try:
             self.mol = Chem.MolFromMolBlock(str(mol))
             self.accept = True
@@ -26,106 +254,243 @@ class FragmentEngine(object):
         self.ionisation_mode = ionisation_mode
         self.skip_fragmentation = skip_fragmentation
         self.molcharge = molcharge
-        self.atom_masses = []
-        self.neutral_loss_atoms = []
-        self.bonded_atoms = []
         self.bonds = set([])
         self.bondscore = {}
-        self.new_fragment = 0
-        self.template_fragment = 0
-        self.fragment_masses = ((max_broken_bonds + max_water_losses) * 2 + 1) * [0]
+        bond_weights = []
+        # fragment table: fragment_info and fragment_mass per fragment (the first entry is a dummy),
+        # fragment_masses with the ion masses of all fragments for the allowed hydrogen shifts
         self.fragment_info = [[0, 0, 0]]
+        self.fragment_mass = GrowableArray(numpy.float64)
+        self.fragment_mass.append(0.0)
+        self.fragment_masses = GrowableArray(numpy.float64)
+        self.fragment_mass_ids = GrowableArray(numpy.int32)
+        self.fragment_mass_deltaH = GrowableArray(numpy.int8)
+        self.ion_mass_offsets = {}
         self.avg_score = None
-        for x in range(self.natoms):
-            self.bonded_atoms.append([])
-            self.atom_masses.append(Chem.GetExtendedAtomMass(self.mol, x))
-            if Chem.GetAtomSymbol(self.mol, x) == 'O' and Chem.GetAtomHs(self.mol, x) == 1 and Chem.GetNBonds(self.mol, x) == 1:
-                self.neutral_loss_atoms.append(x)
-            if Chem.GetAtomSymbol(self.mol, x) == 'N' and Chem.GetAtomHs(self.mol, x) == 2 and Chem.GetNBonds(self.mol, x) == 1:
-                self.neutral_loss_atoms.append(x)
-
-        for x in range(Chem.nbonds(self.mol)):
-            (a1, a2,) = Chem.GetBondAtoms(self.mol, x)
-            self.bonded_atoms[a1].append(a2)
-            self.bonded_atoms[a2].append(a1)
+        self.pruned = False
+        self.truncated = False
+        self.beam_width = 0
+        self.required_atoms = None
+        self.breadth_fragments = None
+        self.reused_fragments = 0
+        # annotations of fragments, computed once per fragment
+        self.fragment_atoms_cache = {}
+        self.fragment_info_cache = {}
+        (atom_masses, atom_symbols, atom_hs, atom_degrees, bond_atoms, bond_types,) = Chem.GetMolArrays(self.mol)
+        self.atom_masses = atom_masses.tolist()
+        self.atom_symbols = atom_symbols.tolist()
+        self.atom_hs = atom_hs.tolist()
+        # hydroxyl and amine groups which can be lost as water or ammonia
+        neutral_losses = (atom_degrees == 1) & ((atom_symbols == 'O') & (atom_hs == 1) | (atom_symbols == 'N') & (atom_hs == 2))
+        self.neutral_loss_atoms = numpy.flatnonzero(neutral_losses).tolist()
+        hetero = (atom_symbols[bond_atoms[:, 0]] != 'C') | (atom_symbols[bond_atoms[:, 1]] != 'C')
+        self.neighbour_masks = [0] * self.natoms
+        for ((a1, a2,), bond_type, is_hetero,) in zip(bond_atoms.tolist(), bond_types.tolist(), hetero.tolist()):
+            self.neighbour_masks[a1] |= 1 << a2
+            self.neighbour_masks[a2] |= 1 << a1
             bond = 1 << a1 | 1 << a2
-            bondscore = pars.typew[Chem.GetBondType(self.mol, x)] * pars.heterow[(Chem.GetAtomSymbol(self.mol, a1) != 'C' or Chem.GetAtomSymbol(self.mol, a2) != 'C')]
+            bondscore = pars.typew[bond_type] * pars.heterow[is_hetero]
             self.bonds.add(bond)
             self.bondscore[bond] = bondscore
+            bond_weights.append(bondscore)
+
+        # bond incidence table: atom pairs, with the word and bit of each atom in the
+        # fixed-width word representation of a fragment, and the bond break weights
+        self.nwords = (self.natoms + 63) // 64
+        self.bond_atoms = numpy.array(bond_atoms, dtype=numpy.int64).reshape(-1, 2)
+        self.bond_words = self.bond_atoms >> 6
+        self.bond_bits = (self.bond_atoms & 63).astype(numpy.uint64)
+        self.bond_weights = numpy.array(bond_weights, dtype=numpy.float64)
+        # the same with the atoms of each bond ordered by index, for the parent relative scores
+        bond_atoms_sorted = numpy.sort(self.bond_atoms, axis=1)
+        self.sorted_bond_words = bond_atoms_sorted >> 6
+        self.sorted_bond_bits = (bond_atoms_sorted & 63).astype(numpy.uint64)
+        self.parent_bond_states = {}
+        self.automorphism_tables = None
+        self.symmetric_fragments_cache = {}
+        if symmetry:
+            self.set_automorphisms(Chem.GetAutomorphisms(self.mol, max_automorphisms))
+
+
+
+    def set_automorphisms(self, automorphisms):
+        """Enables merging of symmetric fragments, with the atom permutations which map the molecule onto itself.
+
+        Each permutation is stored as lookup tables per byte of a fragment bitset. Only permutations which
+        keep element and hydrogen count of all atoms are used, the identity is always included.
+        """
+        identity = tuple(range(self.natoms))
+        permutations = [identity]
+        for automorphism in automorphisms:
+            automorphism = tuple(automorphism)
+            if automorphism not in permutations and len(automorphism) == self.natoms and \
+                    all([ self.atom_symbols[a] == self.atom_symbols[b] and self.atom_hs[a] == self.atom_hs[b] for (a, b,) in enumerate(automorphism) ]):
+                permutations.append(automorphism)
+
+        if len(permutations) == 1:
+            self.automorphism_tables = None
+            return 
+        self.automorphism_tables = []
+        for permutation in permutations:
+            byte_tables = []
+            for offset in range(0, self.natoms, 8):
+                atoms = permutation[offset:offset + 8]
+                table = [0] * 256
+                for value in range(1, 256):
+                    lowbit = value & -value
+                    table[value] = table[value ^ lowbit] | (1 << atoms[lowbit.bit_length() - 1] if lowbit.bit_length() <= len(atoms) else 0)
+
+                byte_tables.append(table)
+
+            self.automorphism_tables.append(byte_tables)
+
+
+
+    def get_canonical_fragment(self, fragment):
+        """Returns the smallest bitset among the fragments symmetric to fragment, the same for all of them"""
+        return min([ map_fragment(fragment, byte_tables) for byte_tables in self.automorphism_tables ])
 
 
 
+    def get_symmetric_fragments(self, fragment, parent):
+        """Returns the fragments symmetric to fragment which are part of parent, the smallest one per class of
+        fragments which are also symmetric within parent (as for parent itself, it is mapped onto itself)."""
+        if (fragment, parent) in self.symmetric_fragments_cache:
+            return self.symmetric_fragments_cache[(fragment, parent)]
+        images = []
+        keys = set([])
+        stabilizer = [ byte_tables for byte_tables in self.automorphism_tables if map_fragment(parent, byte_tables) == parent ]
+        for byte_tables in self.automorphism_tables:
+            image = map_fragment(fragment, byte_tables)
+            if image & parent == image:
+                key = min([ map_fragment(image, tables) for tables in stabilizer ])
+                if key not in keys:
+                    keys.add(key)
+                    images.append(key)
 
-    def extend(self, atom):
-        for a in self.bonded_atoms[atom]:
-            atombit = 1 << a
-            if atombit & self.template_fragment and not atombit & self.new_fragment:
-                self.new_fragment = self.new_fragment | atombit
-                self.extend(a)
+        self.symmetric_fragments_cache[(fragment, parent)] = images
+        return images
 
 
 
+    def generate_fragments(self, peak_masses = None, precision = None, mz_precision_abs = None, ncpus = 1, beam = None, required_atoms = None, extra_fragments = None):
+        """Generates the fragment table, returns the number of fragments.
 
-    def generate_fragments(self):
+        If the (neutral) masses of the observed fragment peaks are given, with the relative
+        and absolute tolerances used to match them, fragments which are too light to match
+        any of these peaks are pruned: they are not stored and not expanded further, as all
+        their descendants are lighter still. The table is then only complete for these peaks.
+
+        With ncpus > 1, large breadth steps are expanded by a pool of worker processes.
+        The chunks are merged in order, so the table is identical to the serial one.
+
+        If fragmentation.max_memory (MB) is set in magma_job.ini, enumeration stops when its
+        estimated memory use exceeds it: the fragments found so far are kept, no neutral losses
+        are added and truncated is set.
+
+        With beam > 0, each breadth step only expands the beam best scoring new fragments
+        per number of broken bonds. By default (beam=None) this beam search is used, with
+        beam_width fragments, for molecules above beam_max_atoms atoms or beam_max_bonds bonds,
+        if these are set in magma_job.ini. Other molecules, or beam=0, are fragmented exhaustively.
+
+        With required_atoms (a bitset), the bond breaking steps only store and expand fragments
+        containing at least one of these atoms. Fragments given as extra_fragments (arrays as returned
+        by get_fragment_arrays) are added to the table after these steps, before the neutral losses.
+        See generate_fragments_from_parent.
+        """
+        self.beam_width = self.get_beam_width(beam)
+        self.required_atoms = required_atoms
+        min_fragment_mass = 0.0
+        self.pruned = peak_masses != None
+        if self.pruned:
+            if len(peak_masses) > 0:
+                min_peak_mass = min(peak_masses)
+                # largest ion mass offset: one hydrogen per broken bond, plus the ionisation
+                min_fragment_mass = min(min_peak_mass / precision, min_peak_mass - mz_precision_abs) - (self.max_broken_bonds + self.max_water_losses + 1) * pars.Hmass
+            else:
+                min_fragment_mass = float('inf')
         frag = (1 << self.natoms) - 1
-        all_fragments = set([frag])
-        total_fragments = set([frag])
-        current_fragments = set([frag])
-        new_fragments = set([frag])
-        self.add_fragment(frag, self.calc_fragment_mass(frag), 0, 0)
+        fragmass = self.calc_fragment_mass(frag)
+        self.truncated = False
+        all_fragments = self.new_visited_set()
+        total_fragments = self.new_visited_set()
+        self.select_new_fragments([frag], all_fragments)
+        self.select_new_fragments([frag], total_fragments)
+        # the fragments to expand in a breadth step, by fragment id
+        current_fragments = numpy.array([len(self.fragment_info)], dtype=numpy.int64)
+        self.add_fragment(frag, fragmass, 0, 0)
         if self.skip_fragmentation:
             self.convert_fragments_table()
             return len(self.fragment_info)
-        for step in range(self.max_broken_bonds):
-            for fragment in current_fragments:
-                for atom in range(self.natoms):
-                    if 1 << atom & fragment:
-                        self.template_fragment = fragment ^ 1 << atom
-                        list_ext_atoms = set([])
-                        extended_fragments = set([])
-                        for a in self.bonded_atoms[atom]:
-                            if 1 << a & self.template_fragment:
-                                list_ext_atoms.add(a)
-
-                        if len(list_ext_atoms) == 1:
-                            extended_fragments.add(self.template_fragment)
-                        else:
-                            for a in list_ext_atoms:
-                                for frag in extended_fragments:
-                                    if 1 << a & frag:
-                                        break
-                                else:
-                                    self.new_fragment = 1 << a
-                                    self.extend(a)
-                                    extended_fragments.add(self.new_fragment)
-
-
-                        for frag in extended_fragments:
-                            if frag not in all_fragments:
-                                all_fragments.add(frag)
-                                (bondbreaks, score,) = self.score_fragment(frag)
-                                if bondbreaks <= self.max_broken_bonds and score < pars.missingfragmentpenalty + 5:
-                                    new_fragments.add(frag)
-                                    total_fragments.add(frag)
-                                    self.add_fragment(frag, self.calc_fragment_mass(frag), score, bondbreaks)
-
-
-
-            current_fragments = new_fragments
-            new_fragments = set([])
+        visited = (all_fragments, total_fragments)
+        pool = None
+        try:
+            for step in range(self.max_broken_bonds):
+                first_fid = len(self.fragment_info)
+                if ncpus > 1 and len(current_fragments) >= min_parallel_fragments:
+                    if pool == None:
+                        pool = multiprocessing.Pool(ncpus, init_expansion_worker, (self,))
+                    self.expand_fragments_parallel(pool, ncpus, current_fragments, all_fragments, total_fragments, min_fragment_mass)
+                else:
+                    self.expand_fragments(current_fragments, all_fragments, total_fragments, min_fragment_mass)
+                for fragment_set in visited:
+                    if isinstance(fragment_set, FragmentSet):
+                        fragment_set.merge()
+
+                if self.truncated or self.exceeds_memory(visited):
+                    self.truncated = True
+                    logging.warn('Fragmentation stopped after ' + str(step + 1) + ' of ' + str(self.max_broken_bonds) + ' bond breaking steps, as it exceeds the memory limit of ' + str(max_memory) + ' MB')
+                    break
+                # the new fragments of a breadth step are the last ones added to the table
+                current_fragments = numpy.arange(first_fid, len(self.fragment_info))
+                if self.beam_width > 0:
+                    current_fragments = self.select_beam(current_fragments)
+
+        finally:
+            if pool != None:
+                pool.terminate()
+                pool.join()
+
+        if self.truncated:
+            self.convert_fragments_table()
+            return len(self.fragment_info)
+
+        self.breadth_fragments = len(self.fragment_info)
+        if extra_fragments != None:
+            self.add_fragments(*extra_fragments)
+            self.select_new_fragments(extra_fragments[0], total_fragments)
+
+        # fragment ids per number of broken bonds, so each loss step only visits its own layer
+        levels = {}
+        for fid in range(len(self.fragment_info)):
+            levels.setdefault(self.fragment_info[fid][2], []).append(fid)
+
+        neutral_loss_mask = 0
+        for atom in self.neutral_loss_atoms:
+            neutral_loss_mask |= 1 << atom
 
         for step in range(self.max_water_losses):
-            for fi in self.fragment_info:
-                if fi[2] == self.max_broken_bonds + step:
-                    fragment = fi[0]
-                    for atom in self.neutral_loss_atoms:
-                        if 1 << atom & fragment:
-                            frag = fragment ^ 1 << atom
-                            if frag not in total_fragments:
-                                total_fragments.add(frag)
-                                (bondbreaks, score,) = self.score_fragment(frag)
-                                if score < pars.missingfragmentpenalty + 5:
-                                    self.add_fragment(frag, self.calc_fragment_mass(frag), score, bondbreaks)
+            if not neutral_loss_mask:
+                break
+            layer = list(levels.get(self.max_broken_bonds + step, []))
+            start = 0
+            while start < len(layer):
+                candidates = []
+                while start < len(layer) and len(candidates) < visited_batch_size:
+                    fid = layer[start]
+                    fragment = self.fragment_info[fid][0]
+                    for atom in iter_bits(fragment & neutral_loss_mask):
+                        candidates.append((fragment ^ 1 << atom, self.fragment_mass.data[fid] - self.atom_masses[atom]))
+
+                    start += 1
+
+                new = self.select_new_fragments([frag for (frag, fragmass,) in candidates], total_fragments)
+                candidates = [ candidates[i] for i in range(len(candidates)) if new[i] ]
+                (bondbreaks, scores,) = self.score_fragments([frag for (frag, fragmass,) in candidates])
+                for i in range(len(candidates)):
+                    if scores[i] < pars.missingfragmentpenalty + 5 and candidates[i][1] >= min_fragment_mass:
+                        levels.setdefault(bondbreaks[i], []).append(len(self.fragment_info))
+                        self.add_fragment(candidates[i][0], candidates[i][1], scores[i], bondbreaks[i])
 
 
 
@@ -134,19 +499,356 @@ class FragmentEngine(object):
 
 
 
+    def get_beam_width(self, beam = None):
+        """Returns the beam width generate_fragments uses with argument beam, 0 for exhaustive enumeration"""
+        if beam != None:
+            return beam
+        if beam_max_atoms != None and self.natoms > beam_max_atoms or beam_max_bonds != None and len(self.bonds) > beam_max_bonds:
+            return beam_width
+        return 0
+
+
+
+    def select_beam(self, new_fragments):
+        """Returns the beam_width best scoring of the new fragments (ids) of a breadth step for each number of broken bonds.
+
+        The order of the fragments is kept.
+        """
+        levels = {}
+        for fid in new_fragments:
+            (frag, score, bondbreaks,) = self.fragment_info[fid]
+            levels.setdefault(bondbreaks, []).append((score, fid))
+
+        selected = []
+        for level in levels.values():
+            level.sort()
+            selected.extend([ fid for (score, fid,) in level[:self.beam_width] ])
+
+        selected.sort()
+        return numpy.array(selected, dtype=numpy.int64)
+
+
+
+    def complete(self):
+        """Returns True if the fragment table holds all fragments within the bond break and water loss limits"""
+        return self.cacheable() and self.beam_width == 0
+
+
+
+    def cacheable(self):
+        """Returns True if the fragment table only depends on the molecule, the fragmentation parameters and the beam width,
+        so it can be stored in the fragment cache or library"""
+        return not (self.pruned or self.truncated or self.required_atoms != None)
+
+
+
+    def get_atom_map(self, parent_engine):
+        """Returns for each atom of the parent molecule (of parent_engine) the matching atom of this molecule, or -1.
+
+        The atoms are matched with a substructure match of the parent in this molecule, as for
+        an addition (like hydroxylation or conjugation), or of this molecule in the parent, as
+        for a loss. Returns None if neither molecule is a substructure of the other.
+        """
+        match = Chem.GetSubstructMatch(self.mol, parent_engine.mol)
+        if len(match) > 0:
+            return list(match)
+        match = Chem.GetSubstructMatch(parent_engine.mol, self.mol)
+        if len(match) > 0:
+            atom_map = [-1] * parent_engine.natoms
+            for (atom, parent_atom,) in enumerate(match):
+                atom_map[parent_atom] = atom
+
+            return atom_map
+        return None
+
+
+
+    def get_atom_bond_scores(self, atom):
+        return sorted([ self.bondscore[1 << atom | 1 << neighbour] for neighbour in iter_bits(self.neighbour_masks[atom]) ])
+
+
+
+    def get_unchanged_atoms(self, parent_engine, atom_map):
+        """Returns (parent atom, atom) pairs of the atoms which are the same in the parent molecule and this one.
+
+        Atoms are the same if they are mapped onto each other with the same element and hydrogens, and
+        the same bonds (by score) to mapped atoms and to others. The fragments consisting of these atoms
+        only have the same mass, score and bond breaks in both molecules.
+        """
+        inverse_map = dict([ (atom, parent_atom) for (parent_atom, atom,) in enumerate(atom_map) if atom >= 0 ])
+        unchanged = []
+        for (parent_atom, atom,) in enumerate(atom_map):
+            if atom < 0 or self.atom_symbols[atom] != parent_engine.atom_symbols[parent_atom] or self.atom_hs[atom] != parent_engine.atom_hs[parent_atom]:
+                continue
+            if self.get_atom_bond_scores(atom) != parent_engine.get_atom_bond_scores(parent_atom):
+                continue
+            same = True
+            for neighbour in iter_bits(self.neighbour_masks[atom]):
+                if neighbour in inverse_map and parent_engine.bondscore.get(1 << parent_atom | 1 << inverse_map[neighbour]) != self.bondscore[1 << atom | 1 << neighbour]:
+                    same = False
+
+            for parent_neighbour in iter_bits(parent_engine.neighbour_masks[parent_atom]):
+                if atom_map[parent_neighbour] >= 0 and self.bondscore.get(1 << atom | 1 << atom_map[parent_neighbour]) != parent_engine.bondscore[1 << parent_atom | 1 << parent_neighbour]:
+                    same = False
+
+            if same:
+                unchanged.append((parent_atom, atom))
+
+        return unchanged
+
+
+
+    def generate_fragments_from_parent(self, parent_engine, atom_map = None, ncpus = 1):
+        """Generates the fragment table of a molecule which differs by a small change from the molecule of
+        parent_engine, a metabolic parent of which the fragments have been generated, with the same settings.
+
+        The fragments of the parent found by breaking bonds which consist of unchanged atoms only (see
+        get_unchanged_atoms) are mapped onto this molecule, with their masses and scores. Only the fragments
+        containing changed atoms are found by breaking bonds, see required_atoms in generate_fragments,
+        the neutral losses are added to all fragments as usual. atom_map gives for each parent atom the atom in this molecule
+        (or -1), by default it is found with get_atom_map. Returns the number of fragments, or None if the parent
+        table can not be used, in which case nothing is generated.
+
+        A fragment is reused when the parent enumeration reached it. In rare cases the change makes a fragment
+        of unchanged atoms reachable within fewer bond breaking steps, which is then not in the table.
+        """
+        if not parent_engine.accepted() or not parent_engine.complete() or parent_engine.breadth_fragments == None or self.skip_fragmentation or \
+                (parent_engine.max_broken_bonds, parent_engine.max_water_losses, parent_engine.ionisation_mode, parent_engine.molcharge) != \
+                (self.max_broken_bonds, self.max_water_losses, self.ionisation_mode, self.molcharge) or \
+                parent_engine.automorphism_tables != None or self.automorphism_tables != None:
+            return None
+        if atom_map == None:
+            atom_map = self.get_atom_map(parent_engine)
+            if atom_map == None:
+                return None
+        unchanged = self.get_unchanged_atoms(parent_engine, atom_map)
+        permutation = [self.natoms] * parent_engine.natoms
+        changed_parent_atoms = (1 << parent_engine.natoms) - 1
+        changed_atoms = (1 << self.natoms) - 1
+        for (parent_atom, atom,) in unchanged:
+            permutation[parent_atom] = atom
+            changed_parent_atoms &= ~(1 << parent_atom)
+            changed_atoms &= ~(1 << atom)
+
+        byte_tables = []
+        for offset in range(0, parent_engine.natoms, 8):
+            table = [0] * 256
+            for value in range(1, 256):
+                lowbit = value & -value
+                atom = permutation[offset + lowbit.bit_length() - 1] if offset + lowbit.bit_length() <= parent_engine.natoms else self.natoms
+                table[value] = table[value ^ lowbit] | (1 << atom if atom < self.natoms else 0)
+
+            byte_tables.append(table)
+
+        # only the fragments found by breaking bonds, neutral losses depend on the changed atoms as well
+        (parent_fragments, masses, scores, bondbreaks,) = parent_engine.get_fragment_arrays()
+        nbreadth = parent_engine.breadth_fragments - 1
+        words = parent_engine.fragments_to_words(parent_fragments[:nbreadth])
+        outside = parent_engine.fragments_to_words([changed_parent_atoms])
+        reused = numpy.flatnonzero(~(words & outside).any(1))
+        fragments = [ map_fragment(parent_fragments[i], byte_tables) for i in reused ]
+        # without changed atoms, the molecule itself is generated already
+        molecule = (1 << self.natoms) - 1
+        reused = reused[numpy.array([ fragment != molecule for fragment in fragments ], dtype=bool)]
+        fragments = [ fragment for fragment in fragments if fragment != molecule ]
+        self.reused_fragments = len(fragments)
+        return self.generate_fragments(ncpus=ncpus, required_atoms=changed_atoms, extra_fragments=(fragments,
+         masses[reused],
+         scores[reused],
+         bondbreaks[reused]))
+
+
+
+    def new_visited_set(self):
+        """Returns an empty set of visited fragments, see select_new_fragments.
+
+        Without symmetry this is a compact FragmentSet. Symmetric fragments are merged
+        with a Python set, which holds canonical forms as well, see is_new_fragment.
+        """
+        if self.automorphism_tables == None:
+            return FragmentSet(self.nwords)
+        return set()
+
+
+
+    def select_new_fragments(self, fragments, visited):
+        """Adds a batch of fragments to the visited fragments, returns a list which is True for each fragment that is new"""
+        if isinstance(visited, FragmentSet):
+            return visited.add_new(self.fragments_to_words(fragments)).tolist()
+        return [ self.is_new_fragment(fragment, visited) for fragment in fragments ]
+
+
+
+    def exceeds_memory(self, visited):
+        """Checks the estimated memory use of the enumeration against max_memory (MB).
+
+        Counts the fragment table, the visited fragments and the temporary arrays of a batch of children.
+        """
+        if max_memory == None:
+            return False
+        nbytes = len(self.fragment_info) * fragment_entry_bytes + self.get_batch_bytes()
+        for fragment_set in visited:
+            if isinstance(fragment_set, FragmentSet):
+                nbytes += fragment_set.nbytes()
+            else:
+                nbytes += len(fragment_set) * fragment_entry_bytes
+        return nbytes > max_memory * 1048576
+
+
+
+    def get_batch_bytes(self):
+        """Returns the estimated size of the temporary arrays used to check and score a batch of children"""
+        rows = min(visited_batch_size, self.get_score_batch_size())
+        return 3 * visited_batch_size * 8 * self.nwords + rows * len(self.bonds) * 32
+
+
+
+    def get_score_batch_size(self):
+        """Returns the number of fragments scored at once by score_fragments, see score_batch_memory"""
+        return max(1, int(score_batch_memory * 1048576) // (32 * max(1, len(self.bonds))))
+
+
+
+    def is_new_fragment(self, fragment, visited):
+        """Adds fragment to the set of visited fragments, returns False if it (or a symmetric fragment) was visited before.
+
+        If symmetric fragments are merged, visited holds the canonical form of each visited fragment
+        as well as the fragment itself, so most repeated fragments are found without mapping them.
+        """
+        if fragment in visited:
+            return False
+        if self.automorphism_tables == None:
+            visited.add(fragment)
+            return True
+        key = self.get_canonical_fragment(fragment)
+        new = key not in visited
+        visited.add(fragment)
+        visited.add(key)
+        return new
+
+
+
+    def expand_fragments(self, current_fragments, all_fragments, total_fragments, min_fragment_mass):
+        """One breadth step: adds the new child fragments of current_fragments (fragment ids) to the table.
+
+        Children are checked against the visited fragments in batches. The step stops early,
+        setting truncated, when the estimated memory use exceeds max_memory.
+        """
+        start = 0
+        while start < len(current_fragments):
+            children = []
+            parents = []
+            while start < len(current_fragments) and len(children) < visited_batch_size:
+                fid = current_fragments[start]
+                child_fragments = self.get_child_fragments(self.fragment_info[fid][0])
+                if self.required_atoms != None:
+                    child_fragments = [ child for child in child_fragments if child & self.required_atoms ]
+                children.extend(child_fragments)
+                parents.extend([fid] * len(child_fragments))
+                start += 1
+
+            new = self.select_new_fragments(children, all_fragments)
+            candidates = [ children[i] for i in range(len(children)) if new[i] ]
+            parents = [ parents[i] for i in range(len(children)) if new[i] ]
+            self.add_new_children(candidates, parents, total_fragments, min_fragment_mass)
+            if self.exceeds_memory((all_fragments, total_fragments)):
+                self.truncated = True
+                return
+
+
+
+    def add_new_children(self, candidates, parents, total_fragments, min_fragment_mass):
+        """Scores the new child fragments of a breadth step, adds the ones that pass to the table"""
+        (bondbreaks, scores,) = self.score_fragments(candidates)
+        accepted = []
+        for i in range(len(candidates)):
+            if bondbreaks[i] <= self.max_broken_bonds and scores[i] < pars.missingfragmentpenalty + 5:
+                frag = candidates[i]
+                fragmass = self.fragment_mass.data[parents[i]] - self.calc_fragment_mass(self.fragment_info[parents[i]][0] ^ frag)
+                if fragmass < min_fragment_mass:
+                    continue
+                accepted.append(frag)
+                self.add_fragment(frag, fragmass, scores[i], bondbreaks[i])
+
+        self.select_new_fragments(accepted, total_fragments)
+
+
+
+    def expand_fragments_parallel(self, pool, ncpus, current_fragments, all_fragments, total_fragments, min_fragment_mass):
+        """Same breadth step as expand_fragments, with the expansion split over the worker processes of pool.
+
+        Children are merged in parent order and the first occurrence of a fragment is kept, so its
+        mass is calculated from the same parent as in the serial step. Fragments rejected on their
+        bond breaks or score are not returned by the workers; they would be rejected again anyway.
+        """
+        chunksize = max(1, len(current_fragments) // (4 * ncpus))
+        masses = self.fragment_mass.array()[current_fragments]
+        # the chunks of (fragment, mass) pairs are made as the workers take them, the table only grows meanwhile
+        chunks = ([ (self.fragment_info[current_fragments[j]][0], masses[j]) for j in range(i, min(i + chunksize, len(current_fragments))) ] for i in range(0, len(current_fragments), chunksize))
+        for children in pool.imap(expand_fragments_job, chunks):
+            new = self.select_new_fragments([frag for (frag, fragmass, score, bondbreaks,) in children], all_fragments)
+            accepted = []
+            for i in range(len(children)):
+                (frag, fragmass, score, bondbreaks,) = children[i]
+                if new[i] and fragmass >= min_fragment_mass and (self.required_atoms == None or frag & self.required_atoms):
+                    accepted.append(frag)
+                    self.add_fragment(frag, fragmass, score, bondbreaks)
+
+            self.select_new_fragments(accepted, total_fragments)
+            if self.exceeds_memory((all_fragments, total_fragments)):
+                self.truncated = True
+                return
+
+
+
+
+    def get_child_fragments(self, fragment):
+        return expand_fragment(fragment, self.neighbour_masks)
+
+
+
     def score_fragment(self, fragment):
-        score = 0
-        bondbreaks = 0
-        for bond in self.bonds:
-            if 0 < fragment & bond < bond:
-                score += self.bondscore[bond]
-                bondbreaks += 1
+        (bondbreaks, scores,) = self.score_fragments([fragment])
+        return (bondbreaks[0], scores[0])
 
-        if score == 0:
-            print 'score=0: ',
-            print fragment,
-            print bondbreaks
-        return (bondbreaks, score)
+
+
+    def get_fragment_words(self):
+        """Returns the fragments of the table as rows of words, indexed by fragment id"""
+        if self.fragment_words_np is None:
+            self.fragment_words_np = self.fragments_to_words([ fragment for (fragment, score, bondbreaks,) in self.fragment_info ])
+        return self.fragment_words_np
+
+
+
+    def fragments_to_words(self, fragments):
+        words = numpy.zeros((len(fragments), self.nwords), dtype=numpy.uint64)
+        for w in range(self.nwords):
+            shift = 64 * w
+            words[:, w] = [fragment >> shift & WORDMASK for fragment in fragments]
+
+        return words
+
+
+
+    def score_fragments(self, fragments):
+        """Count and score the broken bonds of a batch of fragments at once.
+
+        A bond is broken when exactly one of its atoms is part of the fragment.
+        Returns two lists: the number of broken bonds and the summed bond weights.
+        The fragments are scored in batches of get_score_batch_size, to bound the temporary arrays.
+        """
+        bondbreaks = []
+        scores = []
+        batch_size = self.get_score_batch_size()
+        for start in range(0, len(fragments), batch_size):
+            words = self.fragments_to_words(fragments[start:start + batch_size])
+            in_fragment = words[:, self.bond_words] >> self.bond_bits & numpy.uint64(1)
+            broken = in_fragment[:, :, 0] != in_fragment[:, :, 1]
+            bondbreaks.extend(broken.sum(1).tolist())
+            scores.extend(broken.dot(self.bond_weights).tolist())
+
+        return (bondbreaks, scores)
 
 
 
@@ -160,27 +862,155 @@ class FragmentEngine(object):
 
 
 
+    def get_bond_states(self, fragments):
+        """Returns for each fragment and bond the two bond atom bits, as 2 * higher atom + lower atom"""
+        words = self.fragments_to_words(fragments)
+        in_fragment = (words[:, self.sorted_bond_words] >> self.sorted_bond_bits & numpy.uint64(1)).astype(numpy.int8)
+        return 2 * in_fragment[:, :, 1] + in_fragment[:, :, 0]
+
+
+
+    def score_fragments_rel2parent(self, fragments, parent):
+        """Parent relative scores of a batch of fragments, as score_fragment_rel2parent.
+
+        The integer comparison 0 < fragment & bond < bond & parent only depends on the two bond
+        atom bits, so it is done on the bond states of the fragments and those of parent, which
+        are cached per parent.
+        """
+        if parent not in self.parent_bond_states:
+            self.parent_bond_states[parent] = self.get_bond_states([parent])[0]
+        parent_states = self.parent_bond_states[parent]
+        states = self.get_bond_states(fragments)
+        return ((0 < states) & (states < parent_states)).dot(self.bond_weights).tolist()
+
+
+
     def calc_fragment_mass(self, fragment):
         fragment_mass = 0.0
-        for atom in range(self.natoms):
-            if fragment & 1 << atom:
-                fragment_mass += self.atom_masses[atom]
+        for atom in iter_bits(fragment):
+            fragment_mass += self.atom_masses[atom]
 
         return fragment_mass
 
 
 
+    def get_ion_mass_offsets(self, bondbreaks):
+        """Returns the ion mass offsets and deltaH values of a fragment with the given number of broken bonds"""
+        if bondbreaks not in self.ion_mass_offsets:
+            deltaH = range(-bondbreaks, bondbreaks + 1)
+            if bondbreaks == 0:
+                deltaH.append(-self.ionisation_mode)
+                deltaH.sort()
+            ion_deltaH = numpy.array(deltaH) + self.ionisation_mode * (1 - self.molcharge)
+            offsets = ion_deltaH * pars.Hmass
+            if bondbreaks == 0:
+                offsets[deltaH.index(-self.ionisation_mode)] = 0.0
+            self.ion_mass_offsets[bondbreaks] = (offsets, ion_deltaH)
+        return self.ion_mass_offsets[bondbreaks]
+
+
+
     def add_fragment(self, fragment, fragmentmass, score, bondbreaks):
-        mass_range = (self.max_broken_bonds + self.max_water_losses - bondbreaks) * [0] + list(numpy.arange(-bondbreaks + self.ionisation_mode * (1 - self.molcharge), bondbreaks + self.ionisation_mode * (1 - self.molcharge) + 1) * pars.Hmass + fragmentmass) + (self.max_broken_bonds + self.max_water_losses - bondbreaks) * [0]
-        if bondbreaks == 0:
-            mass_range[self.max_broken_bonds + self.max_water_losses - self.ionisation_mode] = fragmentmass
-        self.fragment_masses += mass_range
+        """Adds a fragment to the fragment table.
+
+        For each allowed hydrogen shift (deltaH) the ion mass is stored in fragment_masses,
+        the number of hydrogen shifts allowed is equal to the number of broken bonds.
+        """
+        (offsets, ion_deltaH,) = self.get_ion_mass_offsets(bondbreaks)
+        fid = len(self.fragment_info)
+        self.fragment_masses.extend(offsets + fragmentmass)
+        self.fragment_mass_ids.extend(len(offsets) * [fid])
+        self.fragment_mass_deltaH.extend(ion_deltaH)
+        self.fragment_mass.append(fragmentmass)
         self.fragment_info.append([fragment, score, bondbreaks])
 
 
 
     def convert_fragments_table(self):
-        self.fragment_masses_np = numpy.array(self.fragment_masses).reshape(len(self.fragment_info), (self.max_broken_bonds + self.max_water_losses) * 2 + 1)
+        self.fragment_masses_np = self.fragment_masses.array()
+        self.fragment_mass_ids_np = self.fragment_mass_ids.array()
+        self.fragment_mass_deltaH_np = self.fragment_mass_deltaH.array()
+        self.fragment_mass_np = self.fragment_mass.array()
+        # mass index: positions in fragment_masses_np sorted by mass, for binary search
+        self.mass_order = numpy.argsort(self.fragment_masses_np, kind='mergesort')
+        self.sorted_masses = self.fragment_masses_np[self.mass_order]
+        # fragments as rows of words, built on the first lookup of child fragments, see get_fragment_words
+        self.fragment_words_np = None
+
+
+
+    def get_fragment_table(self):
+        """Returns the fragment table in a compact form, to be stored and restored with set_fragment_table"""
+        return (self.fragment_info,
+         self.fragment_mass_np,
+         self.fragment_masses_np,
+         self.fragment_mass_ids_np,
+         self.fragment_mass_deltaH_np)
+
+
+
+    def set_fragment_table(self, fragment_table):
+        """Restores a fragment table obtained with get_fragment_table, instead of generating the fragments"""
+        (self.fragment_info, fragment_mass, fragment_masses, fragment_mass_ids, fragment_mass_deltaH,) = fragment_table
+        for (growable, values,) in ((self.fragment_mass, fragment_mass),
+         (self.fragment_masses, fragment_masses),
+         (self.fragment_mass_ids, fragment_mass_ids),
+         (self.fragment_mass_deltaH, fragment_mass_deltaH)):
+            growable.data = numpy.asarray(values, dtype=growable.data.dtype)
+            growable.size = len(values)
+
+        self.convert_fragments_table()
+        return len(self.fragment_info)
+
+
+
+    def get_fragment_arrays(self):
+        """Returns the fragments (without the dummy first entry) with their masses, scores and bondbreaks as arrays"""
+        fragments = [fi[0] for fi in self.fragment_info[1:]]
+        scores = numpy.array([fi[1] for fi in self.fragment_info[1:]], dtype=numpy.float64)
+        bondbreaks = numpy.array([fi[2] for fi in self.fragment_info[1:]], dtype=numpy.int8)
+        return (fragments, self.fragment_mass_np[1:], scores, bondbreaks)
+
+
+
+    def set_fragment_arrays(self, fragments, masses, scores, bondbreaks):
+        """Fills the fragment table from arrays as returned by get_fragment_arrays, instead of generating the fragments.
+
+        The fragments are added after those already in the table, if any.
+        """
+        self.add_fragments(fragments, masses, scores, bondbreaks)
+        self.convert_fragments_table()
+        return len(self.fragment_info)
+
+
+
+    def add_fragments(self, fragments, masses, scores, bondbreaks):
+        """Adds fragments to the fragment table at once, as add_fragment does for one"""
+        bondbreaks = numpy.asarray(bondbreaks, dtype=numpy.int64)
+        masses = numpy.asarray(masses, dtype=numpy.float64)
+        first_fid = len(self.fragment_info)
+        self.fragment_info.extend([list(fi) for fi in zip(fragments, numpy.asarray(scores, dtype=numpy.float64).tolist(), bondbreaks.tolist())])
+        self.fragment_mass.extend(masses)
+        if len(bondbreaks) > 0:
+            # ion masses of all fragments at once, from per bondbreaks tables of offsets and deltaH
+            levels = numpy.unique(bondbreaks)
+            width = max([len(self.get_ion_mass_offsets(b)[0]) for b in levels])
+            offsets_table = numpy.zeros((levels[-1] + 1, width), dtype=numpy.float64)
+            deltaH_table = numpy.zeros((levels[-1] + 1, width), dtype=numpy.int64)
+            lengths = numpy.zeros(levels[-1] + 1, dtype=numpy.int64)
+            for b in levels:
+                (offsets, ion_deltaH,) = self.get_ion_mass_offsets(b)
+                offsets_table[b, :len(offsets)] = offsets
+                deltaH_table[b, :len(offsets)] = ion_deltaH
+                lengths[b] = len(offsets)
+
+            counts = lengths[bondbreaks]
+            starts = numpy.cumsum(counts) - counts
+            positions = numpy.arange(counts.sum()) - numpy.repeat(starts, counts)
+            levels = numpy.repeat(bondbreaks, counts)
+            self.fragment_masses.extend(offsets_table[levels, positions] + numpy.repeat(masses, counts))
+            self.fragment_mass_ids.extend(numpy.repeat(numpy.arange(first_fid, first_fid + len(bondbreaks)), counts))
+            self.fragment_mass_deltaH.extend(deltaH_table[levels, positions])
 
 
 
@@ -195,39 +1025,97 @@ class FragmentEngine(object):
 
 
     def find_fragments(self, mass, parent, precision, mz_precision_abs):
-        result = numpy.where(numpy.where(self.fragment_masses_np < max(mass * precision, mass + mz_precision_abs), self.fragment_masses_np, 0) > min(mass / precision, mass - mz_precision_abs))
-        fragment_set = []
-        for i in range(len(result[0])):
-            fid = result[0][i]
-            fragment_set.append(self.fragment_info[fid] + [self.fragment_masses_np[fid][(self.max_broken_bonds + self.max_water_losses - self.ionisation_mode * (1 - self.molcharge))]] + [self.ionisation_mode * (1 - self.molcharge) + result[1][i] - self.max_broken_bonds - self.max_water_losses])
+        return self.find_fragments_batch([mass], parent, precision, mz_precision_abs)[0]
+
 
-        return fragment_set
+
+    def find_fragments_batch(self, masses, parent, precision, mz_precision_abs):
+        """Finds the fragments matching each of a list of masses, with a single binary search.
+
+        Returns a list with, for each mass, the list of [fragment, score, bondbreaks, mass, deltaH]
+        of the matching fragment ions which are part of parent, ordered by fragment and deltaH. The
+        order of the fragment table depends on how it was made (generated, from a parent, cache or
+        library), so the first of equally scored fragments, which search_structure keeps, does not.
+        The fragments in the mass windows are tested against parent at once on their words, so
+        only the descendants of parent are looked up. If symmetric fragments are merged, each
+        stored fragment is replaced by its symmetric counterparts within parent.
+        """
+        masses = numpy.asarray(masses, dtype=numpy.float64)
+        low = numpy.minimum(masses / precision, masses - mz_precision_abs)
+        high = numpy.maximum(masses * precision, masses + mz_precision_abs)
+        start = numpy.searchsorted(self.sorted_masses, low, 'right')
+        end = numpy.searchsorted(self.sorted_masses, high, 'left')
+        windows = [ numpy.sort(self.mass_order[start[i]:end[i]]) for i in range(len(masses)) ]
+        if self.automorphism_tables == None and parent != (1 << self.natoms) - 1 and sum([ len(window) for window in windows ]) > 0:
+            indices = numpy.concatenate(windows)
+            outside = ~self.fragments_to_words([parent])[0]
+            descendant = ~(self.get_fragment_words()[self.fragment_mass_ids_np[indices]] & outside).any(1)
+            bounds = numpy.cumsum([0] + [ len(window) for window in windows ])
+            windows = [ window[descendant[bounds[i]:bounds[i + 1]]] for (i, window,) in enumerate(windows) ]
+        fragment_sets = []
+        for i in range(len(masses)):
+            fragment_set = []
+            for index in windows[i]:
+                fid = self.fragment_mass_ids_np[index]
+                (fragment, score, bondbreaks,) = self.fragment_info[fid]
+                if self.automorphism_tables == None or fragment == 0:
+                    fragments = [fragment]
+                else:
+                    fragments = self.get_symmetric_fragments(fragment, parent)
+                for fragment in fragments:
+                    fragment_set.append([fragment, score, bondbreaks, float(self.fragment_mass_np[fid]), int(self.fragment_mass_deltaH_np[index])])
+
+
+            fragment_set.sort(key=lambda fragment_ion: (fragment_ion[0], fragment_ion[4]))
+            fragment_sets.append(fragment_set)
+
+        return fragment_sets
+
+
+
+    def get_fragment_atoms(self, fragment):
+        """Returns the atom string and atom list of a fragment, the cheap part of get_fragment_info"""
+        if fragment not in self.fragment_atoms_cache:
+            atomlist = list(iter_bits(fragment))
+            atomstring = ''.join([ ',' + str(atom) for atom in atomlist ])
+            self.fragment_atoms_cache[fragment] = (atomstring, atomlist)
+        return self.fragment_atoms_cache[fragment]
 
 
 
     def get_fragment_info(self, fragment, deltaH):
-        atomstring = ''
-        atomlist = []
-        elements = dict([(e,0) for e in pars.mims.keys()])
-        for atom in range(self.natoms):
-            if 1 << atom & fragment:
-                atomstring += ',' + str(atom)
-                atomlist.append(atom)
-                elements[Chem.GetAtomSymbol(self.mol, atom)] += 1
-                elements['H'] += Chem.GetAtomHs(self.mol, atom)
-
-        formula = ''
-        for el in pars.mims.keys():
-            nel = elements[el]
-            if nel > 0:
-                formula += el
-            if nel > 1:
-                formula += str(nel)
-
-        return (atomstring,
-         atomlist,
-         formula,
-         Chem.FragmentToInchiKey(self.mol, atomlist))
+        """Returns atom string, atom list, formula and SMILES of a fragment, memoized per fragment"""
+        if fragment not in self.fragment_info_cache:
+            self.get_fragments_info([fragment])
+        return self.fragment_info_cache[fragment]
+
+
+
+    def get_fragments_info(self, fragments):
+        """Fills the fragment_info_cache for a batch of fragments, with a single call for the SMILES"""
+        fragments = [ fragment for fragment in set(fragments) if fragment not in self.fragment_info_cache ]
+        if len(fragments) == 0:
+            return 
+        atomlists = [ self.get_fragment_atoms(fragment)[1] for fragment in fragments ]
+        for (fragment, smiles,) in zip(fragments, Chem.FragmentsToInchiKey(self.mol, atomlists)):
+            (atomstring, atomlist,) = self.get_fragment_atoms(fragment)
+            elements = {'H': 0}
+            for atom in atomlist:
+                elements[self.atom_symbols[atom]] = elements.get(self.atom_symbols[atom], 0) + 1
+                elements['H'] += self.atom_hs[atom]
+
+            formula = ''
+            for el in pars.mims.keys():
+                nel = elements.get(el, 0)
+                if nel > 0:
+                    formula += el
+                if nel > 1:
+                    formula += str(nel)
+
+            self.fragment_info_cache[fragment] = (atomstring,
+             atomlist,
+             formula,
+             smiles)
 
 
 
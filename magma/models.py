@@ -86,6 +86,8 @@ class Metabolite(Base):
     natoms = Column(Integer)
     logp = Column(Float)
     reference = Column(Unicode)
+    # why the candidate was not annotated, when it exceeded its time or memory limit
+    skip_reason = Column(Unicode)
     fragments = relationship('Fragment', backref='metabolite')
 
 
@@ -191,6 +193,9 @@ class Fragment(Base):
     deltappm = Column(Float)
     inchikey = Column(Unicode)
     formula = Column(Unicode)
+    # fragmentation depth the candidate molecule was annotated with
+    max_broken_bonds = Column(Integer)
+    max_water_losses = Column(Integer)
     children_backref = backref('parent', remote_side=[fragid])
     children = relationship('Fragment', backref=children_backref, lazy='joined', join_depth=1)
     __table_args__ = (ForeignKeyConstraint(['scanid', 'mz'], ['peaks.scanid', 'peaks.mz']), {})
@@ -215,3 +220,14 @@ class Run(Base):
     mz_precision_abs = Column(Float)
     precursor_mz_precision = Column(Float)
     use_all_peaks = Column(Boolean)
+
+
+# columns added to existing tables after their first release, create_all does not add them to existing databases
+added_columns = [Metabolite.__table__.c.skip_reason, Fragment.__table__.c.max_broken_bonds, Fragment.__table__.c.max_water_losses]
+
+def add_missing_columns(engine):
+    """Adds the added_columns which are missing from the tables of a database made before they were added"""
+    for column in added_columns:
+        table = column.table.name
+        if column.name not in [ row[1] for row in engine.execute('PRAGMA table_info(' + table + ')') ]:
+            engine.execute('ALTER TABLE ' + table + ' ADD COLUMN ' + column.name + ' ' + column.type.compile(engine.dialect))
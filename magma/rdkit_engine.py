@@ -2,6 +2,7 @@
 from rdkit.Chem import *
 from rdkit import Chem, Geometry
 from rdkit.Chem import AllChem, Descriptors
+import numpy
 import pars
 bondtype2string = {v:k for (k, v,) in Chem.rdchem.BondType.names.items()}
 
@@ -61,19 +62,97 @@ def GetBondType(mol, b):
 
 
 
+def GetMolArrays(mol):
+    """Returns the atoms and bonds of mol at once, as numpy arrays.
+
+    Returns atom masses (including hydrogens), element symbols, hydrogen counts and numbers of
+    bonds of the atoms, and the atom index pairs and bond types of the bonds.
+    """
+    atoms = mol.GetAtoms()
+    symbols = [ atom.GetSymbol() for atom in atoms ]
+    hs = numpy.array([ atom.GetNumImplicitHs() + atom.GetNumExplicitHs() for atom in atoms ], dtype=numpy.int64)
+    degrees = numpy.array([ atom.GetDegree() for atom in atoms ], dtype=numpy.int64)
+    masses = numpy.array([ pars.mims[symbol] for symbol in symbols ], dtype=numpy.float64) + pars.Hmass * hs
+    bonds = mol.GetBonds()
+    bond_atoms = numpy.array([ (bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()) for bond in bonds ], dtype=numpy.int64).reshape(-1, 2)
+    bond_types = numpy.array([ bondtype2string[bond.GetBondType()] for bond in bonds ], dtype=str)
+    return (masses,
+     numpy.array(symbols, dtype=str),
+     hs,
+     degrees,
+     bond_atoms,
+     bond_types)
+
+
+
+def GetAutomorphisms(mol, max_automorphisms = 1000):
+    """Returns atom permutations which map mol onto itself, from substructure matches of mol with itself"""
+    return mol.GetSubstructMatches(mol, uniquify=False, useChirality=False, maxMatches=max_automorphisms)
+
+
+
+def GetSubstructMatch(mol, query):
+    """Returns for each atom of query the index of the matching atom of mol, or an empty tuple if query is not a substructure of mol"""
+    return mol.GetSubstructMatch(query)
+
+
+
 def MolToInchiKey(mol):
     return AllChem.InchiToInchiKey(AllChem.MolToInchi(mol))
 
 
 
 def FragmentToInchiKey(mol, atomlist):
-    emol = Chem.EditableMol(mol)
-    for atom in reversed(range(mol.GetNumAtoms())):
-        if atom not in atomlist:
-            emol.RemoveAtom(atom)
+    return FragmentsToSmiles(mol, [atomlist])[0]
 
-    frag = emol.GetMol()
-    return Chem.MolToSmiles(frag)
+
+
+def FragmentsToInchiKey(mol, atomlists):
+    return FragmentsToSmiles(mol, atomlists)
+
+
+
+def FragmentToSmiles(mol, atomlist):
+    return FragmentsToSmiles(mol, [atomlist])[0]
+
+
+
+def FragmentsToSmiles(mol, atomlists):
+    """Returns the SMILES of a batch of fragments of mol, each given as a list of atoms.
+
+    A fragment is cut out of mol by its internal bonds with PathToSubmol, and its stereochemistry
+    is assigned again, which gives the same SMILES as removing the other atoms from a copy of mol.
+    Only fragments whose atoms are not all covered by these bonds (single atoms) are made by
+    removing the other atoms.
+    """
+    bonds = [ (bond.GetIdx(), bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()) for bond in mol.GetBonds() ]
+    smiles = []
+    for atomlist in atomlists:
+        atoms = set(atomlist)
+        path = []
+        path_atoms = set([])
+        for (b, a1, a2,) in bonds:
+            if a1 in atoms and a2 in atoms:
+                path.append(b)
+                path_atoms.add(a1)
+                path_atoms.add(a2)
+
+        if len(path) > 0 and path_atoms == atoms:
+            submol = Chem.PathToSubmol(mol, path)
+            # PathToSubmol keeps the chiral tags and stereo bonds of mol, which the fragment may not have
+            submol.ClearComputedProps()
+            submol.UpdatePropertyCache(False)
+            Chem.AssignStereochemistry(submol, cleanIt=True, force=True)
+            smiles.append(Chem.MolToSmiles(submol))
+        else:
+            emol = Chem.EditableMol(mol)
+            for atom in reversed(range(mol.GetNumAtoms())):
+                if atom not in atoms:
+                    emol.RemoveAtom(atom)
+
+            smiles.append(Chem.MolToSmiles(emol.GetMol()))
+
+    return smiles
 
 
 
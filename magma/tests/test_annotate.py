@@ -0,0 +1,432 @@
+"""
+Tests of AnnotateEngine.search_structures, on a database with a spectral tree of a few molecules.
+"""
+import unittest
+import tempfile
+import shutil
+import os
+import re
+import sqlite3
+import numpy
+import magma
+from magma import pars
+from magma import fragmentation_py
+from magma.fragmentation_py import Chem
+from magma.models import Metabolite, Reaction, Fragment
+from magma.tests.test_fragmentation import molecules, get_molblock, generate
+from magma.tests.test_cache import create_structure_database
+
+# isomers of glucose, which share its precursor ion
+molecules['fructose'] = 'OC[C@@]1(O)OC[C@@H](O)[C@@H](O)[C@@H]1O'
+molecules['inositol'] = 'O[C@H]1[C@H](O)[C@@H](O)[C@H](O)[C@H](O)[C@@H]1O'
+
+def get_tree(name, npeaks = 8):
+    """Returns a spectral tree of molecule name in the manual tree format, with an MS3 scan of one fragment"""
+    engine = generate(fragmentation_py, name, 3, 1)
+    fragments = dict([ (fragment, mass) for ((fragment, score, bondbreaks,), mass,) in zip(engine.fragment_info[1:], engine.fragment_mass_np[1:]) ])
+    molecule = (1 << engine.natoms) - 1
+    ion = pars.Hmass - pars.elmass
+    masses = numpy.unique(engine.fragment_masses_np)
+    masses = masses[masses > 50]
+    childpeaks = [ '%.6f: 100000' % (mass - pars.elmass) for mass in masses[::max(1, len(masses) // npeaks)] ]
+    # the largest fragment, with its own fragments
+    (mass, fragment,) = max([ (mass, fragment) for (fragment, mass,) in fragments.items() if fragment != molecule ])
+    masses = sorted(set([ round(fragments[f] + ion, 6) for f in fragments if f & fragment == f and f != fragment and fragments[f] > 50 ]))
+    childpeaks.append('%.6f: 200000 (%s)' % (mass + ion, ', '.join([ '%.6f: 50000' % mass for mass in masses[::max(1, len(masses) // 4)] ])))
+    mim = fragments[molecule]
+    return '%.6f: 10000000 (%s)' % (mim + ion, ', '.join(childpeaks))
+
+
+
+def get_fragments(db_session):
+    """Returns the stored fragments as sorted tuples, with the fragment ids replaced by the atoms of the parent fragment"""
+    fragments = db_session.query(Fragment).all()
+    atoms = dict([ (fragment.fragid, (fragment.scanid, fragment.atoms)) for fragment in fragments ])
+    return sorted([ (fragment.metid, fragment.scanid, round(fragment.mz, 6), round(fragment.score, 6), fragment.atoms, round(fragment.mass, 6), fragment.deltah, fragment.deltappm == None or round(fragment.deltappm, 3), fragment.formula, fragment.inchikey, fragment.max_broken_bonds, fragment.max_water_losses, atoms.get(fragment.parentfragid)) for fragment in fragments ])
+
+
+
+def get_nhits(db_session):
+    """Returns the number of hits and the skip reason of each metabolite"""
+    return sorted(db_session.query(Metabolite.metid, Metabolite.nhits, Metabolite.skip_reason).all())
+
+
+
+def remove_columns(dbfilename, columns):
+    """Recreates tables without some of their columns, given as a dict of lists per table, as in older databases"""
+    conn = sqlite3.connect(dbfilename)
+    for (table, table_columns,) in columns.items():
+        sql = conn.execute('SELECT sql FROM sqlite_master WHERE name = ?', (table,)).fetchone()[0]
+        for column in table_columns:
+            sql = re.sub('\\s*' + column + ' \\w+,', '', sql)
+
+        conn.execute('DROP TABLE ' + table)
+        conn.execute(sql)
+
+    conn.commit()
+    conn.close()
+
+
+
+class AnnotateTestCase(unittest.TestCase):
+    """Creates a database with the spectral trees of trees, and the candidates with the reactions between them, for each test"""
+    trees = ('glucose', 'chlorogenic acid')
+    candidates = ('glucose', 'fructose', 'inositol', 'chlorogenic acid', 'phenylalanine', 'choline')
+    reactions = ()
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.treefilename = os.path.join(self.directory, 'tree.txt')
+        with open(self.treefilename, 'w') as treefile:
+            treefile.write(', '.join([ get_tree(name) for name in self.trees ]))
+
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+
+    def get_session(self, name = 'results.db', candidates = None):
+        """Returns a MagmaSession with the spectral trees and the candidates stored"""
+        if candidates == None:
+            candidates = self.candidates
+        magma_session = magma.MagmaSession(os.path.join(self.directory, name))
+        ms_data_engine = magma_session.get_ms_data_engine(ionisation_mode=1, abs_peak_cutoff=0)
+        ms_data_engine.store_manual_tree(self.treefilename, 0)
+        structure_engine = magma_session.get_structure_engine()
+        metids = {}
+        for name in candidates:
+            metids[name] = structure_engine.add_structure(get_molblock(name), name, 1.0, 0, 1)
+
+        for (reactant, product, reaction,) in self.reactions:
+            magma_session.db_session.add(Reaction(reactant=metids[reactant], product=metids[product], name=unicode(reaction)))
+
+        magma_session.commit()
+        return magma_session
+
+
+
+    def get_annotate_engine(self, magma_session, **kwargs):
+        annotate_engine = magma_session.get_annotate_engine(ms_intensity_cutoff=0, msms_intensity_cutoff=0, **kwargs)
+        annotate_engine.build_spectra()
+        return annotate_engine
+
+
+
+    def search(self, name = 'results.db', engine_kwargs = {}, **kwargs):
+        """Returns the fragments and hits of the candidates after search_structures"""
+        magma_session = self.get_session(name)
+        self.get_annotate_engine(magma_session, **engine_kwargs).search_structures(**kwargs)
+        return (get_fragments(magma_session.db_session), get_nhits(magma_session.db_session))
+
+
+
+
+
+class TestSearchStructures(AnnotateTestCase):
+
+    def test_search_structures(self):
+        (fragments, nhits,) = self.search()
+        matched = set([ fragment[0] for fragment in fragments if fragment[-1] == None ])
+        # the hexoses and chlorogenic acid
+        self.assertEqual(len(matched), 4)
+        self.assertTrue(len([ fragment for fragment in fragments if fragment[-1] != None and fragment[-1][1].count(',') < fragment[4].count(',') ]) == 0)
+        self.assertTrue(len([ fragment for fragment in fragments if fragment[1] > 2 and fragment[-1] != None ]) > 0)
+
+
+
+    def test_annotate_top(self):
+        (expected, expected_nhits,) = self.search('full.db')
+        (fragments, nhits,) = self.search(annotate_top=10)
+        self.assertEqual(fragments, expected)
+        self.assertEqual(nhits, expected_nhits)
+        (fragments, nhits,) = self.search('top.db', annotate_top=1)
+        self.assertEqual(nhits, expected_nhits)
+        # the best candidate of each precursor ion
+        top = set([ min([ (fragment[3], fragment[0]) for fragment in expected if fragment[1:3] == precursor and fragment[-1] == None ])[1] for precursor in set([ fragment[1:3] for fragment in expected if fragment[-1] == None ]) ])
+        self.assertEqual(len(top), 2)
+        for (fragment, expected_fragment,) in zip(fragments, expected):
+            if fragment[0] in top:
+                self.assertEqual(fragment, expected_fragment)
+            else:
+                self.assertEqual(fragment[:8] + fragment[10:], expected_fragment[:8] + expected_fragment[10:])
+                self.assertEqual(fragment[9], u'')
+
+
+
+    def test_depth_budget(self):
+        (expected, expected_nhits,) = self.search('depth.db', {'max_broken_bonds': 1})
+        # too small for more than the minimum depth
+        (fragments, nhits,) = self.search(depth_budget=1e-09)
+        self.assertEqual(fragments, expected)
+        self.assertEqual(nhits, expected_nhits)
+        # nor is a fragment library of the full depth used
+        libfilename = os.path.join(self.directory, 'structures.frag')
+        create_structure_database(os.path.join(self.directory, 'structures.db'), self.candidates)
+        magma.build_fragment_library(os.path.join(self.directory, 'structures.db'), libfilename, 3, 1, 1)
+        (fragments, nhits,) = self.search('library.db', {'fragment_library': libfilename}, depth_budget=1e-09)
+        self.assertEqual(fragments, expected)
+        self.assertEqual(nhits, expected_nhits)
+        self.assertEqual(set([ fragment[10] for fragment in fragments ]), set([1]))
+
+
+
+    def test_old_database(self):
+        (expected, expected_nhits,) = self.search('new.db')
+        dbfilename = os.path.join(self.directory, 'results.db')
+        magma.MagmaSession(dbfilename).close()
+        remove_columns(dbfilename, {'metabolites': ['skip_reason'],
+         'fragments': ['max_broken_bonds', 'max_water_losses']})
+        # the missing columns are added when the database is opened again
+        (fragments, nhits,) = self.search()
+        self.assertEqual(fragments, expected)
+        self.assertEqual(nhits, expected_nhits)
+
+
+
+    def test_candidate_limits(self):
+        (expected, expected_nhits,) = self.search('full.db')
+        (fragments, nhits,) = self.search(candidate_time_limit=600, candidate_memory_limit=10000)
+        self.assertEqual(fragments, expected)
+        self.assertEqual(nhits, expected_nhits)
+        # the candidates which match a precursor are skipped, the others are not searched
+        (fragments, nhits,) = self.search('time.db', candidate_time_limit=1e-06)
+        self.assertEqual(fragments, [])
+        self.assertEqual(nhits, [ (metid, 0, u'time limit of 1e-06 s exceeded' if metid <= 4 else None) for (metid, expected_hits, skip_reason,) in expected_nhits ])
+        search_structure = magma.search_structure
+
+        def allocating_search_structure(*args, **kwargs):
+            # more than the memory limit, in the worker process
+            numpy.ones(256 * 1048576)
+            return search_structure(*args, **kwargs)
+
+
+
+        magma.search_structure = allocating_search_structure
+        try:
+            (fragments, nhits,) = self.search('memory.db', candidate_memory_limit=100)
+        finally:
+            magma.search_structure = search_structure
+
+        self.assertEqual(fragments, [])
+        self.assertEqual(nhits, [ (metid, 0, u'memory limit of 100 MB exceeded' if metid <= 4 else None) for (metid, expected_hits, skip_reason,) in expected_nhits ])
+
+
+
+    def test_parallel(self):
+        (expected, expected_nhits,) = self.search('serial.db')
+        (fragments, nhits,) = self.search(ncpus=2)
+        self.assertEqual(fragments, expected)
+        self.assertEqual(nhits, expected_nhits)
+        (fragments, nhits,) = self.search('top.db', ncpus=2, annotate_top=1)
+        (top, top_nhits,) = self.search('serial_top.db', annotate_top=1)
+        self.assertEqual(fragments, top)
+        self.assertEqual(nhits, top_nhits)
+        # the workers of the process pool open the fragment cache and library themselves
+        cachefilename = os.path.join(self.directory, 'fragments.cache')
+        for name in ('cache.db', 'cached.db'):
+            (fragments, nhits,) = self.search(name, {'fragment_cache': cachefilename}, ncpus=2)
+            self.assertEqual(fragments, expected)
+            self.assertEqual(nhits, expected_nhits)
+            self.assertEqual(sqlite3.connect(cachefilename).execute('SELECT COUNT(*) FROM fragment_tables').fetchone()[0], 4)
+
+        libfilename = os.path.join(self.directory, 'structures.frag')
+        create_structure_database(os.path.join(self.directory, 'structures.db'), self.candidates)
+        magma.build_fragment_library(os.path.join(self.directory, 'structures.db'), libfilename, 3, 1, 1)
+        (fragments, nhits,) = self.search('library.db', {'fragment_library': libfilename}, ncpus=2)
+        self.assertEqual((fragments, nhits), self.search('serial_library.db', {'fragment_library': libfilename}))
+        # the supervised workers are started from a pool of threads
+        (fragments, nhits,) = self.search('limits.db', ncpus=2, candidate_time_limit=600)
+        self.assertEqual(fragments, expected)
+        self.assertEqual(nhits, expected_nhits)
+
+
+
+    def test_prefilter(self):
+        (expected, expected_nhits,) = self.search('full.db')
+        (fragments, nhits,) = self.search('all.db', prefilter_top=10)
+        self.assertEqual(fragments, expected)
+        self.assertEqual(nhits, expected_nhits)
+        (shallow, shallow_nhits,) = self.search('shallow.db', {'max_broken_bonds': 2, 'max_water_losses': 0})
+        (fragments, nhits,) = self.search(prefilter_top=1, prefilter_broken_bonds=2)
+        self.assertEqual(nhits, expected_nhits)
+        # the other candidates keep their hits of the shallow search, annotated afterwards
+        top = set([ fragment[0] for fragment in fragments if fragment[10] == 3 ])
+        # glucose and fructose are tied
+        self.assertEqual(top, set([1, 2, 4]))
+        self.assertEqual([ fragment for fragment in fragments if fragment[0] in top ], [ fragment for fragment in expected if fragment[0] in top ])
+        self.assertEqual([ fragment[:10] + fragment[12:] for fragment in fragments if fragment[0] not in top ], [ fragment[:10] + fragment[12:] for fragment in shallow if fragment[0] not in top ])
+        self.assertEqual(set([ fragment[10:12] for fragment in fragments if fragment[0] not in top ]), set([(2, 0)]))
+        # with the same pool and limits as the full search
+        (parallel, parallel_nhits,) = self.search('parallel.db', prefilter_top=1, prefilter_broken_bonds=2, ncpus=2)
+        self.assertEqual(parallel, fragments)
+        self.assertEqual(parallel_nhits, nhits)
+        # not with candidate limits, the reactant would be fragmented outside them
+        get_parent_engine = magma.get_parent_engine
+        magma.get_parent_engine = None
+        try:
+            (limited, limited_nhits,) = self.search('limited.db', reuse_parent_fragments=True, candidate_time_limit=600)
+        finally:
+            magma.get_parent_engine = get_parent_engine
+
+        self.assertEqual(limited, expected)
+        self.assertEqual(limited_nhits, expected_nhits)
+        (fragments, nhits,) = self.search('time.db', prefilter_top=1, candidate_time_limit=1e-06)
+        self.assertEqual(fragments, [])
+        self.assertEqual(nhits, [ (metid, 0, u'time limit of 1e-06 s exceeded' if metid <= 4 else None) for (metid, expected_hits, skip_reason,) in expected_nhits ])
+
+
+
+
+
+class TestParentFragments(AnnotateTestCase):
+    trees = ('feruloylquinic acid', 'hydroxychlorogenic acid')
+    candidates = ('chlorogenic acid', 'feruloylquinic acid', 'hydroxychlorogenic acid')
+    reactions = (('chlorogenic acid', 'feruloylquinic acid', 'methylation'), ('chlorogenic acid', 'hydroxychlorogenic acid', 'hydroxylation'))
+
+    def test_reuse_parent_fragments(self):
+        (expected, expected_nhits,) = self.search('full.db')
+        (fragments, nhits,) = self.search(reuse_parent_fragments=True)
+        self.assertEqual(nhits, expected_nhits)
+        self.assertEqual(fragments, expected)
+        # the workers make the parent engines themselves
+        (parallel, parallel_nhits,) = self.search('parallel.db', reuse_parent_fragments=True, ncpus=2)
+        self.assertEqual(parallel, fragments)
+        self.assertEqual(parallel_nhits, nhits)
+        # not with candidate limits, the reactant would be fragmented outside them
+        get_parent_engine = magma.get_parent_engine
+        magma.get_parent_engine = None
+        try:
+            (limited, limited_nhits,) = self.search('limited.db', reuse_parent_fragments=True, candidate_time_limit=600)
+        finally:
+            magma.get_parent_engine = get_parent_engine
+
+        self.assertEqual(limited, expected)
+        self.assertEqual(limited_nhits, expected_nhits)
+
+
+
+
+
+class TestMergeResults(AnnotateTestCase):
+
+    def get_results(self, name):
+        """Returns the fragments, hits and InChIKeys of the candidates in database name"""
+        magma_session = magma.MagmaSession(os.path.join(self.directory, name))
+        results = (get_fragments(magma_session.db_session), get_nhits(magma_session.db_session), sorted(magma_session.db_session.query(Metabolite.metid, Metabolite.smiles).all()))
+        magma_session.close()
+        return results
+
+
+
+    def test_merge_shards(self):
+        self.search('full.db')
+        self.search('shard1.db', shard=(1, 2))
+        self.search('shard2.db', shard=(2, 2))
+        self.get_session().close()
+        dbfilename = os.path.join(self.directory, 'results.db')
+        shard_dbfilenames = [ os.path.join(self.directory, name) for name in ('shard1.db', 'shard2.db') ]
+        nfragments = magma.merge_results(dbfilename, shard_dbfilenames)
+        expected = self.get_results('full.db')
+        self.assertEqual(self.get_results('results.db'), expected)
+        self.assertEqual(nfragments, len(expected[0]))
+        # the candidates are annotated already
+        self.assertEqual(magma.merge_results(dbfilename, shard_dbfilenames), 0)
+        self.assertEqual(self.get_results('results.db'), expected)
+
+
+
+    def test_metid_collision(self):
+        # a candidate only found in the shard, with the metid of another candidate in the database merged into
+        self.get_session(candidates=('glucose', 'chlorogenic acid')).close()
+        for (name, candidates,) in (('shard.db', ('glucose', 'fructose', 'chlorogenic acid')), ('full.db', ('glucose', 'chlorogenic acid', 'fructose'))):
+            magma_session = self.get_session(name, candidates)
+            self.get_annotate_engine(magma_session).search_structures()
+            magma_session.close()
+
+        magma.merge_results(os.path.join(self.directory, 'results.db'), [os.path.join(self.directory, 'shard.db')])
+        self.assertEqual(self.get_results('results.db'), self.get_results('full.db'))
+
+
+
+
+
+class TestDepthPolicy(unittest.TestCase):
+
+    def test_choose_depth(self):
+        molblock = get_molblock('chlorogenic acid')
+        policy = magma.DepthPolicy(3, 1, 1000.0, 10)
+        costs = [ policy.estimate_cost(molblock, max_broken_bonds) for max_broken_bonds in range(4) ]
+        self.assertEqual(costs, sorted(set(costs)))
+        self.assertEqual(policy.choose_depth(molblock), 3)
+        self.assertEqual(magma.DepthPolicy(3, 1, 1e-09, 10).choose_depth(molblock), 1)
+        # a share of the budget which fits 2 broken bonds, at the initial time per unit of cost
+        policy = magma.DepthPolicy(3, 1, 20 * costs[2] * policy.seconds_per_cost, 10)
+        self.assertEqual(policy.choose_depth(molblock), 2)
+        # slower than expected, which leaves 1 broken bond for the next candidates
+        policy.add_candidate(molblock, 2, 5 * costs[2] * policy.seconds_per_cost)
+        self.assertEqual(policy.ncandidates, 9)
+        self.assertEqual(policy.choose_depth(molblock), 1)
+        policy.skip_candidate()
+        self.assertEqual(policy.ncandidates, 8)
+
+
+
+    def test_molblock_formats(self):
+        molblock = get_molblock('chlorogenic acid')
+        policy = magma.DepthPolicy(3, 1, 1000.0, 10)
+        expected = policy.estimate_cost(molblock, 2)
+        mol = Chem.MolFromMolBlock(molblock)
+        self.assertEqual(policy.estimate_cost(Chem.MolToV3KMolBlock(mol), 2), expected)
+        # without a counts line the candidate gets the maximum depth, and does not count for the time per cost
+        policy = magma.DepthPolicy(3, 1, 1e-09, 10)
+        self.assertEqual(policy.estimate_cost('chlorogenic acid\n', 2), None)
+        self.assertEqual(policy.choose_depth('chlorogenic acid\n'), 3)
+        policy.add_candidate('chlorogenic acid\n', 3, 10.0)
+        self.assertEqual((policy.ncandidates, policy.spent_time, policy.spent_cost,), (9, 10.0, 0))
+        self.assertEqual(policy.seconds_per_cost, 5e-05)
+
+
+
+
+
+class TestMatchPrecursors(AnnotateTestCase):
+    # with a hydrogen atom which is kept in the molecule, so it has more atoms than heavy atoms
+    candidates = ('deuterated glucose', 'fructose', 'inositol', 'chlorogenic acid', 'phenylalanine', 'choline')
+
+    def setUp(self):
+        molecules['deuterated glucose'] = '[2H]OC[C@H]1OC(O)[C@H](O)[C@@H](O)[C@@H]1O'
+        AnnotateTestCase.setUp(self)
+
+
+
+    def test_match_precursors(self):
+        (fragments, nhits,) = self.search(engine_kwargs={'skip_fragmentation': True})
+        # the hits of search_structure for each candidate, as when the fragmentation is not skipped
+        magma_session = self.get_session('expected.db')
+        annotate_engine = self.get_annotate_engine(magma_session, skip_fragmentation=True)
+        magma.fragid = 0
+        for structure in magma_session.db_session.query(Metabolite).all():
+            molcharge = annotate_engine.get_molcharge(structure.molformula)
+            peaks = annotate_engine.get_candidate_peaks(structure.mim, molcharge)
+            (hits, frags,) = magma.search_structure(structure.mol, structure.mim, molcharge, peaks, 3, 1, annotate_engine.precision, annotate_engine.mz_precision_abs, False, 1, True, False, magma.config.get('magma job', 'chemical_engine'), annotate_engine.ions)
+            structure.nhits = len(hits)
+            # with the formula and InChIKey of the candidate
+            hits_left = list(hits)
+            while len(hits_left) > 0:
+                hit = hits_left.pop()
+                (hit.formula, hit.inchikey,) = (structure.molformula, structure.smiles)
+                hits_left.extend(hit.besthits)
+
+            for hit in hits:
+                annotate_engine.store_hit(hit, structure.metid, 0, 3)
+
+
+        magma_session.commit()
+        self.assertEqual(fragments, get_fragments(magma_session.db_session))
+        self.assertEqual(nhits, get_nhits(magma_session.db_session))
+        self.assertEqual(len([ fragment for fragment in fragments if fragment[0] == 1 and fragment[4].count(',') == 13 ]), 2)
+        # stopped after the first candidate matched
+        (fragments, nhits,) = self.search('time.db', {'skip_fragmentation': True}, time_limit=1e-09)
+        self.assertEqual(len(set([ fragment[0] for fragment in fragments ])), 1)
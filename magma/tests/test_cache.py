@@ -0,0 +1,262 @@
+"""
+Tests of the fragment cache and the fragment library.
+"""
+import unittest
+import tempfile
+import shutil
+import os
+import zlib
+import sqlite3
+import time
+import cPickle as pickle
+import magma
+from magma import types
+from magma import fragmentation_py
+from magma import fragmentation_cy
+from magma.fragmentation_py import Chem
+from magma.tests.test_fragmentation import get_molblock, generate, get_fragments, get_ion_masses, get_peaks, search
+
+def create_structure_database(dbfilename, names):
+    """Creates a structure database of molecules names, as read by the query engines, returns their InChIKeys and charges"""
+    conn = sqlite3.connect(dbfilename)
+    conn.execute('CREATE TABLE molecules (id TEXT PRIMARY KEY, mim INTEGER NOT NULL, charge INTEGER NOT NULL, natoms INTEGER NOT NULL, molblock BLOB, inchikey TEXT, molform TEXT, name TEXT, reference TEXT, logp INT)')
+    molecules = {}
+    for name in names:
+        molecule = types.MoleculeType(get_molblock(name), name, None, 1)
+        molcharge = 1 * (molecule.molformula[-1] == '+')
+        conn.execute('INSERT INTO molecules VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (name, int(molecule.mim * 1000000.0), molcharge, molecule.natoms, sqlite3.Binary(zlib.compress(molecule.molblock)), molecule.inchikey, molecule.molformula, name, name, int(molecule.logp * 10)))
+        molecules[name] = (molecule.inchikey, molcharge)
+
+    conn.commit()
+    conn.close()
+    return molecules
+
+
+
+class TestFragmentCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dbfilename = os.path.join(self.directory, 'cache.db')
+
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+
+    def get_key(self, cache, name, max_broken_bonds = 3, max_water_losses = 1, ionisation_mode = 1, molcharge = 0, symmetry = False):
+        return cache.get_key(name, get_molblock(name), max_broken_bonds, max_water_losses, ionisation_mode, False, molcharge, symmetry)
+
+
+
+    def test_round_trip(self):
+        engine = generate(fragmentation_py, 'chlorogenic acid', 3, 1)
+        cache = magma.FragmentCache(self.dbfilename)
+        key = self.get_key(cache, 'chlorogenic acid')
+        self.assertEqual(cache.get(key), None)
+        cache.put(key, engine.get_fragment_table())
+        # read back by another connection, as by another job
+        cache = magma.FragmentCache(self.dbfilename)
+        cached_engine = fragmentation_py.FragmentEngine(get_molblock('chlorogenic acid'), 3, 1, 1, False, 0)
+        self.assertEqual(cached_engine.set_fragment_table(cache.get(key)), len(engine.fragment_info))
+        self.assertEqual(get_fragments(cached_engine), get_fragments(engine))
+        self.assertEqual(get_ion_masses(cached_engine), get_ion_masses(engine))
+        molecule = (1 << engine.natoms) - 1
+        for mass in engine.fragment_masses_np[::25]:
+            self.assertEqual(cached_engine.find_fragments(mass, molecule, 1 + 5e-06, 0.001), engine.find_fragments(mass, molecule, 1 + 5e-06, 0.001))
+
+
+
+    def test_key(self):
+        cache = magma.FragmentCache(self.dbfilename)
+        key = self.get_key(cache, 'glucose')
+        self.assertEqual(self.get_key(cache, 'glucose'), key)
+        self.assertNotEqual(self.get_key(cache, 'glucose', max_broken_bonds=2), key)
+        self.assertNotEqual(self.get_key(cache, 'glucose', max_water_losses=2), key)
+        self.assertNotEqual(self.get_key(cache, 'glucose', ionisation_mode=-1), key)
+        self.assertNotEqual(self.get_key(cache, 'glucose', molcharge=1), key)
+        self.assertNotEqual(self.get_key(cache, 'glucose', symmetry=True), key)
+        # the same molecule, with another atom numbering
+        renumbered = Chem.MolToMolBlock(Chem.SmilesToMol('O[C@@H]1O[C@H](CO)[C@@H](O)[C@H](O)[C@H]1O', 'glucose'))
+        self.assertNotEqual(cache.get_key('glucose', renumbered, 3, 1, 1, False, 0), key)
+
+
+
+    def test_eviction(self):
+        fragment_table = generate(fragmentation_py, 'glucose', 3, 1).get_fragment_table()
+        size = len(zlib.compress(pickle.dumps(fragment_table, 2)))
+        # room for two tables
+        cache = magma.FragmentCache(self.dbfilename, 2.5 * size / 1000000.0)
+        cache.touch_interval = 0
+        keys = [ self.get_key(cache, 'glucose', max_broken_bonds) for max_broken_bonds in (1, 2, 3) ]
+        cache.put(keys[0], fragment_table)
+        cache.put(keys[1], fragment_table)
+        # the first table is used, so the second one is now the least recently used
+        cache.get(keys[0])
+        cache.put(keys[2], fragment_table)
+        self.assertNotEqual(cache.get(keys[0]), None)
+        self.assertEqual(cache.get(keys[1]), None)
+        self.assertNotEqual(cache.get(keys[2]), None)
+
+
+
+    def test_last_used(self):
+        fragment_table = generate(fragmentation_py, 'glucose', 3, 1).get_fragment_table()
+        cache = magma.FragmentCache(self.dbfilename)
+        key = self.get_key(cache, 'glucose')
+        cache.put(key, fragment_table)
+        get_last_used = lambda : cache.c.execute('SELECT last_used FROM fragment_tables').fetchone()[0]
+        last_used = get_last_used()
+        # not updated on each read
+        cache.get(key)
+        self.assertEqual(get_last_used(), last_used)
+        cache.c.execute('UPDATE fragment_tables SET last_used = ?', (last_used - cache.touch_interval,))
+        cache.conn.commit()
+        # nor while another job is writing, the table is read without waiting for it
+        conn = sqlite3.connect(self.dbfilename)
+        conn.execute('BEGIN IMMEDIATE')
+        start = time.time()
+        self.assertNotEqual(cache.get(key), None)
+        self.assertTrue(time.time() - start < 10)
+        self.assertEqual(get_last_used(), last_used - cache.touch_interval)
+        conn.rollback()
+        conn.close()
+        self.assertNotEqual(cache.get(key), None)
+        self.assertTrue(get_last_used() >= last_used)
+
+
+
+    def test_search_structure(self):
+        peaks = get_peaks(generate(fragmentation_py, 'chlorogenic acid', 3, 1))
+        (expected, frags,) = search('chlorogenic acid', 3, 1, peaks)
+        cache = magma.FragmentCache(self.dbfilename)
+        self.assertEqual(search('chlorogenic acid', 3, 1, peaks, fragment_cache=cache), (expected, frags))
+        key = self.get_key(cache, 'chlorogenic acid')
+        self.assertNotEqual(cache.get(key), None)
+        # the second search uses the cached fragment table
+        self.assertEqual(search('chlorogenic acid', 3, 1, peaks, fragment_cache=cache), (expected, frags))
+
+
+
+    def test_beam_search(self):
+        peaks = get_peaks(generate(fragmentation_py, 'chlorogenic acid', 3, 1))
+        cache = magma.FragmentCache(self.dbfilename)
+        (beam_max_atoms, beam_width,) = (fragmentation_py.beam_max_atoms, fragmentation_py.beam_width)
+        (fragmentation_py.beam_max_atoms, fragmentation_py.beam_width,) = (20, 10)
+        try:
+            (expected, frags,) = search('chlorogenic acid', 3, 1, peaks)
+            self.assertEqual(search('chlorogenic acid', 3, 1, peaks, fragment_cache=cache), (expected, frags))
+            # beam search tables are cached apart from exhaustive ones
+            self.assertEqual(cache.get(self.get_key(cache, 'chlorogenic acid')), None)
+            key = cache.get_key('chlorogenic acid', get_molblock('chlorogenic acid'), 3, 1, 1, False, 0, False, 10)
+            self.assertNotEqual(cache.get(key), None)
+            self.assertEqual(search('chlorogenic acid', 3, 1, peaks, fragment_cache=cache), (expected, frags))
+        finally:
+            (fragmentation_py.beam_max_atoms, fragmentation_py.beam_width,) = (beam_max_atoms, beam_width)
+
+        self.assertNotEqual(search('chlorogenic acid', 3, 1, peaks, fragment_cache=cache)[1], frags)
+
+
+
+    def test_truncated_table(self):
+        cache = magma.FragmentCache(self.dbfilename)
+        peaks = get_peaks(generate(fragmentation_py, 'chlorogenic acid', 3, 1))
+        max_memory = fragmentation_py.max_memory
+        fragmentation_py.max_memory = 0.05
+        try:
+            search('chlorogenic acid', 3, 1, peaks, fragment_cache=cache)
+        finally:
+            fragmentation_py.max_memory = max_memory
+
+        # tables truncated at the memory limit are not cached
+        self.assertEqual(cache.get(self.get_key(cache, 'chlorogenic acid')), None)
+
+
+
+
+class TestFragmentLibrary(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dbfilename = os.path.join(self.directory, 'structures.db')
+        self.libfilename = os.path.join(self.directory, 'structures.frag')
+        self.molecules = create_structure_database(self.dbfilename, ('glucose', 'chlorogenic acid', 'choline'))
+
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+
+    def assertFragmentArraysEqual(self, fragment_arrays, engine):
+        (fragments, masses, scores, bondbreaks,) = fragment_arrays
+        (expected_fragments, expected_masses, expected_scores, expected_bondbreaks,) = engine.get_fragment_arrays()
+        self.assertEqual(list(fragments), list(expected_fragments))
+        self.assertEqual(masses.tolist(), expected_masses.tolist())
+        self.assertEqual(scores.tolist(), expected_scores.tolist())
+        self.assertEqual(bondbreaks.tolist(), expected_bondbreaks.tolist())
+
+
+
+    def test_round_trip(self):
+        for (ncpus, fast,) in ((1, False), (2, False), (1, True)):
+            self.assertEqual(magma.build_fragment_library(self.dbfilename, self.libfilename, 3, 1, 1, ncpus, fast), 3)
+            library = magma.FragmentLibrary(self.libfilename)
+            self.assertTrue(library.compatible(3, 1, 1))
+            for (name, (inchikey, molcharge,),) in self.molecules.items():
+                engine = generate(fragmentation_py, name, 3, 1, 1, molcharge)
+                fragment_arrays = library.get_fragments(inchikey, get_molblock(name), molcharge)
+                self.assertFragmentArraysEqual(fragment_arrays, engine)
+                library_engine = fragmentation_py.FragmentEngine(get_molblock(name), 3, 1, 1, False, molcharge)
+                library_engine.set_fragment_arrays(*fragment_arrays)
+                self.assertEqual(get_ion_masses(library_engine), get_ion_masses(engine))
+
+
+
+    def test_beam_search(self):
+        (beam_max_atoms, beam_width,) = (fragmentation_py.beam_max_atoms, fragmentation_py.beam_width)
+        (fragmentation_py.beam_max_atoms, fragmentation_py.beam_width,) = (20, 10)
+        try:
+            self.assertEqual(magma.build_fragment_library(self.dbfilename, self.libfilename, 3, 1, 1), 3)
+            library = magma.FragmentLibrary(self.libfilename)
+            self.assertTrue(library.compatible(3, 1, 1))
+            (inchikey, molcharge,) = self.molecules['chlorogenic acid']
+            engine = generate(fragmentation_py, 'chlorogenic acid', 3, 1, 1, molcharge)
+            self.assertTrue(len(engine.fragment_info) < len(generate(fragmentation_py, 'chlorogenic acid', 3, 1, 1, molcharge, beam=0).fragment_info))
+            self.assertFragmentArraysEqual(library.get_fragments(inchikey, get_molblock('chlorogenic acid'), molcharge), engine)
+        finally:
+            (fragmentation_py.beam_max_atoms, fragmentation_py.beam_width,) = (beam_max_atoms, beam_width)
+
+        # nor used without the beam search
+        self.assertFalse(library.compatible(3, 1, 1))
+
+
+
+    def test_lookup(self):
+        magma.build_fragment_library(self.dbfilename, self.libfilename, 3, 1, 1)
+        library = magma.FragmentLibrary(self.libfilename)
+        (inchikey, molcharge,) = self.molecules['glucose']
+        self.assertEqual(library.get_fragments('XXXXXXXXXXXXXX', get_molblock('glucose'), molcharge), None)
+        self.assertEqual(library.get_fragments(inchikey, get_molblock('glucose'), 1 - molcharge), None)
+        # the same molecule, with another atom numbering
+        renumbered = Chem.MolToMolBlock(Chem.SmilesToMol('O[C@@H]1O[C@H](CO)[C@@H](O)[C@H](O)[C@H]1O', 'glucose'))
+        self.assertEqual(library.get_fragments(inchikey, renumbered, molcharge), None)
+        self.assertFalse(library.compatible(2, 1, 1))
+        self.assertFalse(library.compatible(3, 2, 1))
+        self.assertFalse(library.compatible(3, 1, -1))
+
+
+
+    def test_search_structure(self):
+        magma.build_fragment_library(self.dbfilename, self.libfilename, 3, 1, 1)
+        library = magma.FragmentLibrary(self.libfilename)
+        (inchikey, molcharge,) = self.molecules['chlorogenic acid']
+        peaks = get_peaks(generate(fragmentation_py, 'chlorogenic acid', 3, 1))
+        (expected, frags,) = search('chlorogenic acid', 3, 1, peaks, inchikey=inchikey)
+        (hits, library_frags,) = search('chlorogenic acid', 3, 1, peaks, fragment_library=library, inchikey=inchikey)
+        self.assertEqual(library_frags, frags)
+        self.assertEqual(len(hits), 1)
+        self.assertEqual(hits, expected)
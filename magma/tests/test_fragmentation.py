@@ -0,0 +1,495 @@
+"""
+Tests of the fragment engines, against the baseline FragmentEngine (see baseline.py).
+"""
+import unittest
+import numpy
+import magma
+from magma import pars
+from magma import types
+from magma import fragmentation_py
+from magma import fragmentation_cy
+from magma.fragmentation_py import Chem
+from magma.tests import baseline
+
+molecules = {'glucose': 'OC[C@H]1O[C@@H](O)[C@H](O)[C@@H](O)[C@@H]1O',
+ 'chlorogenic acid': 'O=C(/C=C/c1ccc(O)c(O)c1)O[C@@H]1C[C@](O)(C(=O)O)C[C@@H](O)[C@H]1O',
+ 'phenylalanine': 'N[C@@H](Cc1ccccc1)C(=O)O',
+ 'choline': 'C[N+](C)(C)CCO',
+ 'citric acid': 'OC(=O)CC(O)(CC(O)=O)C(O)=O',
+ 'feruloylquinic acid': 'O=C(/C=C/c1ccc(O)c(OC)c1)O[C@@H]1C[C@](O)(C(=O)O)C[C@@H](O)[C@H]1O',
+ 'hydroxychlorogenic acid': 'O=C(/C=C/c1cc(O)c(O)c(O)c1)O[C@@H]1C[C@](O)(C(=O)O)C[C@@H](O)[C@H]1O',
+ 'glycolipid': 'CCCCCCCCCCCCCCCCCC(=O)OC[C@H](CO[C@@H]1O[C@H](CO)[C@@H](O)[C@H](O)[C@H]1O[C@@H]1O[C@H](CO)[C@@H](O)[C@H](O)[C@H]1O)OC(=O)CCCCCCC/C=C\\CCCCCCCC'}
+molblocks = {}
+
+def get_molblock(name):
+    if name not in molblocks:
+        molblocks[name] = Chem.MolToMolBlock(Chem.SmilesToMol(molecules[name], name))
+    return molblocks[name]
+
+
+
+def generate(module, name, max_broken_bonds, max_water_losses, ionisation_mode = 1, molcharge = 0, **kwargs):
+    """Returns a FragmentEngine of module for molecule name, with its fragments generated"""
+    engine = module.FragmentEngine(get_molblock(name), max_broken_bonds, max_water_losses, ionisation_mode, False, molcharge)
+    engine.generate_fragments(**kwargs)
+    return engine
+
+
+
+def get_fragments(engine):
+    """Returns the fragment table of engine as sorted (fragment, score, bondbreaks, mass) tuples"""
+    return sorted([ (fragment, round(score, 6), bondbreaks, round(mass, 6)) for ((fragment, score, bondbreaks,), mass,) in zip(engine.fragment_info[1:], engine.fragment_mass_np[1:]) ])
+
+
+
+def get_baseline_fragments(engine):
+    """Returns the fragment table of a baseline engine as get_fragments does"""
+    return sorted([ (fragment, round(score, 6), bondbreaks, round(engine.calc_fragment_mass(fragment), 6)) for (fragment, score, bondbreaks,) in engine.fragment_info[1:] ])
+
+
+
+def get_ion_masses(engine):
+    """Returns the ion masses of the fragment table of engine as sorted (fragment, deltaH, mass) tuples"""
+    return sorted([ (engine.fragment_info[fid][0], int(deltaH), round(mass, 6)) for (mass, fid, deltaH,) in zip(engine.fragment_masses_np, engine.fragment_mass_ids_np, engine.fragment_mass_deltaH_np) ])
+
+
+
+def get_baseline_ion_masses(engine):
+    """Returns the ion masses of a baseline engine as get_ion_masses does, from its table with a column per deltaH"""
+    ion_masses = []
+    for fid in range(1, len(engine.fragment_info)):
+        for (column, mass,) in enumerate(engine.fragment_masses_np[fid]):
+            if mass != 0:
+                deltaH = engine.ionisation_mode * (1 - engine.molcharge) + column - engine.max_broken_bonds - engine.max_water_losses
+                ion_masses.append((engine.fragment_info[fid][0], deltaH, round(mass, 6)))
+
+    return sorted(ion_masses)
+
+
+
+def get_found_fragments(fragment_set):
+    """Returns the result of find_fragments as sorted tuples, rounded"""
+    return sorted([ (fragment, round(score, 6), bondbreaks, round(mass, 6), int(deltaH)) for (fragment, score, bondbreaks, mass, deltaH,) in fragment_set ])
+
+
+
+def get_peaks(engine, npeaks = 12):
+    """Returns a precursor peak of the molecule of engine, with an MS2 scan of npeaks of its fragment ions"""
+    ionisation_mode = engine.ionisation_mode
+    mim = engine.calc_fragment_mass((1 << engine.natoms) - 1)
+    intensity = 10000000.0
+    peak = types.PeakType(mim + ionisation_mode * (pars.Hmass - pars.elmass), intensity, 1, pars.missingfragmentpenalty * intensity ** 0.5)
+    peak.childscan = types.ScanType(2, 2)
+    masses = numpy.unique(engine.fragment_masses_np)
+    masses = masses[masses > 50]
+    for mass in masses[::max(1, len(masses) // npeaks)]:
+        intensity = 100000.0
+        childpeak = types.PeakType(mass - ionisation_mode * pars.elmass, intensity, 2, pars.missingfragmentpenalty * intensity ** 0.5)
+        peak.childscan.peaks.append(childpeak)
+        peak.missing_fragment_score += childpeak.missing_fragment_score
+
+    return [peak]
+
+
+
+def get_ions(ionisation_mode = 1):
+    """Returns the ions of AnnotateEngine.generate_ions for the protonated or deprotonated molecule"""
+    if ionisation_mode == 1:
+        return [{0: ''}, {pars.ionmasses[1]['+H']: '[M+H]+'}]
+    return [{0: ''}, {pars.ionmasses[-1]['-H']: '[M-H]-'}]
+
+
+
+def get_hits(hits):
+    """Returns the hits of search_structure as nested tuples, rounded, to compare them"""
+    return [ (hit.scan, round(hit.mz, 6), round(hit.score, 6), hit.fragment, hit.breaks, round(hit.mass, 6), round(hit.deltaH, 6), hit.atomstring, hit.formula, hit.inchikey, hit.ion, get_hits(hit.besthits)) for hit in hits ]
+
+
+
+def search(name, max_broken_bonds, max_water_losses, peaks, ionisation_mode = 1, fast = False, **kwargs):
+    """Matches molecule name with peaks, returns the hits of search_structure as get_hits does, and the number of fragments"""
+    molblock = get_molblock(name)
+    engine = fragmentation_py.FragmentEngine(molblock, 0, 0, ionisation_mode, False, 0)
+    mim = engine.calc_fragment_mass((1 << engine.natoms) - 1)
+    kwargs.setdefault('inchikey', name)
+    (hits, frags,) = magma.search_structure(molblock, mim, 0, peaks, max_broken_bonds, max_water_losses, 1 + 5e-06, 0.001, False, ionisation_mode, False, fast, 'rdkit', get_ions(ionisation_mode), **kwargs)
+    return (get_hits(hits), frags)
+
+
+
+def get_baseline_child_fragments(engine, fragment):
+    """Returns the fragments which remain after removing each atom of fragment, with the recursive extend of a baseline engine"""
+    children = []
+    for atom in range(engine.natoms):
+        if 1 << atom & fragment:
+            engine.template_fragment = fragment ^ 1 << atom
+            ext_atoms = [ a for a in engine.bonded_atoms[atom] if 1 << a & engine.template_fragment ]
+            if len(ext_atoms) == 1:
+                children.append(engine.template_fragment)
+            else:
+                extended_fragments = []
+                for a in ext_atoms:
+                    if not [ frag for frag in extended_fragments if 1 << a & frag ]:
+                        engine.new_fragment = 1 << a
+                        engine.extend(a)
+                        extended_fragments.append(engine.new_fragment)
+
+                children.extend(extended_fragments)
+
+    return sorted(children)
+
+
+
+class TestFragmentEngine(unittest.TestCase):
+
+    def test_fragments_equal_baseline(self):
+        for name in ('glucose', 'chlorogenic acid', 'phenylalanine'):
+            for ionisation_mode in (1, -1):
+                expected = get_baseline_fragments(generate(baseline, name, 3, 1, ionisation_mode))
+                self.assertEqual(get_fragments(generate(fragmentation_py, name, 3, 1, ionisation_mode)), expected)
+
+
+
+    def test_charged_molecule(self):
+        expected = get_baseline_fragments(generate(baseline, 'choline', 3, 1, 1, 1))
+        self.assertEqual(get_fragments(generate(fragmentation_py, 'choline', 3, 1, 1, 1)), expected)
+
+
+
+    def test_ion_masses_equal_baseline(self):
+        for (name, ionisation_mode, molcharge,) in (('chlorogenic acid', 1, 0), ('chlorogenic acid', -1, 0), ('choline', 1, 1)):
+            expected = get_baseline_ion_masses(generate(baseline, name, 3, 1, ionisation_mode, molcharge))
+            self.assertEqual(get_ion_masses(generate(fragmentation_py, name, 3, 1, ionisation_mode, molcharge)), expected)
+
+
+
+    def test_growable_array(self):
+        array = fragmentation_py.GrowableArray(numpy.float64, 2)
+        values = []
+        for i in range(10):
+            array.append(i * 0.5)
+            values.append(i * 0.5)
+
+        array.extend([1.0, 2.0, 3.0])
+        values.extend([1.0, 2.0, 3.0])
+        self.assertEqual(len(array), len(values))
+        self.assertEqual(array.array().tolist(), values)
+
+
+
+    def test_score_fragments(self):
+        ref = generate(baseline, 'chlorogenic acid', 3, 1)
+        engine = generate(fragmentation_py, 'chlorogenic acid', 3, 1)
+        fragments = [ fragment for (fragment, score, bondbreaks,) in ref.fragment_info[1:] if bondbreaks > 0 ]
+        (bondbreaks, scores,) = engine.score_fragments(fragments)
+        for (fragment, fragment_bondbreaks, score,) in zip(fragments, bondbreaks, scores):
+            (expected_bondbreaks, expected_score,) = ref.score_fragment(fragment)
+            self.assertEqual(fragment_bondbreaks, expected_bondbreaks)
+            self.assertAlmostEqual(score, expected_score)
+
+
+
+    def test_more_than_64_atoms(self):
+        expected = get_baseline_fragments(generate(baseline, 'glycolipid', 2, 1))
+        engine = generate(fragmentation_py, 'glycolipid', 2, 1)
+        self.assertTrue(engine.natoms > 64)
+        self.assertEqual(get_fragments(engine), expected)
+
+
+
+    def test_child_fragments(self):
+        ref = generate(baseline, 'chlorogenic acid', 2, 0)
+        engine = generate(fragmentation_py, 'chlorogenic acid', 0, 0)
+        for (fragment, score, bondbreaks,) in ref.fragment_info[1:]:
+            self.assertEqual(sorted(engine.get_child_fragments(fragment)), get_baseline_child_fragments(ref, fragment))
+
+
+
+    def test_find_fragments_equals_baseline(self):
+        ref = generate(baseline, 'chlorogenic acid', 3, 1)
+        engine = generate(fragmentation_py, 'chlorogenic acid', 3, 1)
+        molecule = (1 << engine.natoms) - 1
+        masses = []
+        for mass in numpy.unique(engine.fragment_masses_np)[::10]:
+            masses.extend([mass, mass + 0.0009, mass - 0.002])
+
+        for (precision, mz_precision_abs,) in ((1 + 5e-06, 0.001), (1 + 2e-05, 0.0)):
+            fragment_sets = engine.find_fragments_batch(masses, molecule, precision, mz_precision_abs)
+            for (mass, fragment_set,) in zip(masses, fragment_sets):
+                expected = get_found_fragments(ref.find_fragments(mass, molecule, precision, mz_precision_abs))
+                self.assertEqual(get_found_fragments(fragment_set), expected)
+                self.assertEqual(get_found_fragments(engine.find_fragments(mass, molecule, precision, mz_precision_abs)), expected)
+
+
+
+    def test_find_fragments_order(self):
+        # tables from a parent, cache or library are in another order than generated ones
+        engine = generate(fragmentation_py, 'chlorogenic acid', 3, 1)
+        (fragments, fragment_masses, scores, bondbreaks,) = engine.get_fragment_arrays()
+        order = numpy.random.RandomState(1).permutation(len(fragments))
+        shuffled = fragmentation_py.FragmentEngine(get_molblock('chlorogenic acid'), 3, 1, 1, False, 0)
+        shuffled.set_fragment_arrays([ fragments[i] for i in order ], fragment_masses[order], scores[order], bondbreaks[order])
+        masses = numpy.unique(engine.fragment_masses_np)[::5]
+        for parent in ((1 << engine.natoms) - 1, max(fragments)):
+            fragment_sets = engine.find_fragments_batch(masses, parent, 1 + 5e-06, 0.001)
+            self.assertEqual(shuffled.find_fragments_batch(masses, parent, 1 + 5e-06, 0.001), fragment_sets)
+            for fragment_set in fragment_sets:
+                self.assertEqual([ (fragment[0], fragment[4]) for fragment in fragment_set ], sorted([ (fragment[0], fragment[4]) for fragment in fragment_set ]))
+
+
+
+    def test_find_descendants_equals_baseline(self):
+        # the glycolipid has fragments of more than one word
+        for (name, max_broken_bonds,) in (('chlorogenic acid', 3), ('glycolipid', 2)):
+            ref = generate(baseline, name, max_broken_bonds, 1)
+            engine = generate(fragmentation_py, name, max_broken_bonds, 1)
+            masses = numpy.unique(engine.fragment_masses_np)[1::7]
+            for (parent, score, bondbreaks,) in ref.fragment_info[1::max(1, len(ref.fragment_info) // 20)]:
+                fragment_sets = engine.find_fragments_batch(masses, parent, 1 + 5e-06, 0.001)
+                for (mass, fragment_set,) in zip(masses, fragment_sets):
+                    expected = get_found_fragments([ fragment for fragment in ref.find_fragments(mass, parent, 1 + 5e-06, 0.001) if fragment[0] & parent == fragment[0] ])
+                    self.assertEqual(get_found_fragments(fragment_set), expected)
+
+
+
+    def test_fragment_info_equals_baseline(self):
+        ref = generate(baseline, 'chlorogenic acid', 3, 1)
+        engine = generate(fragmentation_py, 'chlorogenic acid', 3, 1)
+        fragments = [ fragment for (fragment, score, bondbreaks,) in ref.fragment_info[1::5] ]
+        engine.get_fragments_info(fragments[::2])
+        for fragment in fragments:
+            self.assertEqual(engine.get_fragment_info(fragment, 0), ref.get_fragment_info(fragment, 0))
+
+
+
+    def test_pruned_fragments(self):
+        for module in (fragmentation_py, fragmentation_cy):
+            engine = generate(module, 'chlorogenic acid', 3, 1)
+            peaks = get_peaks(engine)
+            peak_masses = [ childpeak.mz + pars.elmass for childpeak in peaks[0].childscan.peaks ]
+            pruned = generate(module, 'chlorogenic acid', 3, 1, peak_masses=peak_masses, precision=1 + 5e-06, mz_precision_abs=0.001)
+            fragments = get_fragments(pruned)
+            self.assertTrue(0 < len(fragments) < len(get_fragments(engine)))
+            self.assertTrue(set(fragments) <= set(get_fragments(engine)))
+            # all fragments which match a peak are kept
+            molecule = (1 << engine.natoms) - 1
+            for mass in peak_masses:
+                expected = get_found_fragments(engine.find_fragments(mass, molecule, 1 + 5e-06, 0.001))
+                self.assertEqual(get_found_fragments(pruned.find_fragments(mass, molecule, 1 + 5e-06, 0.001)), expected)
+
+            (hits, frags,) = search('chlorogenic acid', 3, 1, peaks, fast=module == fragmentation_cy, prune_fragments=True)
+            (expected, expected_frags,) = search('chlorogenic acid', 3, 1, peaks, fast=module == fragmentation_cy)
+            self.assertEqual(hits, expected)
+            self.assertTrue(frags < expected_frags)
+
+
+
+    def test_parallel_expansion(self):
+        min_parallel_fragments = fragmentation_py.min_parallel_fragments
+        fragmentation_py.min_parallel_fragments = 10
+        try:
+            for module in (fragmentation_py, fragmentation_cy):
+                engine = generate(module, 'chlorogenic acid', 3, 1)
+                parallel = generate(module, 'chlorogenic acid', 3, 1, ncpus=2)
+                # the same table, in the same order
+                self.assertEqual(parallel.fragment_info, engine.fragment_info)
+                self.assertEqual(parallel.fragment_mass_np.tolist(), engine.fragment_mass_np.tolist())
+                self.assertEqual(get_ion_masses(parallel), get_ion_masses(engine))
+
+        finally:
+            fragmentation_py.min_parallel_fragments = min_parallel_fragments
+
+
+
+    def test_neutral_losses_equal_baseline(self):
+        for module in (fragmentation_py, fragmentation_cy):
+            for name in ('phenylalanine', 'chlorogenic acid'):
+                ref = generate(baseline, name, 2, 2)
+                engine = generate(module, name, 2, 2)
+                self.assertEqual(get_fragments(engine), get_baseline_fragments(ref))
+                self.assertEqual(get_ion_masses(engine), get_baseline_ion_masses(ref))
+
+            # including losses of ammonia, atom 0 of phenylalanine
+            bondbreaks = dict([ (fragment, fragment_bondbreaks) for (fragment, score, fragment_bondbreaks,) in generate(module, 'phenylalanine', 2, 2).fragment_info[1:] ])
+            losses = [ fragment for fragment in bondbreaks if bondbreaks[fragment] == 3 and bondbreaks.get(fragment | 1) == 2 ]
+            self.assertTrue(len(losses) > 0)
+
+
+
+    def test_scores_rel2parent_equal_baseline(self):
+        for (name, max_broken_bonds,) in (('chlorogenic acid', 3), ('glycolipid', 1)):
+            ref = generate(baseline, name, max_broken_bonds, 0)
+            fragments = [ fragment for (fragment, score, bondbreaks,) in ref.fragment_info[1:] ]
+            for module in (fragmentation_py, fragmentation_cy):
+                engine = generate(module, name, max_broken_bonds, 0)
+                for parent in fragments[::max(1, len(fragments) // 20)]:
+                    children = [ fragment for fragment in fragments if fragment & parent == fragment ]
+                    expected = [ ref.score_fragment_rel2parent(fragment, parent) for fragment in children ]
+                    scores = engine.score_fragments_rel2parent(children, parent)
+                    self.assertEqual(len(scores), len(expected))
+                    for (score, expected_score,) in zip(scores, expected):
+                        self.assertAlmostEqual(score, expected_score)
+
+
+
+    def test_symmetric_fragments(self):
+        for module in (fragmentation_py, fragmentation_cy):
+            engine = generate(module, 'citric acid', 3, 1)
+            symmetric = module.FragmentEngine(get_molblock('citric acid'), 3, 1, 1, False, 0, True)
+            symmetric.generate_fragments()
+            self.assertTrue(symmetric.automorphism_tables != None)
+            # one fragment per class of symmetric fragments, with the same scores and masses
+            fragments = [ (symmetric.get_canonical_fragment(fragment), score, bondbreaks, mass) for (fragment, score, bondbreaks, mass,) in get_fragments(symmetric) ]
+            expected = sorted(set([ (symmetric.get_canonical_fragment(fragment), score, bondbreaks, mass) for (fragment, score, bondbreaks, mass,) in get_fragments(engine) ]))
+            self.assertEqual(sorted(fragments), expected)
+            self.assertTrue(len(fragments) < len(engine.fragment_info) - 1)
+            peaks = get_peaks(engine)
+            (hits, frags,) = search('citric acid', 3, 1, peaks, fast=module == fragmentation_cy, symmetry=True)
+            (expected_hits, expected_frags,) = search('citric acid', 3, 1, peaks, fast=module == fragmentation_cy)
+            self.assertEqual(frags, len(symmetric.fragment_info))
+            self.assertEqual(hits, expected_hits)
+
+
+
+    def test_fragments_from_parent(self):
+        parent = generate(fragmentation_py, 'chlorogenic acid', 3, 1)
+        for module in (fragmentation_py, fragmentation_cy):
+            for name in ('feruloylquinic acid', 'hydroxychlorogenic acid'):
+                full = generate(module, name, 3, 1)
+                engine = module.FragmentEngine(get_molblock(name), 3, 1, 1, False, 0)
+                self.assertEqual(engine.generate_fragments_from_parent(parent), len(full.fragment_info))
+                self.assertTrue(engine.reused_fragments > 0)
+                self.assertFalse(engine.complete())
+                # the same table, in another order
+                self.assertEqual(get_fragments(engine), get_fragments(full))
+                self.assertEqual(get_ion_masses(engine), get_ion_masses(full))
+
+        # not from a parent fragmented with other settings
+        engine = fragmentation_py.FragmentEngine(get_molblock('feruloylquinic acid'), 2, 1, 1, False, 0)
+        self.assertEqual(engine.generate_fragments_from_parent(parent), None)
+
+
+
+    def test_fragment_set(self):
+        rnd = numpy.random.RandomState(1)
+        fragment_set = fragmentation_py.FragmentSet(2)
+        visited = set([])
+        for i in range(20):
+            words = rnd.randint(0, 50, (30, 2)).astype(numpy.uint64)
+            expected = []
+            for row in words.tolist():
+                expected.append(tuple(row) not in visited)
+                visited.add(tuple(row))
+
+            self.assertEqual(fragment_set.add_new(words).tolist(), expected)
+            self.assertEqual(len(fragment_set), len(visited))
+            # batches are merged into a logarithmic number of sorted runs
+            self.assertTrue(len(fragment_set.runs) <= numpy.log2(len(visited)) + 1)
+
+        fragment_set.merge()
+        self.assertEqual(len(fragment_set.runs), 1)
+        self.assertEqual(len(fragment_set), len(visited))
+        self.assertEqual(fragment_set.runs[0].tolist(), sorted(fragment_set.runs[0].tolist()))
+        self.assertEqual(fragment_set.add_new(words).tolist(), [False] * len(words))
+
+
+
+    def test_score_batches(self):
+        full = generate(fragmentation_py, 'chlorogenic acid', 3, 1)
+        score_batch_memory = fragmentation_py.score_batch_memory
+        fragmentation_py.score_batch_memory = 0.001
+        try:
+            engine = generate(fragmentation_py, 'chlorogenic acid', 3, 1)
+            self.assertTrue(engine.get_score_batch_size() < 50)
+            self.assertEqual(engine.fragment_info, full.fragment_info)
+        finally:
+            fragmentation_py.score_batch_memory = score_batch_memory
+
+
+
+    def test_memory_limit(self):
+        full = generate(fragmentation_py, 'chlorogenic acid', 3, 1)
+        self.assertFalse(full.truncated)
+        max_memory = fragmentation_py.max_memory
+        fragmentation_py.max_memory = 0.05
+        try:
+            for module in (fragmentation_py, fragmentation_cy):
+                engine = generate(module, 'chlorogenic acid', 3, 1)
+                self.assertTrue(engine.truncated)
+                self.assertFalse(engine.complete())
+                # the fragments found before the limit was exceeded
+                self.assertTrue(1 < len(engine.fragment_info) < len(full.fragment_info))
+                self.assertEqual(engine.fragment_info, full.fragment_info[:len(engine.fragment_info)])
+                # the temporary arrays of a batch of children count as well
+                fragmentation_py.max_memory = engine.get_batch_bytes() / 1048576.0
+                self.assertTrue(generate(module, 'chlorogenic acid', 3, 1).truncated)
+                fragmentation_py.max_memory = 0.05
+
+        finally:
+            fragmentation_py.max_memory = max_memory
+
+
+
+    def test_beam_search(self):
+        for module in (fragmentation_py, fragmentation_cy):
+            full = generate(module, 'chlorogenic acid', 3, 1)
+            self.assertTrue(full.complete())
+            # a beam wider than any breadth step expands all fragments
+            engine = generate(module, 'chlorogenic acid', 3, 1, beam=100000)
+            self.assertFalse(engine.complete())
+            self.assertTrue(engine.cacheable())
+            self.assertEqual(engine.fragment_info, full.fragment_info)
+            self.assertEqual(get_ion_masses(engine), get_ion_masses(full))
+            engine = generate(module, 'chlorogenic acid', 3, 1, beam=5)
+            fragments = get_fragments(engine)
+            self.assertTrue(len(fragments) < len(full.fragment_info) - 1)
+            self.assertTrue(set(fragments) <= set(get_fragments(full)))
+            # the children of the molecule are all found before the beam selects any
+            self.assertEqual([ fragment for fragment in fragments if fragment[2] == 1 ], [ fragment for fragment in get_fragments(full) if fragment[2] == 1 ])
+
+        # only used for large molecules if enabled
+        self.assertTrue(generate(fragmentation_py, 'glycolipid', 1, 0).complete())
+        beam_max_atoms = fragmentation_py.beam_max_atoms
+        fragmentation_py.beam_max_atoms = 50
+        try:
+            self.assertFalse(generate(fragmentation_py, 'glycolipid', 1, 0).complete())
+            self.assertTrue(generate(fragmentation_py, 'glycolipid', 1, 0, beam=0).complete())
+            self.assertTrue(generate(fragmentation_py, 'chlorogenic acid', 1, 0).complete())
+        finally:
+            fragmentation_py.beam_max_atoms = beam_max_atoms
+
+
+
+
+
+class TestCompiledFragmentEngine(unittest.TestCase):
+
+    def test_fragments_equal_baseline(self):
+        for name in ('glucose', 'chlorogenic acid', 'phenylalanine'):
+            for ionisation_mode in (1, -1):
+                expected = get_baseline_fragments(generate(baseline, name, 3, 1, ionisation_mode))
+                self.assertEqual(get_fragments(generate(fragmentation_cy, name, 3, 1, ionisation_mode)), expected)
+
+
+
+    def test_more_than_64_atoms(self):
+        expected = get_baseline_fragments(generate(baseline, 'glycolipid', 2, 1))
+        self.assertEqual(get_fragments(generate(fragmentation_cy, 'glycolipid', 2, 1)), expected)
+
+
+
+    def test_kernels_equal_python(self):
+        engine = generate(fragmentation_cy, 'glycolipid', 1, 0)
+        ref = generate(fragmentation_py, 'glycolipid', 1, 0)
+        molecule = (1 << engine.natoms) - 1
+        fragments = [ fragment for (fragment, score, bondbreaks,) in ref.fragment_info[1:] ]
+        (bondbreaks, scores,) = engine.score_fragments(fragments)
+        (expected_bondbreaks, expected_scores,) = ref.score_fragments(fragments)
+        self.assertEqual(bondbreaks, expected_bondbreaks)
+        for (score, expected_score,) in zip(scores, expected_scores):
+            self.assertAlmostEqual(score, expected_score)
+
+        for fragment in fragments:
+            self.assertEqual(sorted(engine.get_child_fragments(fragment)), sorted(ref.get_child_fragments(fragment)))
+            self.assertAlmostEqual(engine.calc_fragment_mass(fragment), ref.calc_fragment_mass(fragment))
+            self.assertAlmostEqual(engine.score_fragment_rel2parent(fragment, molecule), ref.score_fragment_rel2parent(fragment, molecule))
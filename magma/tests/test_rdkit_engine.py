@@ -0,0 +1,85 @@
+"""
+Tests of the RDKit chemical engine, against the baseline functions (see baseline.py).
+"""
+import unittest
+import random
+from magma.tests import baseline
+from magma.tests.test_fragmentation import molecules, get_molblock
+try:
+    from magma import rdkit_engine as Chem
+except ImportError:
+    Chem = None
+
+# with stereocenters and a stereo double bond which fragments can lose
+smiles = [molecules['glucose'],
+ molecules['chlorogenic acid'],
+ molecules['phenylalanine'],
+ 'C/C=C/C(=O)OC[C@H](N)C(=O)O',
+ 'C[C@H](O)[C@@H](N)C(=O)O',
+ 'CC(C)CCC[C@@H](C)[C@H]1CC[C@H]2[C@@H]3CC=C4C[C@@H](O)CC[C@]4(C)[C@H]3CC[C@]12C']
+
+def get_random_fragments(mol, nfragments, rnd):
+    """Returns nfragments random connected fragments of mol, as sorted lists of atoms"""
+    natoms = mol.GetNumAtoms()
+    neighbours = [ [] for atom in range(natoms) ]
+    for bond in range(Chem.nbonds(mol)):
+        (a1, a2,) = Chem.GetBondAtoms(mol, bond)
+        neighbours[a1].append(a2)
+        neighbours[a2].append(a1)
+
+    fragments = []
+    for i in range(nfragments):
+        fragment = set([rnd.randrange(natoms)])
+        size = rnd.randrange(1, natoms + 1)
+        while len(fragment) < size:
+            extensions = [ a for atom in fragment for a in neighbours[atom] if a not in fragment ]
+            if len(extensions) == 0:
+                break
+            fragment.add(rnd.choice(extensions))
+
+        fragments.append(sorted(fragment))
+
+    return fragments
+
+
+
+@unittest.skipIf(Chem == None, 'RDKit is not installed')
+class TestFragmentsToSmiles(unittest.TestCase):
+
+    def test_fragments_equal_baseline(self):
+        rnd = random.Random(1)
+        for smi in smiles:
+            mol = Chem.MolFromSmiles(smi)
+            # and with explicit hydrogens, as atoms of their own
+            for mol in (mol, Chem.MolFromMolBlock(Chem.MolToMolBlock(Chem.AddHs(mol)), True, False)):
+                fragments = get_random_fragments(mol, 40, rnd)
+                expected = [ baseline.FragmentToInchiKey(mol, fragment) for fragment in fragments ]
+                self.assertEqual(Chem.FragmentsToSmiles(mol, fragments), expected)
+                self.assertEqual(Chem.FragmentsToInchiKey(mol, fragments), expected)
+
+
+
+    def test_lost_stereocenter(self):
+        mol = Chem.MolFromSmiles('C[C@H](O)CC')
+        self.assertEqual(Chem.FragmentToInchiKey(mol, [1, 2]), 'CO')
+        self.assertEqual(Chem.FragmentToInchiKey(mol, [0, 1, 2, 3]), baseline.FragmentToInchiKey(mol, [0, 1, 2, 3]))
+
+
+
+
+
+@unittest.skipIf(Chem == None, 'RDKit is not installed')
+class TestGetMolArrays(unittest.TestCase):
+
+    def test_arrays_equal_atom_calls(self):
+        for name in ('chlorogenic acid', 'choline', 'glycolipid'):
+            mol = Chem.MolFromMolBlock(get_molblock(name))
+            (masses, symbols, hs, degrees, bond_atoms, bond_types,) = Chem.GetMolArrays(mol)
+            atoms = range(Chem.natoms(mol))
+            self.assertEqual(masses.tolist(), [ Chem.GetExtendedAtomMass(mol, atom) for atom in atoms ])
+            self.assertEqual(symbols.tolist(), [ Chem.GetAtomSymbol(mol, atom) for atom in atoms ])
+            self.assertEqual(hs.tolist(), [ Chem.GetAtomHs(mol, atom) for atom in atoms ])
+            self.assertEqual(degrees.tolist(), [ Chem.GetNBonds(mol, atom) for atom in atoms ])
+            bonds = range(Chem.nbonds(mol))
+            self.assertEqual(bond_atoms.tolist(), [ Chem.GetBondAtoms(mol, bond) for bond in bonds ])
+            self.assertEqual(bond_types.tolist(), [ Chem.GetBondType(mol, bond) for bond in bonds ])